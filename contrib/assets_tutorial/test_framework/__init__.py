@@ -1 +1,4 @@
+# Only authproxy is copied here; the rest (readiness) is used from qa/rpc-tests/test_framework.
+import os
 
+__path__.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "qa", "rpc-tests", "test_framework"))
@@ -0,0 +1,81 @@
+# Submit pre-signed transactions to one node from several RPC clients at once, to see how it scales with
+# concurrent users (and -rpcthreads).
+#
+# Each client is a thread with its own AuthServiceProxy connection. Transactions come in chains (each one spending
+# the previous), and each chain belongs to one client, so a transaction never races its parent.
+#
+# Closed-loop (rate=None): every client submits its next transaction as soon as the last one returns, so the
+# offered load is whatever the node can take with that many clients.
+# Open-loop (rate=R): transaction i of the whole run is due at start + i/R, whatever happened before it. Latency is
+# measured from when it was due, so a node that falls behind shows up as growing latency rather than as a lower rate.
+
+from test_framework.authproxy import AuthServiceProxy, JSONRPCException
+import collections
+import threading
+import time
+
+class ClientStats:
+    def __init__(self):
+        self.latencies = []  # due (or sent, closed-loop) to accepted, in seconds
+        self.service_times = []  # sent to accepted
+        self.rejects = collections.Counter()  # RPC error code -> count
+        self.errors = collections.Counter()  # exception type -> count, for connection problems and the like
+
+class SubmissionDriver:
+    def __init__(self, url, clients, rate=None, send_args=(True, True)):
+        self.url = url
+        self.clients = clients
+        self.rate = rate
+        # After the transaction: allowhighfees, and for elementsd allowunblindfails
+        self.send_args = send_args
+        self.on_accept = None  # called (from the client threads) after each accepted transaction
+
+    def schedule(self, chains):
+        # Breadth first over the chains, as presigned does, then dealt out to the clients by chain
+        order = []
+        for k in range(max(len(chain) for chain in chains)):
+            for (i, chain) in enumerate(chains):
+                if k < len(chain):
+                    order.append((i, chain[k]))
+        work = [[] for c in range(self.clients)]
+        for (index, (i, signedtx)) in enumerate(order):
+            work[i % self.clients].append((index, signedtx))
+        return work
+
+    def client(self, work, start, stats):
+        rpc = AuthServiceProxy(self.url)
+        for (index, signedtx) in work:
+            due = None
+            if self.rate is not None:
+                due = start + index / self.rate
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            sent = time.perf_counter()
+            try:
+                rpc.sendrawtransaction(signedtx, *self.send_args)
+            except JSONRPCException as e:
+                stats.rejects[e.error.get("code") if isinstance(e.error, dict) else None] += 1
+                continue
+            except Exception as e:
+                stats.errors[type(e).__name__] += 1
+                # The connection may be unusable now
+                rpc = AuthServiceProxy(self.url)
+                continue
+            done = time.perf_counter()
+            stats.service_times.append(done - sent)
+            stats.latencies.append(done - (due if due is not None else sent))
+            if self.on_accept is not None:
+                self.on_accept()
+
+    def run(self, chains):
+        # Returns the per-client ClientStats once everything has been submitted
+        work = self.schedule(chains)
+        stats = [ClientStats() for c in range(self.clients)]
+        start = time.perf_counter()
+        threads = [threading.Thread(target=self.client, args=(work[c], start, stats[c])) for c in range(self.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return stats
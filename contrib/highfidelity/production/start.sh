@@ -16,25 +16,39 @@ DATA_DIR=$HERE
 ELEMENTS_PATH=$HERE/../../../src
 PRIVFILE=$HERE/blockpriv
 PUBFILE=$HERE/blockpub
+PIDFILE=$HERE/elementsregtest/elements-daemon.pid
 
 alias daemon="$ELEMENTS_PATH/elementsd -datadir=$DATA_DIR"
 alias cli="$ELEMENTS_PATH/elements-cli -datadir=$DATA_DIR"
 
+# Rather than sleeping for a guessed time:
+# wait until elementsd answers RPCs (-rpcwait also waits out warmup),
+wait_ready() {
+    cli -rpcwait getblockcount > /dev/null
+}
+# and until this datadir's elementsd has exited (it removes its pid file on
+# the way out; other elementsd processes on the machine don't matter).
+wait_stopped() {
+    while [ -f $PIDFILE ] && kill -0 $(cat $PIDFILE) 2> /dev/null; do
+        sleep 0.1
+    done
+}
+
 if [ "$1" = "-reset" ]; then
     echo Resetting all blockchain data and stashing new blocksigning keys.
     
     pkill elementsd  # stop any existing
-    sleep 1
+    wait_stopped
     rm -r $HERE/elementsregtest $PRIVFILE $PUBFILE
     daemon
-    sleep 5  # can't talk to it during startup
+    wait_ready  # can't talk to it during startup
     ADDR=$(cli getnewaddress)
     VALID=$(cli validateaddress $ADDR)
     echo $VALID | python3 -c "import sys, json; print(json.load(sys.stdin)['pubkey'])" > $PUBFILE
     cli dumpprivkey $ADDR > $PRIVFILE
     # For security, you cannot swap out blocksigner with old genesis block
     cli stop
-    sleep 2
+    wait_stopped
     rm -r $HERE/elementsregtest
     
 elif [ ! -f $PUBFILE ] || [ ! -f $PRIVFILE ]; then
@@ -51,7 +65,7 @@ PUBKEY=`cat $PUBFILE`
 KEY=`cat $PRIVFILE`
 SIGNBLOCKARG="-signblockscript=5121$(echo $PUBKEY)51ae"
 daemon $SIGNBLOCKARG
-sleep 5
+wait_ready
 cli importprivkey $KEY
 
 if [ $(cli getblockcount) -lt 101 ]; then
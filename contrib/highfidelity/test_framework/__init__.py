@@ -1 +1,5 @@
+# Only authproxy, which is needed without a build tree, is copied here; the rest (readiness, mininode, key,
+# blocksigner, ...) are used from qa/rpc-tests/test_framework.
+import os
 
+__path__.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "qa", "rpc-tests", "test_framework"))
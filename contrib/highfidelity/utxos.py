@@ -0,0 +1,103 @@
+# A local model of the unspent outputs at the addresses we trade from, so that the steady-state loop doesn't have to
+# ask the node for them.
+#
+# Without it, every transfer costs a listunspent (which walks the whole wallet) to find the inputs, and a
+# getrawtransaction per input to find the scriptPubKey to sign against. But we made those outputs ourselves: we know
+# the outputs of each transaction we create (createrawtransaction keeps the order we give them in), and
+# sendrawtransaction tells us its txid. The scriptPubKey of an address never changes, so it is looked up once.
+#
+# Transactions funded by the wallet (fundrawtransaction adds change wherever it likes) just mark their addresses as
+# stale, and those are reloaded from listunspent the next time they are needed. reconcile() compares everything with
+# the node and adopts the node's view where they differ, counting the differences.
+
+import collections
+
+class UTXOTracker:
+    def __init__(self, rpc, listunspent):
+        self.rpc = rpc
+        self.listunspent = listunspent  # addresses -> listunspent entries, for the asset we track
+        self.utxos = {}  # address -> OrderedDict (txid, vout) -> amount, oldest first
+        self.owners = {}  # (txid, vout) -> address
+        self.scripts = {}  # address -> scriptPubKey hex
+        self.stale = set()  # addresses to reload before use
+        self.reloads = 0
+        self.reconciliations = 0
+        self.mismatches = 0
+
+    def track(self, address):
+        if address not in self.utxos:
+            self.utxos[address] = collections.OrderedDict()
+            self.stale.add(address)
+
+    def tracks(self, addresses):
+        return all(address in self.utxos for address in addresses)
+
+    def script(self, address):
+        if address not in self.scripts:
+            self.scripts[address] = self.rpc.validateaddress(address)["scriptPubKey"]
+        return self.scripts[address]
+
+    def _replace(self, address, listing):
+        for outpoint in self.utxos[address]:
+            del self.owners[outpoint]
+        self.utxos[address] = collections.OrderedDict()
+        for entry in listing:
+            outpoint = (entry["txid"], entry["vout"])
+            self.utxos[address][outpoint] = entry["amount"]
+            self.owners[outpoint] = address
+            self.scripts.setdefault(address, entry["scriptPubKey"])
+        self.stale.discard(address)
+
+    def _load(self, address):
+        self.reloads += 1
+        self._replace(address, self.listunspent([address]))
+
+    def inputs(self, addresses):
+        # {txid, vout} for every output we know of at addresses, like getunspent
+        result = []
+        for address in addresses:
+            if address in self.stale:
+                self._load(address)
+            result += [{"txid": txid, "vout": vout} for (txid, vout) in self.utxos[address]]
+        return result
+
+    def detail(self, input):
+        # {txid, vout, scriptPubKey} for signing, or None if it isn't one of ours
+        address = self.owners.get((input["txid"], input["vout"]))
+        if address is None:
+            return None
+        return {"txid": input["txid"], "vout": input["vout"], "scriptPubKey": self.script(address)}
+
+    def spent(self, inputs):
+        for input in inputs:
+            outpoint = (input["txid"], input["vout"])
+            address = self.owners.pop(outpoint, None)
+            if address is not None:
+                del self.utxos[address][outpoint]
+
+    def created(self, txid, outputs):
+        # outputs as given to createrawtransaction, in order
+        for (vout, (address, amount)) in enumerate(outputs.items()):
+            if address in self.utxos and address not in self.stale:
+                self.utxos[address][(txid, vout)] = amount
+                self.owners[(txid, vout)] = address
+
+    def invalidate(self, addresses):
+        for address in addresses:
+            if address in self.utxos:
+                self.stale.add(address)
+
+    def reconcile(self):
+        self.reconciliations += 1
+        for address in self.utxos:
+            listing = self.listunspent([address])
+            if set((entry["txid"], entry["vout"]) for entry in listing) != set(self.utxos[address]):
+                self.mismatches += 1
+            self._replace(address, listing)
+
+    def stats(self):
+        return {"addresses": len(self.utxos),
+                "outputs": len(self.owners),
+                "reloads": self.reloads,
+                "reconciliations": self.reconciliations,
+                "mismatches": self.mismatches}
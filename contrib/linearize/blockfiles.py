@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+#
+# blockfiles.py: Stream blocks out of a node's blocks/blk*.dat files.
+#
+# Copyright (c) 2017 The Elements Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+# Each blk*.dat file is mmapped and walked record by record: 4 bytes of
+# network magic, a 4-byte little-endian size, then the serialized block.
+# Elements block headers are not a fixed 80 bytes: after nVersion,
+# hashPrevBlock, hashMerkleRoot and nTime come nHeight and a CProof
+# (challenge and solution scripts).  The block hash covers everything but
+# the solution.
+#
+# Records carry a memoryview of the block in the mapping, so nothing is
+# copied unless the caller asks for it.  The node preallocates block files
+# in zero-filled chunks; runs of zeros (and any other garbage) are skipped
+# by searching for the next magic, as -reindex does.
+#
+
+from __future__ import print_function, division
+import hashlib
+import mmap
+import os
+import os.path
+import struct
+from binascii import hexlify
+from collections import namedtuple
+
+# Fixed part of the header: nVersion, hashPrevBlock, hashMerkleRoot, nTime, nHeight
+HEADER_FIXED_SIZE = 4 + 32 + 32 + 4 + 4
+
+BlockHeader = namedtuple('BlockHeader', ['version', 'prev_hash', 'merkle_root', 'time', 'height',
+					 'challenge', 'solution', 'size'])
+
+# offset is that of the block itself, just past magic and size
+BlockRecord = namedtuple('BlockRecord', ['fn', 'offset', 'magic', 'size', 'header', 'hash_str', 'data'])
+
+def hash_to_str(h):
+	'''Hex in the usual (byte-reversed) display order'''
+	return hexlify(bytes(h[::-1])).decode('utf-8')
+
+def read_compact_size(buf, pos):
+	'''Returns (value, new position)'''
+	n = struct.unpack_from('<B', buf, pos)[0]
+	if n < 253:
+		return (n, pos + 1)
+	if n == 253:
+		return (struct.unpack_from('<H', buf, pos + 1)[0], pos + 3)
+	if n == 254:
+		return (struct.unpack_from('<I', buf, pos + 1)[0], pos + 5)
+	return (struct.unpack_from('<Q', buf, pos + 1)[0], pos + 9)
+
+def parse_header(buf, pos=0):
+	'''Parse the Elements block header at buf[pos:].
+
+	Returns (BlockHeader, block hash as a display-order hex string).
+	Raises IndexError or struct.error if buf is too short.
+	'''
+	(version, prev_hash, merkle_root, ntime, height) = struct.unpack_from('<i32s32sII', buf, pos)
+	(challenge_len, challenge_pos) = read_compact_size(buf, pos + HEADER_FIXED_SIZE)
+	hashed_end = challenge_pos + challenge_len
+	(solution_len, solution_pos) = read_compact_size(buf, hashed_end)
+	end = solution_pos + solution_len
+	if end > len(buf):
+		raise IndexError('block header truncated')
+	header = BlockHeader(version, hash_to_str(prev_hash), hash_to_str(merkle_root), ntime, height,
+			     bytes(buf[challenge_pos:hashed_end]), bytes(buf[solution_pos:end]), end - pos)
+	h = hashlib.sha256(hashlib.sha256(buf[pos:hashed_end]).digest()).digest()
+	return (header, hash_to_str(h))
+
+def block_file_name(input_dir, fn):
+	return os.path.join(input_dir, "blk%05d.dat" % fn)
+
+class BlockFileReader:
+	'''Iterate over the blocks in blk00000.dat, blk00001.dat, ... in input_dir
+
+	Stops at the first missing file.  skipped_bytes counts bytes passed over
+	while looking for magic (mostly preallocated zeros).
+	'''
+	def __init__(self, input_dir, netmagic, first_fn=0):
+		self.input_dir = input_dir
+		self.netmagic = netmagic
+		self.first_fn = first_fn
+		self.skipped_bytes = 0
+
+	def file_numbers(self):
+		fn = self.first_fn
+		while os.path.exists(block_file_name(self.input_dir, fn)):
+			yield fn
+			fn += 1
+
+	def scan_file(self, fn, start=0):
+		'''Yield BlockRecords for one file, from offset start'''
+		with open(block_file_name(self.input_dir, fn), "rb") as f:
+			try:
+				mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			except ValueError:
+				# Empty file
+				return
+		buf = memoryview(mapped)
+		try:
+			for record in self._scan(fn, mapped, buf, start):
+				yield record
+		finally:
+			buf.release()
+			try:
+				mapped.close()
+			except BufferError:
+				# The caller still holds record data; the mapping goes
+				# away when the last of it does
+				pass
+
+	def _scan(self, fn, mapped, buf, pos):
+		netmagic = self.netmagic
+		end = len(buf)
+		while pos + 8 <= end:
+			magic = buf[pos:pos + 4]
+			if magic != netmagic:
+				found = mapped.find(netmagic, pos + 1)
+				if found < 0:
+					self.skipped_bytes += end - pos
+					return
+				self.skipped_bytes += found - pos
+				pos = found
+				continue
+			size = struct.unpack_from('<I', buf, pos + 4)[0]
+			offset = pos + 8
+			if offset + size > end:
+				# Truncated write at the end of the file
+				self.skipped_bytes += end - pos
+				return
+			data = buf[offset:offset + size]
+			try:
+				(header, hash_str) = parse_header(data)
+			except (IndexError, struct.error):
+				# Not a block after all; resume the search past this magic
+				self.skipped_bytes += 4
+				pos += 4
+				continue
+			yield BlockRecord(fn, offset, netmagic, size, header, hash_str, data)
+			pos = offset + size
+
+	def __iter__(self):
+		for fn in self.file_numbers():
+			for record in self.scan_file(fn):
+				yield record
+
+# Where each block is, for linearizing from an index instead of a scan.
+# offset and size are those of the block itself, as in BlockRecord.
+Extent = namedtuple('Extent', ['fn', 'offset', 'size', 'time'])
+
+INDEX_VERSION = 1
+
+def scan_extents(job):
+	'''Worker for ExtentIndex.update: (fn, end, [(hash_str, Extent)]) for one file'''
+	(input_dir, netmagic, fn, start) = job
+	reader = BlockFileReader(input_dir, netmagic)
+	blocks = []
+	end = start
+	for record in reader.scan_file(fn, start):
+		blocks.append((record.hash_str, Extent(fn, record.offset, record.size, record.header.time)))
+		end = record.offset + record.size
+	return (fn, end, blocks)
+
+class ExtentIndex:
+	'''Block hash -> Extent for every block in a blocks directory
+
+	The index remembers how far into each file it has scanned, so update()
+	only scans what the node has appended since (and files it has not seen).
+	A file whose last indexed block is no longer where the index says (eg
+	after -reindex) is scanned again from the start.
+
+	A block can be in more than one file (eg written again after a crash);
+	get() returns the copy in the highest-numbered file, and the others are
+	kept so that one can take over if that file goes away.
+
+	Saved as text: a header line, then per file a "file <fn> <end>" line
+	followed by "<hash> <offset> <size> <time>" lines for its blocks.
+	'''
+	def __init__(self, netmagic):
+		self.netmagic = netmagic
+		self.extents = {}
+		self.files = {}		# fn -> [scanned up to, [hash_str, ...]]
+		self.copies = {}	# hash_str -> [Extent, ...] in other files than extents[hash_str]
+
+	def __len__(self):
+		return len(self.extents)
+
+	def __contains__(self, hash_str):
+		return hash_str in self.extents
+
+	def get(self, hash_str):
+		return self.extents.get(hash_str)
+
+	@classmethod
+	def load(cls, path, netmagic):
+		'''Load a saved index, or return an empty one if path is missing or
+		was written for another network or format'''
+		index = cls(netmagic)
+		if not os.path.exists(path):
+			return index
+		with open(path, "r") as f:
+			if f.readline().split() != ['linearize-index', str(INDEX_VERSION), hexlify(netmagic).decode('utf-8')]:
+				return index
+			hashes = None
+			fn = None
+			for line in f:
+				fields = line.split()
+				if fields[0] == 'file':
+					fn = int(fields[1])
+					hashes = []
+					index.files[fn] = [int(fields[2]), hashes]
+					continue
+				index._add(fields[0], Extent(fn, int(fields[1]), int(fields[2]), int(fields[3])))
+				hashes.append(fields[0])
+		return index
+
+	def _add(self, hash_str, extent):
+		'''Record a copy of a block; returns whether the block is new'''
+		current = self.extents.get(hash_str)
+		if current is None:
+			self.extents[hash_str] = extent
+			return True
+		if extent.fn > current.fn:
+			(current, extent) = (extent, current)
+			self.extents[hash_str] = current
+		self.copies.setdefault(hash_str, []).append(extent)
+		return False
+
+	def _extent_in(self, hash_str, fn):
+		e = self.extents[hash_str]
+		if e.fn == fn:
+			return e
+		return next(c for c in self.copies[hash_str] if c.fn == fn)
+
+	def save(self, path):
+		tmp = path + '.tmp'
+		with open(tmp, "w") as f:
+			f.write('linearize-index %d %s\n' % (INDEX_VERSION, hexlify(self.netmagic).decode('utf-8')))
+			for fn in sorted(self.files):
+				(end, hashes) = self.files[fn]
+				f.write('file %d %d\n' % (fn, end))
+				for hash_str in hashes:
+					e = self._extent_in(hash_str, fn)
+					f.write('%s %d %d %d\n' % (hash_str, e.offset, e.size, e.time))
+		os.rename(tmp, path)
+
+	def _drop_file(self, fn):
+		for hash_str in self.files.pop(fn)[1]:
+			copies = self.copies.get(hash_str)
+			if not copies:
+				del self.extents[hash_str]
+				continue
+			if self.extents[hash_str].fn == fn:
+				# The copy in the highest-numbered remaining file takes over
+				copies.sort(key=lambda c: c.fn)
+				self.extents[hash_str] = copies.pop()
+			else:
+				copies.remove(next(c for c in copies if c.fn == fn))
+			if not copies:
+				del self.copies[hash_str]
+
+	def _still_valid(self, input_dir, fn):
+		'''Whether the last block indexed for fn is still where we left it'''
+		hashes = self.files[fn][1]
+		if not hashes:
+			return True
+		e = self._extent_in(hashes[-1], fn)
+		try:
+			with open(block_file_name(input_dir, fn), "rb") as f:
+				f.seek(e.offset)
+				data = f.read(e.size)
+			return len(data) == e.size and parse_header(data)[1] == hashes[-1]
+		except (IOError, OSError, IndexError, struct.error):
+			return False
+
+	def update(self, input_dir, workers=None):
+		'''Scan new data in input_dir, one worker process per file.
+
+		Returns the number of blocks added.
+		'''
+		reader = BlockFileReader(input_dir, self.netmagic)
+		present = set(reader.file_numbers())
+		for fn in list(self.files):
+			if fn not in present or not self._still_valid(input_dir, fn):
+				self._drop_file(fn)
+		jobs = [(input_dir, self.netmagic, fn, self.files[fn][0] if fn in self.files else 0)
+			for fn in sorted(present)]
+
+		if workers == 1 or len(jobs) <= 1:
+			results = map(scan_extents, jobs)
+			pool = None
+		else:
+			import multiprocessing
+			pool = multiprocessing.Pool(workers)
+			results = pool.imap(scan_extents, jobs)
+		added = 0
+		try:
+			for (fn, end, blocks) in results:
+				if fn not in self.files:
+					self.files[fn] = [0, []]
+				self.files[fn][0] = end
+				hashes = self.files[fn][1]
+				for (hash_str, extent) in blocks:
+					if self._add(hash_str, extent):
+						added += 1
+					hashes.append(hash_str)
+		finally:
+			if pool is not None:
+				pool.close()
+				pool.join()
+		return added
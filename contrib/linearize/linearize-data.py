@@ -13,12 +13,16 @@ import re
 import os
 import os.path
 import sys
-import hashlib
 import datetime
+import errno
+import heapq
+import json
 import time
-from collections import namedtuple
+from collections import namedtuple, OrderedDict, deque
 from binascii import hexlify, unhexlify
 
+from blockfiles import BlockFileReader, ExtentIndex, block_file_name
+
 settings = {}
 
 ##### Switch endian-ness #####
@@ -27,48 +31,7 @@ def hex_switchEndian(s):
 	pairList = [s[i:i+2].encode() for i in range(0, len(s), 2)]
 	return b''.join(pairList[::-1]).decode()
 
-def uint32(x):
-	return x & 0xffffffff
-
-def bytereverse(x):
-	return uint32(( ((x) << 24) | (((x) << 8) & 0x00ff0000) |
-		       (((x) >> 8) & 0x0000ff00) | ((x) >> 24) ))
-
-def bufreverse(in_buf):
-	out_words = []
-	for i in range(0, len(in_buf), 4):
-		word = struct.unpack('@I', in_buf[i:i+4])[0]
-		out_words.append(struct.pack('@I', bytereverse(word)))
-	return b''.join(out_words)
-
-def wordreverse(in_buf):
-	out_words = []
-	for i in range(0, len(in_buf), 4):
-		out_words.append(in_buf[i:i+4])
-	out_words.reverse()
-	return b''.join(out_words)
-
-def calc_hdr_hash(blk_hdr):
-	hash1 = hashlib.sha256()
-	hash1.update(blk_hdr)
-	hash1_o = hash1.digest()
-
-	hash2 = hashlib.sha256()
-	hash2.update(hash1_o)
-	hash2_o = hash2.digest()
-
-	return hash2_o
-
-def calc_hash_str(blk_hdr):
-	hash = calc_hdr_hash(blk_hdr)
-	hash = bufreverse(hash)
-	hash = wordreverse(hash)
-	hash_str = hexlify(hash).decode('utf-8')
-	return hash_str
-
-def get_blk_dt(blk_hdr):
-	members = struct.unpack("<I", blk_hdr[68:68+4])
-	nTime = members[0]
+def get_blk_dt(nTime):
 	dt = datetime.datetime.fromtimestamp(nTime)
 	dt_ym = datetime.datetime(dt.year, dt.month, 1)
 	return (dt_ym, nTime)
@@ -94,8 +57,96 @@ def mkblockmap(blkindex):
 		blkmap[hash] = height
 	return blkmap
 
-# Block header and extent on disk
-BlockExtent = namedtuple('BlockExtent', ['fn', 'offset', 'inhdr', 'blkhdr', 'size'])
+# Block extent on disk: offset and size of the block itself, after the
+# magic and size that precede it
+BlockExtent = namedtuple('BlockExtent', ['fn', 'offset', 'inhdr', 'size', 'time'])
+
+# Seconds between progress reports
+PROGRESS_INTERVAL = 10
+
+# Blocks remembered in the incremental state file; a reorg deeper than this
+# means rewriting the output from scratch
+STATE_TAIL = 100
+
+class InputFileCache:
+	'''Keep the most recently used input files open, as raw fds'''
+	def __init__(self, settings, maxOpen):
+		self.settings = settings
+		self.maxOpen = maxOpen
+		self.fds = OrderedDict()
+
+	def get(self, fn):
+		if fn in self.fds:
+			fd = self.fds.pop(fn)
+		else:
+			if len(self.fds) >= self.maxOpen:
+				os.close(self.fds.popitem(last=False)[1])
+			fd = os.open(block_file_name(self.settings['input'], fn), os.O_RDONLY)
+			if hasattr(os, 'posix_fadvise'):
+				# Mostly read front to back; let the kernel read ahead
+				os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+		self.fds[fn] = fd
+		return fd
+
+	def close(self):
+		for fd in self.fds.values():
+			os.close(fd)
+		self.fds.clear()
+
+def write_all(fd, data):
+	data = memoryview(data)
+	while data:
+		data = data[os.write(fd, data):]
+
+# In-kernel copies between files, best first; a method is dropped the first
+# time the kernel or filesystem refuses it.  Only a refusal of the very first
+# call, before anything was copied, counts: any other error (or one after
+# part of the extent is already in the output) is raised, since falling back
+# then would copy that part again.
+UNSUPPORTED_COPY_ERRNOS = set([errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP])
+
+class CopyUnsupported(Exception):
+	pass
+
+def kernel_copy(copy, offset, size):
+	first = True
+	while size > 0:
+		try:
+			n = copy(offset, size)
+		except OSError as e:
+			if first and e.errno in UNSUPPORTED_COPY_ERRNOS:
+				raise CopyUnsupported(e)
+			raise
+		if n == 0:
+			raise IOError("Unexpected end of input file")
+		first = False
+		offset += n
+		size -= n
+
+def copy_file_range_fd(in_fd, out_fd, offset, size):
+	kernel_copy(lambda offset, size: os.copy_file_range(in_fd, out_fd, size, offset), offset, size)
+
+def sendfile_fd(in_fd, out_fd, offset, size):
+	kernel_copy(lambda offset, size: os.sendfile(out_fd, in_fd, offset, size), offset, size)
+
+def read_write_fd(in_fd, out_fd, offset, size):
+	while size > 0:
+		chunk = os.pread(in_fd, min(size, 1 << 20), offset)
+		if not chunk:
+			raise IOError("Unexpected end of input file")
+		write_all(out_fd, chunk)
+		offset += len(chunk)
+		size -= len(chunk)
+
+def copy_methods(settings):
+	methods = []
+	if settings['zero_copy'] == 'true':
+		if hasattr(os, 'copy_file_range'):
+			methods.append(copy_file_range_fd)
+		if hasattr(os, 'sendfile'):
+			methods.append(sendfile_fd)
+	methods.append(read_write_fd)
+	return methods
 
 class BlockDataCopier:
 	def __init__(self, settings, blkindex, blkmap):
@@ -103,8 +154,7 @@ class BlockDataCopier:
 		self.blkindex = blkindex
 		self.blkmap = blkmap
 
-		self.inFn = 0
-		self.inF = None
+		self.inFn = None
 		self.outFn = 0
 		self.outsz = 0
 		self.outF = None
@@ -124,13 +174,100 @@ class BlockDataCopier:
 			self.setFileTime = True
 		if settings['split_timestamp'] != 0:
 			self.timestampSplit = True
+		self.inFiles = InputFileCache(settings, settings['max_open_files'])
+		self.copyMethods = copy_methods(settings)
+		self.bytesOut = 0
+		self.startTime = time.time()
+		self.lastProgress = self.startTime
 		# Extents and cache for out-of-order blocks
 		self.blockExtents = {}
 		self.outOfOrderData = {}
 		self.outOfOrderSize = 0 # running total size for items in outOfOrderData
-
-	def writeBlock(self, inhdr, blk_hdr, rawblock):
-		blockSizeOnDisk = len(inhdr) + len(blk_hdr) + len(rawblock)
+		self.outOfOrderHeights = [] # max-heap (negated) of heights in outOfOrderData, lazily pruned
+		self.evicted = set()
+		self.cacheStats = {'hits': 0, 'misses': 0, 'refetches': 0, 'evictions': 0, 'peak': 0}
+		# (height, hash, output file number, end offset) of the last blocks written
+		self.tail = deque(maxlen=STATE_TAIL)
+
+	def outFileName(self, fn):
+		if self.fileOutput:
+			return self.settings['output_file']
+		return os.path.join(self.settings['output'], "blk%05d.dat" % fn)
+
+	def loadState(self):
+		'''Pick up where a previous incremental run left off.
+
+		Truncates the output back to the last block it wrote that is still
+		on the best chain, and returns True; returns False if the output has
+		to be written from scratch.
+		'''
+		stateFile = self.settings['state_file']
+		if not os.path.exists(stateFile):
+			return False
+		with open(stateFile, "r") as f:
+			state = json.load(f)
+		if state.get('netmagic') != hexlify(self.settings['netmagic']).decode('utf-8'):
+			print("State file " + stateFile + " is for another network")
+			return False
+
+		tail = state['tail']
+		written = len(tail)
+		while tail:
+			(height, hash_str, fn, end) = tail[-1]
+			if height < len(self.blkindex) and self.blkindex[height] == hash_str:
+				break
+			tail.pop()
+		if not tail:
+			print("Existing output is no longer on the best chain")
+			return False
+		if len(tail) < written:
+			print("Rolling back %i blocks no longer on the best chain" % (written - len(tail)))
+
+		(height, hash_str, fn, end) = tail[-1]
+		outFname = self.outFileName(fn)
+		if not os.path.exists(outFname) or os.path.getsize(outFname) < end:
+			print("Output file " + outFname + " is shorter than the state file says")
+			return False
+		if not self.fileOutput:
+			# Drop output files written after the point we resume from
+			later = fn + 1
+			while os.path.exists(self.outFileName(later)):
+				os.remove(self.outFileName(later))
+				later += 1
+
+		self.outFn = fn
+		self.outFname = outFname
+		self.outF = open(outFname, "r+b", buffering=0)
+		self.outF.truncate(end)
+		self.outF.seek(end)
+		self.outsz = end
+		self.blkCountOut = height + 1
+		self.highTS = state['high_ts']
+		self.lastDate = datetime.datetime.strptime(state['last_date'], "%Y-%m")
+		self.tail.extend(tuple(entry) for entry in tail)
+		print("Resuming after block " + hash_str + " (height %i) in " % height + outFname)
+		return True
+
+	def saveState(self):
+		if not self.tail:
+			return
+		state = {
+			'netmagic': hexlify(self.settings['netmagic']).decode('utf-8'),
+			'height': self.tail[-1][0],
+			'hash': self.tail[-1][1],
+			'high_ts': self.highTS,
+			'last_date': self.lastDate.strftime("%Y-%m"),
+			'tail': list(self.tail),
+		}
+		tmp = self.settings['state_file'] + '.tmp'
+		with open(tmp, "w") as f:
+			json.dump(state, f, indent=1)
+		os.rename(tmp, self.settings['state_file'])
+
+	def writeBlock(self, extent, rawblock=None):
+		'''Append a block to the output, from memory if rawblock is given and
+		otherwise straight from its extent in the input'''
+		blockSizeOnDisk = len(extent.inhdr) + extent.size
 		if not self.fileOutput and ((self.outsz + blockSizeOnDisk) > self.maxOutSz):
 			self.outF.close()
 			if self.setFileTime:
@@ -140,7 +277,7 @@ class BlockDataCopier:
 			self.outFn = self.outFn + 1
 			self.outsz = 0
 
-		(blkDate, blkTS) = get_blk_dt(blk_hdr)
+		(blkDate, blkTS) = get_blk_dt(extent.time)
 		if self.timestampSplit and (blkDate > self.lastDate):
 			print("New month " + blkDate.strftime("%Y-%m") + " @ " + self.hash_str)
 			self.lastDate = blkDate
@@ -154,34 +291,50 @@ class BlockDataCopier:
 				self.outsz = 0
 
 		if not self.outF:
-			if self.fileOutput:
-				self.outFname = self.settings['output_file']
-			else:
-				self.outFname = os.path.join(self.settings['output'], "blk%05d.dat" % self.outFn)
+			self.outFname = self.outFileName(self.outFn)
 			print("Output file " + self.outFname)
-			self.outF = open(self.outFname, "wb")
-
-		self.outF.write(inhdr)
-		self.outF.write(blk_hdr)
-		self.outF.write(rawblock)
-		self.outsz = self.outsz + len(inhdr) + len(blk_hdr) + len(rawblock)
+			# Unbuffered, so in-kernel copies and our own writes stay in order
+			self.outF = open(self.outFname, "wb", buffering=0)
+
+		outFd = self.outF.fileno()
+		if rawblock is not None:
+			write_all(outFd, extent.inhdr)
+			write_all(outFd, rawblock)
+		else:
+			# The magic and size are on disk right before the block
+			self.copyExtent(extent.fn, extent.offset - len(extent.inhdr), blockSizeOnDisk, outFd)
+		self.outsz = self.outsz + blockSizeOnDisk
+		self.bytesOut += blockSizeOnDisk
+		self.tail.append((self.blkCountOut, self.blkindex[self.blkCountOut], self.outFn, self.outsz))
 
 		self.blkCountOut = self.blkCountOut + 1
 		if blkTS > self.highTS:
 			self.highTS = blkTS
 
-		if (self.blkCountOut % 1000) == 0:
-			print('%i blocks scanned, %i blocks written (of %i, %.1f%% complete)' % 
-					(self.blkCountIn, self.blkCountOut, len(self.blkindex), 100.0 * self.blkCountOut / len(self.blkindex)))
+		now = time.time()
+		if now - self.lastProgress >= PROGRESS_INTERVAL:
+			self.lastProgress = now
+			self.printProgress()
+
+	def printProgress(self):
+		elapsed = max(time.time() - self.startTime, 1e-6)
+		print('%i blocks scanned, %i blocks written (of %i, %.1f%% complete), %.1f MB at %.1f MB/s' %
+				(self.blkCountIn, self.blkCountOut, len(self.blkindex), 100.0 * self.blkCountOut / len(self.blkindex),
+				 self.bytesOut / 1e6, self.bytesOut / 1e6 / elapsed))
+
+	def copyExtent(self, fn, offset, size, outFd):
+		inFd = self.inFiles.get(fn)
+		while True:
+			try:
+				self.copyMethods[0](inFd, outFd, offset, size)
+				return
+			except CopyUnsupported as e:
+				if self.settings['debug_output'] == 'true':
+					print("%s failed (%s), falling back" % (self.copyMethods[0].__name__, e))
+				self.copyMethods.pop(0)
 
 	def inFileName(self, fn):
-		return os.path.join(self.settings['input'], "blk%05d.dat" % fn)
-
-	def fetchBlock(self, extent):
-		'''Fetch block contents from disk given extents'''
-		with open(self.inFileName(extent.fn), "rb") as f:
-			f.seek(extent.offset)
-			return f.read(extent.size)
+		return block_file_name(self.settings['input'], fn)
 
 	def copyOneBlock(self):
 		'''Find the next block to be written in the input, and copy it to the output.'''
@@ -190,70 +343,140 @@ class BlockDataCopier:
 			# If the data is cached, use it from memory and remove from the cache
 			rawblock = self.outOfOrderData.pop(self.blkCountOut)
 			self.outOfOrderSize -= len(rawblock)
-		else: # Otherwise look up data on disk
-			rawblock = self.fetchBlock(extent)
-
-		self.writeBlock(extent.inhdr, extent.blkhdr, rawblock)
+			self.cacheStats['hits'] += 1
+			self.writeBlock(extent, rawblock)
+		else: # Otherwise copy it from disk
+			self.cacheStats['misses'] += 1
+			if self.blkCountOut in self.evicted:
+				self.evicted.remove(self.blkCountOut)
+				self.cacheStats['refetches'] += 1
+			self.writeBlock(extent)
+
+	def furthestCached(self):
+		'''Height of the cached block furthest from being written, or None'''
+		while self.outOfOrderHeights and -self.outOfOrderHeights[0] not in self.outOfOrderData:
+			heapq.heappop(self.outOfOrderHeights)
+		return -self.outOfOrderHeights[0] if self.outOfOrderHeights else None
+
+	def cacheBlock(self, height, data):
+		'''Keep an out-of-order block in memory if it is needed sooner than
+		something already cached, evicting the blocks needed last.  Anything
+		not cached is copied from its extent when its turn comes.'''
+		size = len(data)
+		limit = self.settings['out_of_order_cache_sz']
+		if size > limit:
+			return
+		while self.outOfOrderSize + size > limit:
+			furthest = self.furthestCached()
+			if furthest is None or furthest < height:
+				# Everything cached is needed sooner than this block
+				return
+			heapq.heappop(self.outOfOrderHeights)
+			self.outOfOrderSize -= len(self.outOfOrderData.pop(furthest))
+			self.evicted.add(furthest)
+			self.cacheStats['evictions'] += 1
+		self.outOfOrderData[height] = data.tobytes()
+		self.outOfOrderSize += size
+		heapq.heappush(self.outOfOrderHeights, -height)
+		if self.outOfOrderSize > self.cacheStats['peak']:
+			self.cacheStats['peak'] = self.outOfOrderSize
+
+	def printCacheStats(self):
+		stats = self.cacheStats
+		print('Out-of-order cache: %i hits, %i read from disk (%i of them evicted earlier), %i evictions, peak %.1f MB' %
+				(stats['hits'], stats['misses'], stats['refetches'], stats['evictions'], stats['peak'] / 1e6))
+
+	def finish(self):
+		self.inFiles.close()
+		if self.outF:
+			self.outF.close()
+		if self.settings['incremental'] == 'true':
+			self.saveState()
+		self.printProgress()
+		if self.blkCountOut < len(self.blkindex):
+			print("Premature end of block data")
+			return False
+		return True
+
+	def runIndexed(self):
+		'''Index all block files first (one worker per file), then write the
+		blocks in height order straight from their extents'''
+		indexFile = self.settings['index_file']
+		index = ExtentIndex.load(indexFile, self.settings['netmagic'])
+		print("Index " + indexFile + ": %i blocks" % len(index))
+		start = time.time()
+		added = index.update(self.settings['input'], self.settings['scan_workers'] or None)
+		index.save(indexFile)
+		print("Indexed %i new blocks in %.1fs" % (added, time.time() - start))
+		self.blkCountIn = len(index)
+
+		inLen = struct.Struct("<I")
+		for height in range(self.blkCountOut, len(self.blkindex)):
+			self.hash_str = self.blkindex[height]
+			e = index.get(self.hash_str)
+			if e is None:
+				print("Block " + self.hash_str + " (height %i) not found in block files" % height)
+				break
+			self.writeBlock(BlockExtent(e.fn, e.offset, self.settings['netmagic'] + inLen.pack(e.size), e.size, e.time))
+
+		if self.finish():
+			print("Done (%i blocks written)" % (self.blkCountOut))
 
 	def run(self):
-		while self.blkCountOut < len(self.blkindex):
-			if not self.inF:
-				fname = self.inFileName(self.inFn)
-				print("Input file " + fname)
-				try:
-					self.inF = open(fname, "rb")
-				except IOError:
-					print("Premature end of block data")
-					return
-
-			inhdr = self.inF.read(8)
-			if (not inhdr or (inhdr[0] == "\0")):
-				self.inF.close()
-				self.inF = None
-				self.inFn = self.inFn + 1
-				continue
-
-			inMagic = inhdr[:4]
-			if (inMagic != self.settings['netmagic']):
-				print("Invalid magic: " + hexlify(inMagic).decode('utf-8'))
+		if self.settings['incremental'] == 'true':
+			if not self.loadState() and os.path.exists(self.settings['state_file']):
+				# Rewriting from scratch; don't trust the old state if we stop early
+				os.remove(self.settings['state_file'])
+			if self.blkCountOut >= len(self.blkindex):
+				self.outF.close()
+				print("Nothing to do (%i blocks already written)" % self.blkCountOut)
 				return
-			inLenLE = inhdr[4:]
-			su = struct.unpack("<I", inLenLE)
-			inLen = su[0] - 80 # length without header
-			blk_hdr = self.inF.read(80)
-			inExtent = BlockExtent(self.inFn, self.inF.tell(), inhdr, blk_hdr, inLen)
-
-			self.hash_str = calc_hash_str(blk_hdr)
-			if not self.hash_str in blkmap:
+		if self.settings['indexed'] == 'true':
+			return self.runIndexed()
+
+		reader = BlockFileReader(self.settings['input'], self.settings['netmagic'])
+		for record in reader:
+			if self.blkCountOut >= len(self.blkindex):
+				break
+			if record.fn != self.inFn:
+				self.inFn = record.fn
+				print("Input file " + self.inFileName(self.inFn))
+
+			self.hash_str = record.hash_str
+			if not self.hash_str in self.blkmap:
 				# Because blocks can be written to files out-of-order as of 0.10, the script
 				# may encounter blocks it doesn't know about. Treat as debug output.
-				if settings['debug_output'] == 'true':
+				if self.settings['debug_output'] == 'true':
 					print("Skipping unknown block " + self.hash_str)
-				self.inF.seek(inLen, os.SEEK_CUR)
 				continue
 
 			blkHeight = self.blkmap[self.hash_str]
 			self.blkCountIn += 1
+			if blkHeight < self.blkCountOut:
+				# Already written by an earlier incremental run
+				continue
+			extent = BlockExtent(record.fn, record.offset, record.magic + struct.pack("<I", record.size),
+					     record.size, record.header.time)
 
 			if self.blkCountOut == blkHeight:
 				# If in-order block, just copy
-				rawblock = self.inF.read(inLen)
-				self.writeBlock(inhdr, blk_hdr, rawblock)
+				self.writeBlock(extent)
 
 				# See if we can catch up to prior out-of-order blocks
 				while self.blkCountOut in self.blockExtents:
 					self.copyOneBlock()
 
 			else: # If out-of-order, skip over block data for now
-				self.blockExtents[blkHeight] = inExtent
-				if self.outOfOrderSize < self.settings['out_of_order_cache_sz']:
-					# If there is space in the cache, read the data
-					# Reading the data in file sequence instead of seeking and fetching it later is preferred,
-					# but we don't want to fill up memory
-					self.outOfOrderData[blkHeight] = self.inF.read(inLen)
-					self.outOfOrderSize += inLen
-				else: # If no space in cache, seek forward
-					self.inF.seek(inLen, os.SEEK_CUR)
+				self.blockExtents[blkHeight] = extent
+				# Reading the data in file sequence instead of seeking and fetching it later is preferred,
+				# but we don't want to fill up memory
+				self.cacheBlock(blkHeight, record.data)
+
+		if not self.finish():
+			return
+		self.printCacheStats()
+		if reader.skipped_bytes and self.settings['debug_output'] == 'true':
+			print("Skipped %i bytes of padding or invalid data" % reader.skipped_bytes)
 
 		print("Done (%i blocks written)" % (self.blkCountOut))
 
@@ -300,6 +523,16 @@ if __name__ == '__main__':
 		settings['out_of_order_cache_sz'] = 100 * 1000 * 1000
 	if 'debug_output' not in settings:
 		settings['debug_output'] = 'false'
+	if 'zero_copy' not in settings:
+		settings['zero_copy'] = 'true'
+	if 'max_open_files' not in settings:
+		settings['max_open_files'] = 8
+	if 'indexed' not in settings:
+		settings['indexed'] = 'false'
+	if 'scan_workers' not in settings:
+		settings['scan_workers'] = 0
+	if 'incremental' not in settings:
+		settings['incremental'] = 'false'
 
 	settings['max_out_sz'] = int(settings['max_out_sz'])
 	settings['split_timestamp'] = int(settings['split_timestamp'])
@@ -307,10 +540,26 @@ if __name__ == '__main__':
 	settings['netmagic'] = unhexlify(settings['netmagic'].encode('utf-8'))
 	settings['out_of_order_cache_sz'] = int(settings['out_of_order_cache_sz'])
 	settings['debug_output'] = settings['debug_output'].lower()
+	settings['zero_copy'] = settings['zero_copy'].lower()
+	settings['max_open_files'] = int(settings['max_open_files'])
+	settings['indexed'] = settings['indexed'].lower()
+	settings['scan_workers'] = int(settings['scan_workers'])
+	settings['incremental'] = settings['incremental'].lower()
 
 	if 'output_file' not in settings and 'output' not in settings:
 		print("Missing output file / directory")
 		sys.exit(1)
+	if 'index_file' not in settings:
+		# Next to the output
+		if 'output' in settings:
+			settings['index_file'] = os.path.join(settings['output'], 'linearize.index')
+		else:
+			settings['index_file'] = settings['output_file'] + '.index'
+	if 'state_file' not in settings:
+		if 'output' in settings:
+			settings['state_file'] = os.path.join(settings['output'], 'linearize.state')
+		else:
+			settings['state_file'] = settings['output_file'] + '.state'
 
 	blkindex = get_block_hashes(settings)
 	blkmap = mkblockmap(blkindex)
@@ -13,12 +13,22 @@ try: # Python 3
 except ImportError: # Python 2
     import httplib
 import json
+import os
 import re
 import base64
 import sys
+import threading
+from multiprocessing.pool import ThreadPool
+
+from blockfiles import parse_header
 
 settings = {}
 
+# getblockhash calls per RPC batch
+RPC_BATCH_SIZE = 10000
+# Most headers /rest/headers will return at once
+REST_MAX_HEADERS = 2000
+
 ##### Switch endian-ness #####
 def hex_switchEndian(s):
 	""" Switches the endianness of a hex string (in pairs of hex chars) """
@@ -66,32 +76,156 @@ class BitcoinRPC:
 	def response_is_error(resp_obj):
 		return 'error' in resp_obj and resp_obj['error'] is not None
 
-def get_block_hashes(settings, max_blocks_per_call=10000):
-	rpc = BitcoinRPC(settings['host'], settings['port'],
-			 settings['rpcuser'], settings['rpcpassword'])
+def get_rpc(settings, local):
+	'''One RPC connection per thread'''
+	if not hasattr(local, 'rpc'):
+		local.rpc = BitcoinRPC(settings['host'], settings['port'],
+				       settings['rpcuser'], settings['rpcpassword'])
+	return local.rpc
 
-	height = settings['min_height']
-	while height < settings['max_height']+1:
-		num_blocks = min(settings['max_height']+1-height, max_blocks_per_call)
-		batch = []
-		for x in range(num_blocks):
-			batch.append(rpc.build_request(x, 'getblockhash', [height + x]))
+def rpc_block_hashes(rpc, heights):
+	'''getblockhash for every height, in one batch'''
+	batch = []
+	for x,height in enumerate(heights):
+		batch.append(rpc.build_request(x, 'getblockhash', [height]))
 
-		reply = rpc.execute(batch)
-		if reply is None:
-			print('Cannot continue. Program will halt.')
-			return None
+	reply = rpc.execute(batch)
+	if reply is None:
+		raise RuntimeError('Cannot continue. Program will halt.')
 
-		for x,resp_obj in enumerate(reply):
-			if rpc.response_is_error(resp_obj):
-				print('JSON-RPC: error at height', height+x, ': ', resp_obj['error'], file=sys.stderr)
-				exit(1)
-			assert(resp_obj['id'] == x) # assume replies are in-sequence
-			if settings['rev_hash_bytes'] == 'true':
-				resp_obj['result'] = hex_switchEndian(resp_obj['result'])
-			print(resp_obj['result'])
+	hashes = []
+	for x,resp_obj in enumerate(reply):
+		if rpc.response_is_error(resp_obj):
+			raise RuntimeError('JSON-RPC: error at height %d: %s' % (heights[x], resp_obj['error']))
+		assert(resp_obj['id'] == x) # assume replies are in-sequence
+		hashes.append(resp_obj['result'])
+	return hashes
 
-		height += num_blocks
+class RESTHeaders:
+	'''Fetch runs of up to REST_MAX_HEADERS block hashes with /rest/headers'''
+	def __init__(self, host, port):
+		self.conn = httplib.HTTPConnection(host, port=port, timeout=30)
+
+	def get(self, start_hash, count):
+		self.conn.request('GET', '/rest/headers/%d/%s.bin' % (count, start_hash))
+		resp = self.conn.getresponse()
+		body = resp.read()
+		if resp.status != 200:
+			raise RuntimeError('REST: %d %s (is the node running with -rest?)' % (resp.status, body.strip()))
+		hashes = []
+		pos = 0
+		prev = None
+		while pos < len(body):
+			(header, hash_str) = parse_header(body, pos)
+			if prev is not None and header.prev_hash != prev:
+				raise RuntimeError('REST: headers after %s do not connect' % prev)
+			hashes.append(hash_str)
+			prev = hash_str
+			pos += header.size
+		if not hashes or hashes[0] != start_hash:
+			raise RuntimeError('REST: %s is no longer in the active chain' % start_hash)
+		return hashes
+
+def fetch_batches(settings, start_height):
+	'''Yield lists of block hashes for consecutive heights from start_height
+	to max_height, fetching up to `connections` batches at once'''
+	end_height = settings['max_height'] + 1
+	if start_height >= end_height:
+		return
+	local = threading.local()
+	if settings['rest'] == 'true':
+		step = REST_MAX_HEADERS
+		# The hash at the start of each run comes from RPC
+		starts = list(range(start_height, end_height, step))
+		anchors = []
+		for i in range(0, len(starts), RPC_BATCH_SIZE):
+			anchors += rpc_block_hashes(get_rpc(settings, local), starts[i:i+RPC_BATCH_SIZE])
+		def fetch(job):
+			(height, anchor) = job
+			if not hasattr(local, 'rest'):
+				local.rest = RESTHeaders(settings['host'], settings['port'])
+			count = min(step, end_height - height)
+			hashes = local.rest.get(anchor, count)
+			if len(hashes) != count:
+				raise RuntimeError('REST: chain ends before height %d' % (height + count - 1))
+			return hashes
+		jobs = list(zip(starts, anchors))
+	else:
+		step = RPC_BATCH_SIZE
+		def fetch(height):
+			return rpc_block_hashes(get_rpc(settings, local), list(range(height, min(height + step, end_height))))
+		jobs = range(start_height, end_height, step)
+
+	pool = ThreadPool(settings['connections'])
+	try:
+		# imap keeps the results in order while later batches are in flight
+		for hashes in pool.imap(fetch, jobs):
+			yield hashes
+	finally:
+		pool.terminate()
+
+def resume_height(settings, lines):
+	'''Number of lines of an existing hash list that are still on the best
+	chain; later lines are dropped'''
+	if not lines:
+		return 0
+	rpc = get_rpc(settings, threading.local())
+	# Check the tail (where a reorg would show up) in one batch
+	first = max(0, len(lines) - RPC_BATCH_SIZE)
+	heights = [settings['min_height'] + i for i in range(first, len(lines))]
+	current = rpc_block_hashes(rpc, [h for h in heights if h <= settings['max_height']])
+	keep = first
+	for (i, hash_str) in enumerate(current):
+		if lines[first + i] != hash_str:
+			break
+		keep = first + i + 1
+	if keep == first and first > 0:
+		# Diverged before the tail we checked; start over
+		return 0
+	return keep
+
+def open_output(settings):
+	'''Open the hash list for appending after the hashes in it that are
+	still on the best chain.  Returns (file, number of hashes kept).'''
+	text = ''
+	if os.path.exists(settings['hashlist_output']):
+		with open(settings['hashlist_output'], "r") as f:
+			text = f.read()
+	lines = text.split()
+	if settings['rev_hash_bytes'] == 'true':
+		lines = [hex_switchEndian(line) for line in lines]
+	keep = resume_height(settings, lines)
+	if lines:
+		print('Resuming %s: keeping %d of %d hashes' % (settings['hashlist_output'], keep, len(lines)), file=sys.stderr)
+	if keep == len(lines) and text.endswith('\n'):
+		return (open(settings['hashlist_output'], "a"), keep)
+	# Rewrite the kept hashes (after a reorg, or a partly written last line)
+	out = open(settings['hashlist_output'], "w")
+	out.write(''.join(line + '\n' for line in text.split()[:keep]))
+	return (out, keep)
+
+def get_block_hashes(settings):
+	out = sys.stdout
+	start_height = settings['min_height']
+	written = 0
+	try:
+		if 'hashlist_output' in settings:
+			(out, keep) = open_output(settings)
+			start_height += keep
+		for hashes in fetch_batches(settings, start_height):
+			if settings['rev_hash_bytes'] == 'true':
+				hashes = [hex_switchEndian(h) for h in hashes]
+			out.write('\n'.join(hashes) + '\n')
+			written += len(hashes)
+	except RuntimeError as e:
+		print(str(e), file=sys.stderr)
+		exit(1)
+	finally:
+		out.flush()
+		if out is not sys.stdout:
+			out.close()
+	if 'hashlist_output' in settings:
+		print('Wrote %d hashes to %s' % (written, settings['hashlist_output']), file=sys.stderr)
 
 if __name__ == '__main__':
 	if len(sys.argv) != 2:
@@ -122,6 +256,10 @@ if __name__ == '__main__':
 		settings['max_height'] = 313000
 	if 'rev_hash_bytes' not in settings:
 		settings['rev_hash_bytes'] = 'false'
+	if 'rest' not in settings:
+		settings['rest'] = 'false'
+	if 'connections' not in settings:
+		settings['connections'] = 4
 	if 'rpcuser' not in settings or 'rpcpassword' not in settings:
 		print("Missing username and/or password in cfg file", file=stderr)
 		sys.exit(1)
@@ -129,6 +267,8 @@ if __name__ == '__main__':
 	settings['port'] = int(settings['port'])
 	settings['min_height'] = int(settings['min_height'])
 	settings['max_height'] = int(settings['max_height'])
+	settings['connections'] = int(settings['connections'])
+	settings['rest'] = settings['rest'].lower()
 
 	# Force hash byte format setting to be lowercase to make comparisons easier.
 	settings['rev_hash_bytes'] = settings['rev_hash_bytes'].lower()
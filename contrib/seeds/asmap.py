@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Elements Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+#
+# Offline IP -> ASN lookup from prefix-to-AS dumps, such as CAIDA's
+# RouteViews pfx2as files (routeviews-rv2-*.pfx2as for IPv4 and
+# routeviews-rv6-*.pfx2as for IPv6):
+#
+#   1.0.0.0	24	13335
+#   2001:200::	32	2500
+#
+# Prefixes go into a radix trie with 8-bit strides: each node maps the next
+# byte of the address to a child node and to the ASN of the longest prefix
+# ending within that byte.  Prefixes that don't end on a byte boundary are
+# expanded to every byte value they cover, so a lookup is at most 4 (IPv4)
+# or 16 (IPv6) dict lookups.
+#
+
+import ipaddress
+import socket
+
+STRIDE = 8
+
+class _Node(object):
+    __slots__ = ('asns', 'children')
+
+    def __init__(self):
+        self.asns = {}      # byte -> ASN of the longest prefix ending in this stride
+        self.children = {}  # byte -> _Node
+
+class RadixTrie(object):
+    '''Longest-prefix match from fixed-width integer addresses to ASNs'''
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.root = _Node()
+        self.size = 0
+
+    def insert(self, prefix, length, asn):
+        '''Add prefix/length -> asn.
+
+        A prefix overrides any shorter one covering the same addresses only if
+        it is inserted after it; load() inserts in order of increasing length.
+        '''
+        node = self.root
+        shift = self.bits
+        # Walk down the whole strides of the prefix
+        while length > STRIDE:
+            shift -= STRIDE
+            byte = (prefix >> shift) & 0xff
+            child = node.children.get(byte)
+            if child is None:
+                child = node.children[byte] = _Node()
+            node = child
+            length -= STRIDE
+        # Expand the rest over every byte value it covers
+        shift -= STRIDE
+        first = (prefix >> shift) & 0xff & ~((1 << (STRIDE - length)) - 1)
+        for byte in range(first, first + (1 << (STRIDE - length))):
+            node.asns[byte] = asn
+        self.size += 1
+
+    def lookup(self, addr):
+        '''ASN for the integer address addr, or None'''
+        node = self.root
+        shift = self.bits
+        asn = None
+        while node is not None:
+            shift -= STRIDE
+            byte = (addr >> shift) & 0xff
+            found = node.asns.get(byte)
+            if found is not None:
+                asn = found
+            node = node.children.get(byte)
+        return asn
+
+def parse_address(addr):
+    '''(4 or 6, integer address) for an IP string'''
+    if ':' in addr:
+        return (6, int.from_bytes(socket.inet_pton(socket.AF_INET6, addr), 'big'))
+    return (4, int.from_bytes(socket.inet_aton(addr), 'big'))
+
+class ASMap(object):
+    '''IP -> ASN for IPv4 and IPv6, from one or more pfx2as files'''
+
+    def __init__(self):
+        self.tries = {4: RadixTrie(32), 6: RadixTrie(128)}
+
+    def load(self, path):
+        '''Add the prefixes in a pfx2as file; returns how many were read.
+
+        Multi-origin (13335_209) and AS-set (13335,209) entries map to their
+        first ASN.  Lines may also be written as "prefix/length asn".
+        '''
+        entries = []
+        with open(path, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if not fields or fields[0].startswith('#'):
+                    continue
+                if '/' in fields[0]:
+                    (addr, length) = fields[0].split('/')
+                    asn = fields[1]
+                else:
+                    (addr, length, asn) = fields[:3]
+                (version, prefix) = parse_address(addr)
+                asn = int(asn.replace(',', '_').split('_')[0])
+                entries.append((int(length), version, prefix, asn))
+        # Shorter prefixes first, so longer ones override them
+        entries.sort(key=lambda e: e[0])
+        for (length, version, prefix, asn) in entries:
+            if length == 0:
+                continue
+            self.tries[version].insert(prefix, length, asn)
+        return len(entries)
+
+    def lookup(self, ip):
+        '''ASN for an address (string or ipaddress object), or None'''
+        if isinstance(ip, (ipaddress.IPv4Address, ipaddress.IPv6Address)):
+            return self.tries[ip.version].lookup(int(ip))
+        (version, addr) = parse_address(ip)
+        return self.tries[version].lookup(addr)
+
+    def __len__(self):
+        return self.tries[4].size + self.tries[6].size
@@ -22,10 +22,16 @@ SUSPICIOUS_HOSTS = {
     "54.94.195.96", "54.94.200.247"
 }
 
+import argparse
+import collections
+import ipaddress
+import json
+import os
 import re
 import sys
-import dns.resolver
-import collections
+from multiprocessing.pool import ThreadPool
+
+from asmap import ASMap
 
 PATTERN_IPV4 = re.compile(r"^((\d{1,3})\.(\d{1,3})\.(\d{1,3})\.(\d{1,3})):(\d+)$")
 PATTERN_IPV6 = re.compile(r"^\[([0-9a-z:]+)\]:(\d+)$")
@@ -106,38 +112,169 @@ def filtermultiport(ips):
         hist[ip['sortkey']].append(ip)
     return [value[0] for (key,value) in list(hist.items()) if len(value)==1]
 
+def dns_lookup_asn(net, ipstr):
+    '''Look up the origin ASN of an IP with Team Cymru's DNS service'''
+    # Only needed when some address isn't covered by the asmap
+    import dns.resolver
+    if net == 'ipv4':
+        query = '.'.join(reversed(ipstr.split('.'))) + '.origin.asn.cymru.com'
+    else:
+        nibbles = ipaddress.IPv6Address(ipstr).exploded.replace(':', '')
+        query = '.'.join(reversed(nibbles)) + '.origin6.asn.cymru.com'
+    answer = dns.resolver.query(query, 'TXT').response.answer
+    return int([x.to_text() for x in answer][0].split('\"')[1].split(' ')[0])
+
+class ASNLookup(object):
+    '''IP -> ASN from an asmap, falling back to DNS lookups
+
+    DNS answers are cached per /24 (IPv4) or /48 (IPv6), the longest prefixes
+    that are routed globally, and can be kept in cache_file between runs
+    (failed lookups are retried next time).  prefetch() resolves a batch of
+    addresses on a pool of up to threads concurrent queries.
+
+    resolver(net, ipstr) returns the ASN or raises; it defaults to
+    dns_lookup_asn but can be replaced, eg by a local stub.
+    '''
+    def __init__(self, asmap=None, use_dns=True, resolver=dns_lookup_asn, threads=1, cache_file=None):
+        self.asmap = asmap
+        self.use_dns = use_dns
+        self.resolver = resolver
+        self.threads = threads
+        self.cache_file = cache_file
+        self.cache = {}
+        self.pool = None
+        if cache_file is not None and os.path.exists(cache_file):
+            with open(cache_file, 'r') as f:
+                self.cache = json.load(f)
+
+    def save(self):
+        if self.cache_file is None:
+            return
+        tmp = self.cache_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({k: v for (k, v) in self.cache.items() if v is not None}, f, indent=0, sort_keys=True)
+        os.rename(tmp, self.cache_file)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.save()
+
+    def _prefix(self, ip):
+        if ip['net'] == 'ipv4':
+            return '%s/24' % ipaddress.IPv4Address(ip['ipnum'] & ~0xff)
+        return '%s/48' % ipaddress.IPv6Address(int(ipaddress.IPv6Address(ip['ip'])) >> 80 << 80)
+
+    def _asmap_lookup(self, ip):
+        if self.asmap is None:
+            return None
+        return self.asmap.lookup(ip['ip'])
+
+    def _resolve(self, ip):
+        try:
+            return self.resolver(ip['net'], ip['ip'])
+        except Exception:
+            return None
+
+    def prefetch(self, ips):
+        '''Resolve the uncached prefixes of ips concurrently'''
+        if not self.use_dns:
+            return
+        wanted = collections.OrderedDict()
+        for ip in ips:
+            if self._asmap_lookup(ip) is not None:
+                continue
+            key = self._prefix(ip)
+            if key not in self.cache and key not in wanted:
+                wanted[key] = ip
+        if not wanted:
+            return
+        if self.threads > 1 and len(wanted) > 1:
+            if self.pool is None:
+                self.pool = ThreadPool(self.threads)
+            results = self.pool.map(self._resolve, wanted.values())
+        else:
+            results = map(self._resolve, wanted.values())
+        for (key, asn) in zip(wanted, results):
+            self.cache[key] = asn
+
+    def lookup(self, ip):
+        '''ASN for a parsed entry, or None if it can't be found'''
+        asn = self._asmap_lookup(ip)
+        if asn is not None or not self.use_dns:
+            return asn
+        key = self._prefix(ip)
+        if key not in self.cache:
+            self.cache[key] = self._resolve(ip)
+        return self.cache[key]
+
 # Based on Greg Maxwell's seed_filter.py
-def filterbyasn(ips, max_per_asn, max_total):
+def filterbyasn(ips, max_per_asn, max_total, lookup=None):
+    if lookup is None:
+        lookup = ASNLookup()
     # Sift out ips by type
     ips_ipv4 = [ip for ip in ips if ip['net'] == 'ipv4']
     ips_ipv6 = [ip for ip in ips if ip['net'] == 'ipv6']
     ips_onion = [ip for ip in ips if ip['net'] == 'onion']
 
+    # Resolve a few batches' worth ahead of the filter, so that stopping at
+    # max_total wastes at most one window of lookups.  Which IPs are kept
+    # only depends on their order.
+    window = max(1, lookup.threads) * 4
+    def resolved(ips):
+        for i in range(0, len(ips), window):
+            batch = ips[i:i + window]
+            lookup.prefetch(batch)
+            for ip in batch:
+                yield ip
+
+    asn_count = collections.defaultdict(int)
+    def accept(ip):
+        asn = lookup.lookup(ip)
+        if asn is None:
+            sys.stderr.write('ERR: Could not resolve ASN for "' + ip['ip'] + '"\n')
+            return False
+        if asn_count[asn] == max_per_asn:
+            return False
+        asn_count[asn] += 1
+        return True
+
     # Filter IPv4 by ASN
     result = []
-    asn_count = {}
-    for ip in ips_ipv4:
+    for ip in resolved(ips_ipv4):
         if len(result) == max_total:
             break
-        try:
-            asn = int([x.to_text() for x in dns.resolver.query('.'.join(reversed(ip['ip'].split('.'))) + '.origin.asn.cymru.com', 'TXT').response.answer][0].split('\"')[1].split(' ')[0])
-            if asn not in asn_count:
-                asn_count[asn] = 0
-            if asn_count[asn] == max_per_asn:
-                continue
-            asn_count[asn] += 1
+        if accept(ip):
             result.append(ip)
-        except:
-            sys.stderr.write('ERR: Could not resolve ASN for "' + ip['ip'] + '"\n')
 
-    # TODO: filter IPv6 by ASN
+    # Filter IPv6 by ASN (not counted towards max_total, as before)
+    result.extend([ip for ip in resolved(ips_ipv6) if accept(ip)])
 
-    # Add back non-IPv4
-    result.extend(ips_ipv6)
+    # Add back onions
     result.extend(ips_onion)
     return result
 
 def main():
+    parser = argparse.ArgumentParser(description='Generate seeds.txt from DNS seeder output on stdin.')
+    parser.add_argument('-a', '--asmap', action='append', default=[], metavar='FILE',
+                        help='prefix-to-AS dump (pfx2as format) to look up ASNs in; may be repeated, eg for IPv4 and IPv6')
+    parser.add_argument('--no-dns', dest='dns', action='store_false',
+                        help='do not fall back to DNS for addresses missing from the asmap (they are dropped)')
+    parser.add_argument('-j', '--dns-threads', type=int, default=16, metavar='N',
+                        help='DNS lookups to run at once (default: %(default)s)')
+    parser.add_argument('--asn-cache', metavar='FILE',
+                        help='keep DNS lookup results in FILE between runs')
+    args = parser.parse_args()
+
+    asmap = None
+    if args.asmap:
+        asmap = ASMap()
+        for path in args.asmap:
+            count = asmap.load(path)
+            sys.stderr.write('Loaded %d prefixes from %s\n' % (count, path))
+
     lines = sys.stdin.readlines()
     ips = [parseline(line) for line in lines]
 
@@ -158,7 +295,11 @@ def main():
     # Filter out hosts with multiple bitcoin ports, these are likely abusive
     ips = filtermultiport(ips)
     # Look up ASNs and limit results, both per ASN and globally.
-    ips = filterbyasn(ips, MAX_SEEDS_PER_ASN, NSEEDS)
+    lookup = ASNLookup(asmap, args.dns, threads=args.dns_threads, cache_file=args.asn_cache)
+    try:
+        ips = filterbyasn(ips, MAX_SEEDS_PER_ASN, NSEEDS, lookup)
+    finally:
+        lookup.close()
     # Sort the results by IP address (for deterministic output).
     ips.sort(key=lambda x: (x['net'], x['sortkey']))
 
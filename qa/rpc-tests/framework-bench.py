@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Elements Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+#
+# framework-bench.py - offline micro-benchmarks for the python test framework
+#
+# These don't need a running node; they time the pure-python parts of
+# test_framework that the p2p and comparison tests lean on heavily.
+#
+# Usage: framework-bench.py [--quick] [benchmark ...]
+#
+
+import argparse
+import time
+
+from io import BytesIO
+
+from test_framework.blockstore import HeaderIndex
+from test_framework.blocktools import create_block, create_coinbase, get_legacy_sigopcount_block
+from test_framework.key import CECKey, OpenSSLECKey, Secp256k1ECKey
+from test_framework import confidential, secp256k1, siphash
+from test_framework.txfactory import TxFactory
+from test_framework.util import BITCOIN_ASSET
+from test_framework.mininode import CBitcoinBlockHeader, CBitcoinMerkleBlock, CBlock, CBlockHeader, CBlockLocator, \
+    COutPoint, CPartialMerkleTree, CTransaction, CTxIn, CTxOut, HeaderAndShortIDs, MerkleTree, \
+    PartiallyDownloadedBlock, bitcoin_txid, calculate_shortid, check_bitcoin_proof, check_pegin_proof, ser_uint256
+from test_framework.script import CScript, OP_2, OP_3, OP_CHECKMULTISIG, OP_CHECKSIG, OP_DUP, \
+    OP_EQUALVERIFY, OP_HASH160, OP_TRUE, PrecomputedTransactionData, SegwitVersion1SignatureHash, \
+    SignatureHash, SIGHASH_ALL, hash160
+
+BENCHMARKS = []
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+def report(name, count, elapsed, unit="ops"):
+    rate = count / elapsed if elapsed > 0 else float('inf')
+    print("  %-40s %8d %s in %8.3fs (%12.1f %s/s)" % (name, count, unit, elapsed, rate, unit))
+
+class Timer(object):
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed = time.perf_counter() - self.start
+
+def make_header_chain(length, prev=0):
+    headers = []
+    for i in range(length):
+        header = CBlockHeader()
+        header.hashPrevBlock = prev
+        header.nTime = i
+        header.nHeight = i + 1
+        header.calc_sha256()
+        headers.append(header)
+        prev = header.sha256
+    return headers
+
+@benchmark
+def header_index(args):
+    length = 10000 if args.quick else 100000
+    headers = make_header_chain(length)
+
+    index = HeaderIndex()
+    with Timer() as t:
+        for header in headers:
+            index.add(header)
+    report("index %d headers" % length, length, t.elapsed, "headers")
+
+    tip = headers[-1].sha256
+    rounds = 1000
+    with Timer() as t:
+        for i in range(rounds):
+            index.get_locator(tip)
+    report("get_locator", rounds, t.elapsed, "locators")
+
+    # Peer is 2000 blocks behind at various points along the chain
+    locator = CBlockLocator()
+    with Timer() as t:
+        for i in range(rounds):
+            locator.vHave = index.get_locator(headers[(i * 97) % (length - 2000)].sha256)
+            index.get_headers(tip, locator.vHave, 0)
+    report("getheaders response (2000 headers)", rounds, t.elapsed, "responses")
+
+@benchmark
+def sighash(args):
+    key = CECKey()
+    key.set_secretbytes(b"\x01" * 32)
+    key.set_compressed(True)
+    pubkey = key.get_pubkey()
+    script = CScript([OP_DUP, OP_HASH160, hash160(pubkey), OP_EQUALVERIFY, OP_CHECKSIG])
+
+    for num_inputs in ([100] if args.quick else [100, 500, 2000]):
+        tx = CTransaction()
+        for i in range(num_inputs):
+            tx.vin.append(CTxIn(COutPoint(i + 1, 0), b"", 0xffffffff))
+        tx.vout.append(CTxOut(1000, script))
+        tx.vout.append(CTxOut(2000, script))
+
+        # Without a shared cache every input reserializes the whole tx
+        if num_inputs <= 500:
+            with Timer() as t:
+                for i in range(num_inputs):
+                    SignatureHash(script, tx, i, SIGHASH_ALL)
+            report("legacy, uncached (%d inputs)" % num_inputs, num_inputs, t.elapsed, "inputs")
+
+        with Timer() as t:
+            cache = PrecomputedTransactionData(tx)
+            for i in range(num_inputs):
+                SignatureHash(script, tx, i, SIGHASH_ALL, cache)
+        report("legacy, cached (%d inputs)" % num_inputs, num_inputs, t.elapsed, "inputs")
+
+        with Timer() as t:
+            cache = PrecomputedTransactionData(tx)
+            for i in range(num_inputs):
+                SegwitVersion1SignatureHash(script, tx, i, SIGHASH_ALL, 1000, cache)
+        report("segwit v0, cached (%d inputs)" % num_inputs, num_inputs, t.elapsed, "inputs")
+
+        with Timer() as t:
+            cache = PrecomputedTransactionData(tx)
+            for i in range(num_inputs):
+                (sighash, err) = SignatureHash(script, tx, i, SIGHASH_ALL, cache)
+                tx.vin[i].scriptSig = CScript([key.sign(sighash) + bytes([SIGHASH_ALL]), pubkey])
+        report("sign all inputs (%d inputs)" % num_inputs, num_inputs, t.elapsed, "inputs")
+
+@benchmark
+def keys(args):
+    count = 500 if args.quick else 5000
+    hashes = [hash160(i.to_bytes(4, 'little')) + b"\x00" * 12 for i in range(count)]
+    backends = [("openssl", OpenSSLECKey)]
+    if secp256k1.lib is not None:
+        backends.append(("secp256k1", Secp256k1ECKey))
+    else:
+        print("  (libsecp256k1 not found, set SECP256K1_LIB to include it)")
+
+    for (name, cls) in backends:
+        key = cls()
+        key.set_secretbytes(b"\x01" * 32)
+        key.set_compressed(True)
+
+        with Timer() as t:
+            sigs = [key.sign(h) for h in hashes]
+        report("%s sign" % name, count, t.elapsed, "sigs")
+
+        with Timer() as t:
+            sigs = key.sign_many(hashes)
+        report("%s sign_many" % name, count, t.elapsed, "sigs")
+
+        with Timer() as t:
+            for (h, sig) in zip(hashes, sigs):
+                key.verify(h, sig)
+        report("%s verify" % name, count, t.elapsed, "sigs")
+
+        with Timer() as t:
+            assert all(key.verify_many(hashes, sigs))
+        report("%s verify_many" % name, count, t.elapsed, "sigs")
+
+@benchmark
+def blinding(args):
+    if not confidential.available():
+        print("  (libsecp256k1 with the CT modules not found, set SECP256K1_LIB)")
+        return
+    num_txs = 20 if args.quick else 200
+    asset = bytes(BITCOIN_ASSET)
+    blinding_key = CECKey()
+    blinding_key.set_secretbytes(b"\x02" * 32)
+    blinding_key.set_compressed(True)
+    blinding_pubkey = blinding_key.get_pubkey()
+    spent = CTxOut(2000, CScript([OP_TRUE]))
+
+    txs = []
+    with Timer() as t:
+        for i in range(num_txs):
+            tx = CTransaction()
+            tx.vin.append(CTxIn(COutPoint(i + 1, 0), b"", 0xffffffff))
+            tx.vout.append(CTxOut(1000, CScript([OP_TRUE])))
+            tx.vout.append(CTxOut(900, CScript([OP_TRUE])))
+            tx.vout.append(CTxOut(100, b""))
+            confidential.blind_transaction(tx, [2000], [asset], [confidential.ZERO_BLIND],
+                                           [confidential.ZERO_BLIND], [blinding_pubkey, blinding_pubkey])
+            txs.append(tx)
+    report("blind 2-output txs", num_txs * 2, t.elapsed, "outputs")
+
+    with Timer() as t:
+        for tx in txs:
+            assert confidential.verify_amounts([spent], tx)
+    report("verify amounts and proofs", num_txs * 2, t.elapsed, "outputs")
+
+    with Timer() as t:
+        for tx in txs:
+            assert confidential.unblind_output(tx.vout[0], tx.wit.vtxoutwit[0], blinding_key.secret) is not None
+    report("unblind (rewind rangeproof)", num_txs, t.elapsed, "outputs")
+
+@benchmark
+def txfactory(args):
+    count = 1000 if args.quick else 10000
+    factory = TxFactory()
+    funding = CTransaction()
+    funding.vout.append(CTxOut(10 ** 12, factory.new_key()))
+    factory.add_transaction(funding)
+
+    with Timer() as t:
+        factory.split(count, 10 ** 7)
+    report("fan out to %d outputs" % count, count, t.elapsed, "outputs")
+
+    with Timer() as t:
+        for txhex in factory.payments(count, 1000):
+            pass
+    report("signed 1-in 3-out payments", count, t.elapsed, "txs")
+    print("  %-40s %8.0f txs/minute" % ("", count / t.elapsed * 60))
+
+@benchmark
+def merkle(args):
+    num_txs = 1000 if args.quick else 5000
+    txs = []
+    for i in range(num_txs):
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(i + 1, 0), b"", 0xffffffff))
+        tx.rehash()
+        txs.append(tx)
+
+    # Root recomputed after every transaction, as update_block() does
+    block = create_block(0, create_coinbase(1), 0)
+    with Timer() as t:
+        for tx in txs:
+            block.vtx.append(tx)
+            block.hashMerkleRoot = block.calc_merkle_root()
+    report("build %d-tx block tx-by-tx" % num_txs, num_txs, t.elapsed, "txs")
+
+    # The same with append_tx(), and the witness root too, as
+    # add_witness_commitment() needs
+    block = create_block(0, create_coinbase(1), 0)
+    with Timer() as t:
+        for tx in txs:
+            block.append_tx(tx)
+            block.hashMerkleRoot = block.calc_merkle_root()
+            block.calc_witness_merkle_root()
+    report("... with append_tx and the witness root", num_txs, t.elapsed, "txs")
+
+    rounds = 1000
+    with Timer() as t:
+        for i in range(rounds):
+            block.vtx[0].nLockTime = i
+            block.vtx[0].rehash()
+            block.invalidate_merkle(0)
+            block.hashMerkleRoot = block.calc_merkle_root()
+    report("replace coinbase and recompute", rounds, t.elapsed, "roots")
+
+    full = num_txs // 10
+    hashes = [ser_uint256(tx.sha256) for tx in txs[:full]]
+    with Timer() as t:
+        for i in range(full):
+            block.get_merkle_root(hashes[:i + 1])
+    report("full rebuild per tx (%d-tx block)" % full, full, t.elapsed, "txs")
+
+@benchmark
+def pegin_proofs(args):
+    # A bitcoin regtest block with our transaction among num_txs others
+    num_txs = 2000
+    raw_tx = bytes.fromhex("01000000" "01" + "11" * 32 + "00000000" "00" "ffffffff" "01" "0100000000000000" "0151" "00000000")
+    txid = bitcoin_txid(raw_tx)
+    txids = [i + 1 for i in range(num_txs)] + [txid]
+    header = CBitcoinBlockHeader()
+    header.nBits = 0x207fffff
+    header.hashMerkleRoot = MerkleTree(txids).root()
+    while not check_bitcoin_proof(header.rehash(), header.nBits):
+        header.nNonce += 1
+
+    rounds = 10 if args.quick else 100
+    with Timer() as t:
+        for i in range(rounds):
+            proof = CBitcoinMerkleBlock(header, CPartialMerkleTree(txids, [h == txid for h in txids])).serialize()
+    report("build proof (%d-tx block)" % len(txids), rounds, t.elapsed, "proofs")
+
+    rounds = 1000 if args.quick else 10000
+    with Timer() as t:
+        for i in range(rounds):
+            check_pegin_proof(proof, raw_tx)
+    report("check_pegin_proof", rounds, t.elapsed, "proofs")
+
+@benchmark
+def shortids(args):
+    num_txs = 1000 if args.quick else 5000
+    block = create_block(0, create_coinbase(1), 0)
+    for i in range(num_txs):
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(i + 1, 0), b"", 0xffffffff))
+        tx.vout.append(CTxOut(1000, CScript([OP_TRUE])))
+        tx.rehash()
+        block.vtx.append(tx)
+    block.hashMerkleRoot = block.calc_merkle_root()
+    block.rehash()
+    tx_hashes = [tx.sha256 for tx in block.vtx]
+    (k0, k1) = (0x0706050403020100, 0x0f0e0d0c0b0a0908)
+
+    with Timer() as t:
+        for h in tx_hashes:
+            calculate_shortid(k0, k1, h)
+    report("calculate_shortid one by one", len(tx_hashes), t.elapsed, "ids")
+    with Timer() as t:
+        siphash.siphash256_batch(k0, k1, tx_hashes, use_numpy=False)
+    report("siphash256_batch, pure python", len(tx_hashes), t.elapsed, "ids")
+    if siphash.numpy is not None:
+        with Timer() as t:
+            siphash.siphash256_batch(k0, k1, tx_hashes, use_numpy=True)
+        report("siphash256_batch, numpy", len(tx_hashes), t.elapsed, "ids")
+    else:
+        print("  (numpy not installed, skipping vectorized batch)")
+
+    with Timer() as t:
+        cmpct = HeaderAndShortIDs()
+        cmpct.initialize_from_block(block)
+    report("HeaderAndShortIDs (%d txs)" % len(block.vtx), len(block.vtx), t.elapsed, "txs")
+
+    # Mempool with 90% of the block plus as many unrelated transactions
+    mempool = [tx for (i, tx) in enumerate(block.vtx[1:]) if i % 10]
+    for i in range(num_txs):
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(num_txs + i + 1, 0), b"", 0xffffffff))
+        tx.rehash()
+        mempool.append(tx)
+    with Timer() as t:
+        partial = PartiallyDownloadedBlock()
+        partial.init_data(cmpct, mempool)
+        missing = partial.get_missing()
+        filled = partial.fill_block([block.vtx[i] for i in missing])
+    assert filled is not None and filled.sha256 == block.sha256
+    report("reconstruct from %d-tx mempool" % len(mempool), len(block.vtx), t.elapsed, "txs")
+
+@benchmark
+def sigops(args):
+    num_txs = 500 if args.quick else 3000
+    p2pkh = CScript([OP_DUP, OP_HASH160, b"\x11" * 20, OP_EQUALVERIFY, OP_CHECKSIG])
+    multisig = CScript([OP_2, b"\x02" * 33, b"\x03" * 33, b"\x02" * 33, OP_3, OP_CHECKMULTISIG])
+    block = create_block(0, create_coinbase(1), 0)
+    for i in range(num_txs):
+        tx = CTransaction()
+        for j in range(2):
+            tx.vin.append(CTxIn(COutPoint(i + 1, j), CScript([b"\x30" * 72, b"\x02" * 33]), 0xffffffff))
+        tx.vout.append(CTxOut(1000, p2pkh))
+        tx.vout.append(CTxOut(1000, multisig if i % 10 == 0 else p2pkh))
+        block.vtx.append(tx)
+
+    # Scripts as they come off the wire are plain bytes
+    wire_block = CBlock()
+    wire_block.deserialize(BytesIO(block.serialize()))
+    num_scripts = sum(len(tx.vin) + len(tx.vout) for tx in block.vtx)
+
+    with Timer() as t:
+        get_legacy_sigopcount_block(wire_block)
+    report("deserialized block (%d txs)" % len(block.vtx), num_scripts, t.elapsed, "scripts")
+
+    with Timer() as t:
+        get_legacy_sigopcount_block(block)
+    report("first count (%d txs)" % len(block.vtx), num_scripts, t.elapsed, "scripts")
+
+    rounds = 5
+    with Timer() as t:
+        for i in range(rounds):
+            get_legacy_sigopcount_block(block)
+    report("recount, decoded opcodes cached", num_scripts * rounds, t.elapsed, "scripts")
+
+    with Timer() as t:
+        for i in range(rounds):
+            for tx in block.vtx:
+                for txout in tx.vout:
+                    list(txout.scriptPubKey.raw_iter())
+    report("raw_iter over scriptPubKeys", rounds * num_scripts // 2, t.elapsed, "scripts")
+
+def main():
+    names = [f.__name__ for f in BENCHMARKS]
+    parser = argparse.ArgumentParser(description="Benchmark the python test framework.")
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark",
+                        help="benchmarks to run (default: all of %s)" % ", ".join(names))
+    parser.add_argument("--quick", action="store_true",
+                        help="use smaller workloads")
+    args = parser.parse_args()
+
+    for name in args.benchmarks:
+        if name not in names:
+            parser.error("unknown benchmark %s" % name)
+    for func in BENCHMARKS:
+        if args.benchmarks and func.__name__ not in args.benchmarks:
+            continue
+        print("%s:" % func.__name__)
+        func(args)
+
+if __name__ == '__main__':
+    main()
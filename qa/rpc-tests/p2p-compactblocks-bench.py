@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Elements Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+#
+# p2p-compactblocks-bench.py - measure BIP 152 compact block relay from elementsd
+#
+# A CompactBlockPeer (test_framework/compactblocks.py) connects to the node.
+# For every scenario (announcement mode x block size x mempool overlap) we
+# put block-size transactions into the node's mempool, copy the chosen
+# fraction of them into the peer's mempool mirror, mine a block and time how
+# long it takes the peer to have the whole block, reconstructing from the
+# mirror and fetching the rest with getblocktxn.
+#
+# Not part of the regression suite (not listed in rpc-tests.py).  Example:
+#
+#   p2p-compactblocks-bench.py --txs=100,1000 --overlap=1,0.9,0.5,0 --blocks=5
+#
+
+import json
+import random
+import time
+
+from test_framework.compactblocks import CompactBlockPeer
+from test_framework.mininode import CTransaction, FromHex, NODE_NETWORK, NODE_WITNESS, NetworkThread, NodeConn
+from test_framework.test_framework import BitcoinTestFramework
+from test_framework.txfactory import TxFactory, asset_from_hex
+from test_framework.util import assert_equal, p2p_port, start_nodes
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+class CompactBlocksBench(BitcoinTestFramework):
+    def __init__(self):
+        super().__init__()
+        self.num_nodes = 1
+        self.setup_clean_chain = True
+
+    def add_options(self, parser):
+        parser.add_option("--txs", dest="txs", default="10,100,1000",
+                          help="comma separated transactions per block (default: %default)")
+        parser.add_option("--overlap", dest="overlap", default="1,0.9,0.5,0",
+                          help="comma separated shares of each block already in our mempool (default: %default)")
+        parser.add_option("--blocks", dest="blocks", default=3, type="int",
+                          help="blocks to time per scenario (default: %default)")
+        parser.add_option("--mode", dest="mode", default="both", choices=["high", "low", "both"],
+                          help="sendcmpct announcement mode: high, low or both (default: %default)")
+        parser.add_option("--cmpctversion", dest="cmpctversion", default=1, type="int",
+                          help="compact block version to negotiate, 1 (txids) or 2 (wtxids) (default: %default)")
+        parser.add_option("--seed", dest="seed", default=0, type="int",
+                          help="random seed for picking the overlapping transactions (default: %default)")
+        parser.add_option("--json", dest="json", default=None,
+                          help="also write the results to this file as JSON")
+
+    def setup_network(self):
+        self.nodes = start_nodes(self.num_nodes, self.options.tmpdir)
+
+    def make_utxos(self, count):
+        node = self.nodes[0]
+        node.generate(101)
+        self.factory = TxFactory(asset=asset_from_hex(node.dumpassetlabels()["bitcoin"]))
+        # Block transactions pay the node, so our UTXOs only ever shrink by
+        # payment plus fee
+        self.dest = node.validateaddress(node.getnewaddress())["unconfidential"]
+
+        # Coin selection is FIFO, so fund each fan-out transaction from its
+        # own wallet output rather than from the previous one's outputs
+        per_split = 500
+        splits = (count + per_split - 1) // per_split
+        for i in range(splits):
+            txid = node.sendtoaddress(self.factory.get_new_address(), 10, "", "", False, "bitcoin", True)
+            self.factory.add_transaction(node.getrawtransaction(txid))
+        while len(self.factory.scripts) < 100:
+            self.factory.new_key()
+        node.generate(1)
+        for i in range(splits):
+            outputs = [(self.factory.scripts[j % len(self.factory.scripts)], 10 ** 6) for j in range(per_split)]
+            split = self.factory.create_transaction(outputs, fee=100000)
+            node.sendrawtransaction(split.serialize().hex(), True, True)
+        node.generate(1)
+
+    def run_scenario(self, high_bandwidth, num_txs, overlap):
+        node = self.nodes[0]
+        peer = self.peer
+        peer.set_high_bandwidth(high_bandwidth)
+        rounds = []
+        for i in range(self.options.blocks):
+            txs = []
+            for txhex in self.factory.payments(num_txs, 10000, self.dest):
+                node.sendrawtransaction(txhex, True, True)
+                txs.append(FromHex(CTransaction(), txhex))
+            peer.add_to_mempool([tx for tx in txs if self.rng.random() < overlap])
+            assert_equal(node.getmempoolinfo()["size"], num_txs)
+
+            start = time.time()
+            blockhash = int(node.generate(1)[0], 16)
+            record = peer.wait_for_block(blockhash)
+            assert not record.failed
+            assert_equal(record.num_txs, num_txs + 1)
+            rounds.append({
+                "latency": record.completed - start,
+                "reconstruction": record.reconstruction_time(),
+                "hit_rate": record.hit_rate(),
+                "requested": record.requested,
+                "full_block": record.full_block,
+            })
+
+        latencies = [r["latency"] for r in rounds]
+        result = {
+            "mode": "high" if high_bandwidth else "low",
+            "txs": num_txs,
+            "overlap": overlap,
+            "blocks": len(rounds),
+            "hit_rate": sum(r["hit_rate"] for r in rounds) / len(rounds),
+            "getblocktxn_rounds": sum(1 for r in rounds if r["requested"]),
+            "full_blocks": sum(1 for r in rounds if r["full_block"]),
+            "latency_mean": sum(latencies) / len(latencies),
+            "latency_p50": percentile(latencies, 50),
+            "latency_max": max(latencies),
+            "reconstruction_mean": sum(r["reconstruction"] for r in rounds) / len(rounds),
+            "rounds": rounds,
+        }
+        print("%-4s %6d txs overlap %4.2f: hit rate %5.1f%%, getblocktxn %d/%d, latency mean %7.1fms p50 %7.1fms max %7.1fms" %
+              (result["mode"], num_txs, overlap, result["hit_rate"] * 100, result["getblocktxn_rounds"], len(rounds),
+               result["latency_mean"] * 1000, result["latency_p50"] * 1000, result["latency_max"] * 1000))
+        return result
+
+    def run_test(self):
+        block_sizes = [int(x) for x in self.options.txs.split(",")]
+        overlaps = [float(x) for x in self.options.overlap.split(",")]
+        modes = {"high": [True], "low": [False], "both": [True, False]}[self.options.mode]
+        self.rng = random.Random(self.options.seed)
+
+        services = NODE_NETWORK | (NODE_WITNESS if self.options.cmpctversion == 2 else 0)
+        self.peer = CompactBlockPeer(version=self.options.cmpctversion)
+        self.peer.add_connection(NodeConn('127.0.0.1', p2p_port(0), self.nodes[0], self.peer, services=services))
+        NetworkThread().start()
+        self.peer.wait_for_verack()
+
+        print("Creating UTXOs...")
+        self.make_utxos(max(block_sizes) * 2)
+
+        results = []
+        for high_bandwidth in modes:
+            for num_txs in block_sizes:
+                for overlap in overlaps:
+                    results.append(self.run_scenario(high_bandwidth, num_txs, overlap))
+
+        if self.options.json:
+            with open(self.options.json, "w", encoding="utf8") as f:
+                json.dump(results, f, indent=1)
+
+if __name__ == '__main__':
+    CompactBlocksBench().main()
@@ -29,11 +29,26 @@ def byte_to_base58(b, version):
         str = str[2:]
     return result
 
-# TODO: def base58_decode
+def base58_to_byte(s):
+    """Decode a base58check string into (payload, version)"""
+    value = 0
+    for c in s:
+        value = value * 58 + chars.index(c)
+    n_pad = len(s) - len(s.lstrip(chars[0]))
+    data = b'\x00' * n_pad + value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    if len(data) < 5 or hash256(data[:-4])[:4] != data[-4:]:
+        raise ValueError('invalid base58check string %s' % s)
+    return (data[1:-4], data[0])
 
-def keyhash_to_p2pkh(hash, main = False):
+# Elements regtest and "elements" chain prefixes (see chainparams.cpp)
+ELEMENTS_PUBKEY_ADDRESS = 235
+ELEMENTS_SCRIPT_ADDRESS = 75
+ELEMENTS_SECRET_KEY = 239
+
+def keyhash_to_p2pkh(hash, main = False, version = None):
     assert (len(hash) == 20)
-    version = 0 if main else 111
+    if version is None:
+        version = 0 if main else 111
     return byte_to_base58(hash, version)
 
 def scripthash_to_p2sh(hash, main = False):
@@ -41,9 +56,9 @@ def scripthash_to_p2sh(hash, main = False):
     version = 5 if main else 196
     return byte_to_base58(hash, version)
 
-def key_to_p2pkh(key, main = False):
+def key_to_p2pkh(key, main = False, version = None):
     key = check_key(key)
-    return keyhash_to_p2pkh(hash160(key), main)
+    return keyhash_to_p2pkh(hash160(key), main, version)
 
 def script_to_p2sh(script, main = False):
     script = check_script(script)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Elements Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+#
+# blocksigner.py - sign blocks for a -signblockscript chain in python
+#
+# Making a block on a signed-block chain through RPC takes four calls
+# (getnewblockhex, signblock, combineblocksigs, submitblock), and each
+# signblock makes the node look for the keys in its wallet.  BlockSigner
+# holds the federation's keys itself: the block hash is all that is signed
+# (a raw DER signature, no sighash byte), and for an m-of-n CHECKMULTISIG
+# challenge the solution is OP_0 followed by m signatures in pubkey order.
+#
+# BlockProducer uses it to make blocks with two calls (getnewblockhex and
+# submitblock), or, for a run of blocks, to build the whole chain from a
+# single template and submit it in bulk, by submitblock or over P2P:
+#
+#   producer = BlockProducer(node, [node.dumpprivkey(address)])
+#   producer.generate(1)
+#   producer.generate_chain(101, p2p=("127.0.0.1", p2p_port(0)))
+#
+# Blocks built ahead of the tip have coinbase-only bodies, as a node with an
+# empty mempool would make them.
+#
+
+import time
+
+from io import BytesIO
+
+from .address import base58_to_byte
+from .blocktools import WITNESS_COMMITMENT_HEADER, add_witness_commitment
+from .key import CECKey
+from .mininode import CBlock, COutPoint, CTransaction, CTxIn, CTxOut, CTxOutValue, \
+    NetworkThread, NodeConn, SingleNodeConnCB, ToHex, msg_block, ser_uint256, wait_until
+from .script import CScript, OP_0, OP_CHECKMULTISIG, OP_RETURN, OP_TRUE
+from .util import hex_str_to_bytes
+
+def parse_challenge(challenge):
+    """(m, [pubkeys]) for a bare m-of-n CHECKMULTISIG challenge, (0, []) for OP_TRUE"""
+    if bytes(challenge) == bytes(CScript([OP_TRUE])):
+        return (0, [])
+    # Iterating a script gives small number pushes as ints
+    ops = list(CScript(challenge))
+    if len(ops) < 4 or ops[-1] != OP_CHECKMULTISIG or type(ops[0]) is not int or type(ops[-2]) is not int:
+        raise ValueError("unsupported block signing script %s" % bytes(challenge).hex())
+    (required, pubkeys, total) = (ops[0], ops[1:-2], ops[-2])
+    if total != len(pubkeys) or not 0 < required <= total or not all(isinstance(pubkey, bytes) for pubkey in pubkeys):
+        raise ValueError("unsupported block signing script %s" % bytes(challenge).hex())
+    return (required, pubkeys)
+
+def key_from_wif(wif):
+    """CECKey for a private key as dumpprivkey returns it"""
+    (payload, version) = base58_to_byte(wif)
+    if len(payload) == 33 and payload[32] == 1:
+        (secret, compressed) = (payload[:32], True)
+    elif len(payload) == 32:
+        (secret, compressed) = (payload, False)
+    else:
+        raise ValueError("invalid private key %s" % wif)
+    key = CECKey()
+    key.set_secretbytes(secret)
+    key.set_compressed(compressed)
+    return key
+
+def block_from_hex(block_hex):
+    block = CBlock()
+    block.deserialize(BytesIO(hex_str_to_bytes(block_hex)))
+    block.rehash()
+    return block
+
+class BlockSigner(object):
+    """Solutions for one block signing script, from keys held here
+
+    keys are CECKeys or WIF strings; those not in the script are ignored,
+    and there must be at least as many of the rest as it requires.
+    """
+
+    def __init__(self, challenge, keys=()):
+        self.challenge = bytes(challenge)
+        (self.required, self.pubkeys) = parse_challenge(self.challenge)
+        held = {}
+        for key in keys:
+            if isinstance(key, str):
+                key = key_from_wif(key)
+            held[bytes(key.get_pubkey())] = key
+        # The first m of our keys, in the script's order
+        self.keys = [held[pubkey] for pubkey in self.pubkeys if pubkey in held][:self.required]
+        if len(self.keys) < self.required:
+            raise ValueError("have %d of the %d keys needed to sign blocks" % (len(self.keys), self.required))
+
+    def sign(self, block):
+        """Fill in block.proof.solution, returning the block"""
+        return self.sign_many([block])[0]
+
+    def sign_many(self, blocks):
+        # Batched per key, as the signatures of one key can be made in one call
+        for block in blocks:
+            if bytes(block.proof.challenge) != self.challenge:
+                raise ValueError("block %d has challenge %s, not ours" % (block.nHeight, bytes(block.proof.challenge).hex()))
+            block.rehash()
+        hashes = [ser_uint256(block.sha256) for block in blocks]
+        sigs = [key.sign_many(hashes) for key in self.keys]
+        for (i, block) in enumerate(blocks):
+            if self.required == 0:
+                block.proof.solution = b""
+            else:
+                block.proof.solution = bytes(CScript([OP_0] + [key_sigs[i] for key_sigs in sigs]))
+        return blocks
+
+class BlockProducer(object):
+    """Makes signed blocks on one node, signing them locally
+
+    The signer is made from the challenge of the first template, unless one
+    is given.
+    """
+
+    def __init__(self, rpc, keys=(), signer=None):
+        self.rpc = rpc
+        self.keys = keys
+        self.signer = signer
+
+    def template(self):
+        block = block_from_hex(self.rpc.getnewblockhex())
+        if self.signer is None:
+            self.signer = BlockSigner(block.proof.challenge, self.keys)
+        return block
+
+    def submit(self, block):
+        result = self.rpc.submitblock(ToHex(block))
+        if result is not None:
+            raise AssertionError("block %d (%s) rejected: %s" % (block.nHeight, block.hash, result))
+
+    def generate(self, n):
+        """Make n blocks one at a time, each with the node's choice of transactions; returns their hashes"""
+        hashes = []
+        for i in range(n):
+            block = self.template()
+            self.signer.sign(block)
+            self.submit(block)
+            hashes.append(block.hash)
+        return hashes
+
+    def build_chain(self, n):
+        """n signed blocks on top of the current tip, from a single template"""
+        blocks = [self.template()]
+        # The template's coinbase may take the fees of its transactions; ours have none
+        coinbase = blocks[0].vtx[0]
+        commitment = any(bytes(txout.scriptPubKey)[2:6] == WITNESS_COMMITMENT_HEADER for txout in coinbase.vout)
+        for i in range(1, n):
+            prev = blocks[-1]
+            block = CBlock()
+            block.nVersion = prev.nVersion
+            block.hashPrevBlock = prev.sha256
+            block.nTime = max(prev.nTime + 1, int(time.time()))
+            block.nHeight = prev.nHeight + 1
+            block.proof.challenge = prev.proof.challenge
+            block.vtx.append(self.coinbase(block.nHeight, coinbase))
+            if commitment:
+                add_witness_commitment(block)
+            block.hashMerkleRoot = block.calc_merkle_root()
+            block.rehash()
+            blocks.append(block)
+        return self.signer.sign_many(blocks)
+
+    def coinbase(self, height, template):
+        # As CreateNewBlock makes it when there are no fees
+        tx = CTransaction()
+        tx.nVersion = template.nVersion
+        tx.vin.append(CTxIn(COutPoint(0, 0xffffffff), CScript([height, OP_0]), 0xffffffff))
+        tx.vout.append(CTxOut(CTxOutValue(0), CScript([OP_RETURN]), template.vout[0].nAsset))
+        tx.calc_sha256()
+        return tx
+
+    def generate_chain(self, n, p2p=None, net="regtest", timeout=60):
+        """Build n blocks and submit them, by submitblock or, if p2p is
+        (host, port), in one go over a P2P connection; returns their hashes"""
+        blocks = self.build_chain(n)
+        if p2p is None:
+            for block in blocks:
+                self.submit(block)
+        else:
+            send_blocks(blocks, p2p[0], p2p[1], net, timeout)
+            tip = self.rpc.getbestblockhash()
+            if tip != blocks[-1].hash:
+                raise AssertionError("tip is %s after sending blocks up to %s" % (tip, blocks[-1].hash))
+        return [block.hash for block in blocks]
+
+def send_blocks(blocks, host, port, net="regtest", timeout=60):
+    """Send blocks, in order, to the node at host:port and wait until it has processed them
+
+    The node takes unrequested blocks that extend its best chain, so no
+    headers or inv round trips are needed.  This runs its own NetworkThread,
+    so there must be no other mininode connections open.
+    """
+    callback = SingleNodeConnCB()
+    conn = NodeConn(host, port, None, callback, net=net)
+    callback.add_connection(conn)
+    thread = NetworkThread()
+    thread.start()
+    try:
+        if not wait_until(lambda: callback.verack_received, timeout=timeout):
+            raise AssertionError("no P2P connection to %s:%d" % (host, port))
+        for block in blocks:
+            callback.send_message(msg_block(block))
+        # Messages are handled in order, so once the ping is answered the blocks are in
+        if not callback.sync_with_ping(timeout):
+            raise AssertionError("no pong from %s:%d after sending %d blocks" % (host, port, len(blocks)))
+    finally:
+        conn.disconnect_node()
+        thread.join()
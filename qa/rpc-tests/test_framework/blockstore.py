@@ -11,11 +11,163 @@ from .mininode import *
 from io import BytesIO
 import dbm.dumb as dbmd
 
+# Skiplist helpers, mirroring GetSkipHeight() in chain.cpp.
+# Turn the lowest '1' bit in the binary representation of a number into a '0'.
+def invert_lowest_one(n):
+    return n & (n - 1)
+
+# Compute what height to jump back to with the skip pointer.
+def get_skip_height(height):
+    if height < 2:
+        return 0
+    # Determine which height to jump back to. Any number strictly lower than
+    # height is acceptable, but the following expression seems to perform
+    # well in simulations (max 110 steps to go back up to 2**18 blocks).
+    if height & 1:
+        return invert_lowest_one(invert_lowest_one(height - 1)) + 1
+    return invert_lowest_one(height)
+
+# BlockIndex: the python analogue of CBlockIndex.  Heights are relative to
+# the first header of the chain that we know about (which is usually not the
+# genesis block, since the node under test already has that).
+class BlockIndex(object):
+    __slots__ = ("header", "sha256", "height", "pprev", "pskip")
+
+    def __init__(self, header, pprev=None):
+        self.header = header
+        self.sha256 = header.sha256
+        self.set_parent(pprev)
+
+    def set_parent(self, pprev):
+        self.pprev = pprev
+        self.pskip = None
+        if pprev is None:
+            self.height = 0
+        else:
+            self.height = pprev.height + 1
+            self.pskip = pprev.get_ancestor(get_skip_height(self.height))
+
+    def get_ancestor(self, height):
+        if height > self.height or height < 0:
+            return None
+        index_walk = self
+        height_walk = self.height
+        while height_walk > height:
+            height_skip = get_skip_height(height_walk)
+            height_skip_prev = get_skip_height(height_walk - 1)
+            if index_walk.pskip is not None and \
+                    (height_skip == height or
+                     (height_skip > height and not (height_skip_prev < height_skip - 2 and
+                                                    height_skip_prev >= height))):
+                # Only follow pskip if pprev->pskip isn't better than pskip->pprev.
+                index_walk = index_walk.pskip
+                height_walk = height_skip
+            else:
+                index_walk = index_walk.pprev
+                height_walk -= 1
+        return index_walk
+
+    def __repr__(self):
+        return "BlockIndex(sha256=%064x height=%d)" % (self.sha256, self.height)
+
+# HeaderIndex: keeps a BlockIndex for every header we have seen, so that
+# locators and getheaders responses can be computed without touching the
+# block database.  Headers may be added before their parent; they are
+# re-linked (along with their descendants) once the parent shows up.
+class HeaderIndex(object):
+    def __init__(self):
+        self.index = dict()
+        # prevhash -> [BlockIndex] for entries whose parent we haven't seen
+        self.unlinked = dict()
+
+    def __contains__(self, blockhash):
+        return blockhash in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, blockhash):
+        return self.index.get(blockhash)
+
+    def add(self, header):
+        entry = self.index.get(header.sha256)
+        if entry is not None:
+            entry.header = header
+            return entry
+        pprev = self.index.get(header.hashPrevBlock)
+        entry = BlockIndex(header, pprev)
+        self.index[header.sha256] = entry
+        if pprev is None:
+            self.unlinked.setdefault(header.hashPrevBlock, []).append(entry)
+        self._link_children(entry)
+        return entry
+
+    # Attach any entries waiting on this one, recomputing heights and skip
+    # pointers for their whole subtree (parents before children).
+    def _link_children(self, entry):
+        children = self.unlinked.pop(entry.sha256, None)
+        if children is None:
+            return
+        # This only happens when headers arrive out of order, which is rare,
+        # so just build the child map on demand.
+        descendants = dict()
+        for x in self.index.values():
+            if x.pprev is not None:
+                descendants.setdefault(x.pprev.sha256, []).append(x)
+        pending = [(child, entry) for child in children]
+        while pending:
+            child, parent = pending.pop()
+            child.set_parent(parent)
+            pending.extend((x, child) for x in descendants.get(child.sha256, []))
+
+    # Mirrors the historical BlockStore.get_locator() behaviour: the locator
+    # starts at the parent of the tip, steps back one block at a time for
+    # the first 11 entries and then doubles the step size.  The parent of
+    # the earliest known header (usually the node's genesis) terminates it.
+    def get_locator(self, tip_hash):
+        entry = self.index.get(tip_hash)
+        r = []
+        step = 1
+        while entry is not None:
+            r.append(entry.header.hashPrevBlock)
+            height = entry.height - step
+            if height < 0:
+                break
+            entry = entry.get_ancestor(height)
+            if len(r) > 10:
+                step *= 2
+        return r
+
+    # Return the headers from the most recent ancestor of tip_hash that is
+    # in vhave (or the earliest known ancestor, if none are), up to
+    # maxheaders headers and stopping at hash_stop.
+    def get_headers(self, tip_hash, vhave, hash_stop, maxheaders=2000):
+        tip = self.index.get(tip_hash)
+        if tip is None:
+            return None
+        start_height = 0
+        for h in vhave:
+            entry = self.index.get(h)
+            if entry is not None and entry.height > start_height and \
+                    tip.get_ancestor(entry.height) is entry:
+                start_height = entry.height
+        end_height = min(tip.height, start_height + maxheaders - 1)
+        entry = tip.get_ancestor(end_height)
+        headers = [None] * (end_height - start_height + 1)
+        for i in range(len(headers) - 1, -1, -1):
+            headers[i] = entry.header
+            entry = entry.pprev
+        stop = self.index.get(hash_stop)
+        if stop is not None and start_height <= stop.height <= end_height and \
+                tip.get_ancestor(stop.height) is stop:
+            headers = headers[:stop.height - start_height + 1]
+        return headers
+
 class BlockStore(object):
     def __init__(self, datadir):
         self.blockDB = dbmd.open(datadir + "/blocks", 'c')
         self.currentBlock = 0
-        self.headers_map = dict()
+        self.header_index = HeaderIndex()
 
     def close(self):
         self.blockDB.close()
@@ -44,37 +196,22 @@ class BlockStore(object):
         return ret
 
     def get_header(self, blockhash):
-        try:
-            return self.headers_map[blockhash]
-        except KeyError:
+        entry = self.header_index.get(blockhash)
+        if entry is None:
             return None
+        return entry.header
 
-    # Note: this pulls full blocks out of the database just to retrieve
-    # the headers -- perhaps we could keep a separate data structure
-    # to avoid this overhead.
+    # Headers are served from the in-memory header index rather than by
+    # pulling full blocks out of the database.
     def headers_for(self, locator, hash_stop, current_tip=None):
         if current_tip is None:
             current_tip = self.currentBlock
-        current_block_header = self.get_header(current_tip)
-        if current_block_header is None:
+        headers = self.header_index.get_headers(current_tip, locator.vHave, hash_stop)
+        if headers is None:
             return None
 
         response = msg_headers()
-        headersList = [ current_block_header ]
-        maxheaders = 2000
-        while (headersList[0].sha256 not in locator.vHave):
-            prevBlockHash = headersList[0].hashPrevBlock
-            prevBlockHeader = self.get_header(prevBlockHash)
-            if prevBlockHeader is not None:
-                headersList.insert(0, prevBlockHeader)
-            else:
-                break
-        headersList = headersList[:maxheaders] # truncate if we have too many
-        hashList = [x.sha256 for x in headersList]
-        index = len(headersList)
-        if (hash_stop in hashList):
-            index = hashList.index(hash_stop)+1
-        response.headers = headersList[:index]
+        response.headers = headers
         return response
 
     def add_block(self, block):
@@ -84,10 +221,10 @@ class BlockStore(object):
         except TypeError as e:
             print("Unexpected error: ", sys.exc_info()[0], e.args)
         self.currentBlock = block.sha256
-        self.headers_map[block.sha256] = CBlockHeader(block)
+        self.header_index.add(CBlockHeader(block))
 
     def add_header(self, header):
-        self.headers_map[header.sha256] = header
+        self.header_index.add(header)
 
     # lookup the hashes in "inv", and return p2p messages for delivering
     # blocks found.
@@ -104,21 +241,8 @@ class BlockStore(object):
     def get_locator(self, current_tip=None):
         if current_tip is None:
             current_tip = self.currentBlock
-        r = []
-        counter = 0
-        step = 1
-        lastBlock = self.get_block(current_tip)
-        while lastBlock is not None:
-            r.append(lastBlock.hashPrevBlock)
-            for i in range(step):
-                lastBlock = self.get_block(lastBlock.hashPrevBlock)
-                if lastBlock is None:
-                    break
-            counter += 1
-            if counter > 10:
-                step *= 2
         locator = CBlockLocator()
-        locator.vHave = r
+        locator.vHave = self.header_index.get_locator(current_tip)
         return locator
 
 class TxStore(object):
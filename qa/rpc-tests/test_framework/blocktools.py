@@ -43,6 +43,7 @@ def add_witness_commitment(block, nonce=0):
     output_data = WITNESS_COMMITMENT_HEADER + ser_uint256(witness_commitment)
     block.vtx[0].vout.append(CTxOut(CTxOutValue(0), CScript([OP_RETURN, output_data])))
     block.vtx[0].rehash()
+    block.invalidate_merkle(0)
     block.hashMerkleRoot = block.calc_merkle_root()
     block.rehash()
 
@@ -89,8 +90,15 @@ def get_legacy_sigopcount_block(block, fAccurate=True):
 def get_legacy_sigopcount_tx(tx, fAccurate=True):
     count = 0
     for i in tx.vout:
-        count += i.scriptPubKey.GetSigOpCount(fAccurate)
+        count += get_sigopcount_script(i.scriptPubKey, fAccurate)
     for j in tx.vin:
-        # scriptSig might be of type bytes, so convert to CScript for the moment
-        count += CScript(j.scriptSig).GetSigOpCount(fAccurate)
+        count += get_sigopcount_script(j.scriptSig, fAccurate)
     return count
+
+# Scripts might be of type bytes (eg after deserialization).  Those are
+# converted to CScript for counting; CScripts keep their decoded opcodes
+# cached, so re-counting the same block is cheap.
+def get_sigopcount_script(script, fAccurate=True):
+    if not isinstance(script, CScript):
+        script = CScript(script)
+    return script.GetSigOpCount(fAccurate)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Elements Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+#
+# compactblocks.py - a BIP 152 receiving peer for measuring compact block relay
+#
+# CompactBlockPeer negotiates sendcmpct in high-bandwidth mode (the node
+# pushes cmpctblock as soon as it has a block) or low-bandwidth mode (the
+# node announces with inv/headers and we ask for the compact block with
+# getdata).  Each compact block is reconstructed against a local mempool
+# mirror with PartiallyDownloadedBlock; anything missing is fetched with
+# getblocktxn.  For every block a BlockRecord keeps the timings and how much
+# of the block the mirror supplied.
+#
+# The mirror is only what the caller puts in it (add_to_mempool), so the
+# overlap with the node's mempool can be controlled exactly.  Transactions
+# in reconstructed blocks are dropped from it, as the node does.
+#
+
+import time
+
+from .mininode import BlockTransactionsRequest, CInv, HeaderAndShortIDs, PartiallyDownloadedBlock, \
+    SingleNodeConnCB, mininode_lock, msg_getblocktxn, msg_getdata, msg_sendcmpct, wait_until
+
+MSG_CMPCT_BLOCK = 4
+
+class BlockRecord(object):
+    """What happened to one block on its way to us"""
+
+    def __init__(self, blockhash):
+        self.blockhash = blockhash
+        self.announced = None       # inv/headers seen (low-bandwidth only)
+        self.received = None        # cmpctblock arrived
+        self.completed = None       # block fully reconstructed
+        self.num_txs = 0
+        self.prefilled = 0
+        self.from_mempool = 0
+        self.requested = 0          # transactions asked for with getblocktxn
+        self.full_block = False     # node sent a plain block instead
+        self.failed = False
+
+    def hit_rate(self):
+        """Share of the non-prefilled transactions the mirror supplied"""
+        wanted = self.num_txs - self.prefilled
+        return self.from_mempool / wanted if wanted else 1.0
+
+    def reconstruction_time(self):
+        return self.completed - self.received
+
+    def __repr__(self):
+        return "BlockRecord(hash=%064x txs=%d prefilled=%d mempool=%d requested=%d)" % \
+            (self.blockhash, self.num_txs, self.prefilled, self.from_mempool, self.requested)
+
+class CompactBlockPeer(SingleNodeConnCB):
+    def __init__(self, version=1, high_bandwidth=True):
+        SingleNodeConnCB.__init__(self)
+        self.version = version
+        self.high_bandwidth = high_bandwidth
+        self.mempool = {}       # txid -> CTransaction
+        self.records = {}       # block hash -> BlockRecord
+        self.partial = {}       # block hash -> PartiallyDownloadedBlock awaiting blocktxn
+        self.blocks = {}        # block hash -> reconstructed CBlock
+
+    def on_verack(self, conn, message):
+        SingleNodeConnCB.on_verack(self, conn, message)
+        self._send_sendcmpct(conn)
+
+    def _send_sendcmpct(self, conn):
+        msg = msg_sendcmpct()
+        msg.announce = self.high_bandwidth
+        msg.version = self.version
+        conn.send_message(msg)
+
+    def set_high_bandwidth(self, high_bandwidth):
+        """Switch announcement mode; takes effect once the node has processed it"""
+        with mininode_lock:
+            self.high_bandwidth = high_bandwidth
+        self._send_sendcmpct(self.connection)
+        self.sync_with_ping()
+
+    def add_to_mempool(self, txs):
+        with mininode_lock:
+            for tx in txs:
+                tx.calc_sha256()
+                self.mempool[tx.sha256] = tx
+
+    def _record(self, blockhash):
+        if blockhash not in self.records:
+            self.records[blockhash] = BlockRecord(blockhash)
+        return self.records[blockhash]
+
+    # Low-bandwidth announcements: ask for the compact block
+    def _request_compact(self, conn, hashes):
+        want = msg_getdata()
+        now = time.time()
+        for blockhash in hashes:
+            record = self._record(blockhash)
+            if record.announced is None and record.received is None:
+                record.announced = now
+                want.inv.append(CInv(MSG_CMPCT_BLOCK, blockhash))
+        if want.inv:
+            conn.send_message(want)
+
+    def on_inv(self, conn, message):
+        self._request_compact(conn, [inv.hash for inv in message.inv if inv.type == 2])
+
+    def on_headers(self, conn, message):
+        for header in message.headers:
+            header.calc_sha256()
+        self._request_compact(conn, [header.sha256 for header in message.headers])
+
+    def on_cmpctblock(self, conn, message):
+        now = time.time()
+        cmpct = HeaderAndShortIDs(message.header_and_shortids)
+        cmpct.use_witness = self.version == 2
+        cmpct.header.calc_sha256()
+        blockhash = cmpct.header.sha256
+        record = self._record(blockhash)
+        if record.received is not None:
+            return
+        record.received = now
+        record.num_txs = len(cmpct.shortids) + len(cmpct.prefilled_txn)
+        record.prefilled = len(cmpct.prefilled_txn)
+
+        partial = PartiallyDownloadedBlock()
+        if not partial.init_data(cmpct, self.mempool.values()):
+            record.failed = True
+            return
+        record.from_mempool = partial.mempool_count
+        missing = partial.get_missing()
+        if not missing:
+            self._complete(blockhash, partial.fill_block([]))
+            return
+        record.requested = len(missing)
+        self.partial[blockhash] = partial
+        msg = msg_getblocktxn()
+        msg.block_txn_request = BlockTransactionsRequest(blockhash)
+        msg.block_txn_request.from_absolute(missing)
+        conn.send_message(msg)
+
+    def on_blocktxn(self, conn, message):
+        blocktxn = message.block_transactions
+        partial = self.partial.pop(blocktxn.blockhash, None)
+        if partial is None:
+            return
+        self._complete(blocktxn.blockhash, partial.fill_block(blocktxn.transactions))
+
+    def on_block(self, conn, message):
+        block = message.block
+        block.calc_sha256()
+        record = self._record(block.sha256)
+        if record.completed is not None:
+            return
+        if record.received is None:
+            record.received = time.time()
+        record.num_txs = len(block.vtx)
+        record.full_block = True
+        self.partial.pop(block.sha256, None)
+        self._complete(block.sha256, block)
+
+    def _complete(self, blockhash, block):
+        record = self.records[blockhash]
+        if block is None:
+            record.failed = True
+            return
+        record.completed = time.time()
+        self.blocks[blockhash] = block
+        for tx in block.vtx:
+            tx.calc_sha256()
+            self.mempool.pop(tx.sha256, None)
+
+    def wait_for_block(self, blockhash, timeout=60):
+        """Wait until blockhash is reconstructed (or failed); returns its BlockRecord"""
+        def done():
+            record = self.records.get(blockhash)
+            return record is not None and (record.completed is not None or record.failed)
+        if not wait_until(done, timeout=timeout):
+            raise AssertionError("block %064x not reconstructed within %ds" % (blockhash, timeout))
+        with mininode_lock:
+            return self.records[blockhash]
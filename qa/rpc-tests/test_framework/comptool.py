@@ -156,6 +156,21 @@ class TestNode(NodeConnCB):
 #    on the final tx is None, then contents of entire mempool are compared
 #    across all connections.  (If outcome of final tx is specified as true
 #    or false, then only the last tx is tested against outcome.)
+#
+# Pipelined mode: if the TestManager is given a pipeline_window of N > 0,
+#    then under sync_every_block/sync_every_tx, runs of objects whose outcome
+#    can be verified from the final state are not synced one at a time.
+#    Instead up to N of them are inv'ed ahead of the node, rejects and
+#    getdata requests are collected as they arrive, and the node is only
+#    synced and checked when the run ends (at the end of the TestInstance,
+#    or before an object that needs an individual check).  That covers:
+#     - blocks expected to be accepted which become the tip and extend the
+#       previously verified tip (every block in the run must have been the
+#       tip in turn iff the last one is the tip and none were rejected);
+#     - transactions expected to be accepted (each must be in the mempool
+#       and none may have been rejected).
+#    Everything else (expected rejections, None outcomes, explicit tips)
+#    is handled exactly as without pipelining.
 
 class TestInstance(object):
     def __init__(self, objects=None, sync_every_block=True, sync_every_tx=False):
@@ -165,13 +180,20 @@ class TestInstance(object):
 
 class TestManager(object):
 
-    def __init__(self, testgen, datadir):
+    def __init__(self, testgen, datadir, pipeline_window=None):
         self.test_generator = testgen
         self.connections    = []
         self.test_nodes     = []
         self.block_store    = BlockStore(datadir)
         self.tx_store       = TxStore(datadir)
         self.ping_counter   = 1
+        # Default to the --pipeline option of a ComparisonTestFramework
+        if pipeline_window is None:
+            options = getattr(testgen, 'options', None)
+            pipeline_window = getattr(options, 'pipeline_window', 0)
+        self.pipeline_window = pipeline_window
+        self.blocks_processed = 0
+        self.txs_processed  = 0
 
     def add_all_connections(self, nodes):
         for i in range(len(nodes)):
@@ -225,6 +247,70 @@ class TestManager(object):
         self.wait_for_pings(self.ping_counter)
         self.ping_counter += 1
 
+    # Wait until every connection has requested all but max_outstanding of
+    # the objects in hashes (which are all of the given request map type).
+    def wait_for_requests(self, hashes, max_outstanding, map_name):
+        def requested():
+            return all(
+                sum(1 for h in hashes if not getattr(node, map_name).get(h)) <= max_outstanding
+                for node in self.test_nodes
+            )
+        return wait_until(requested, attempts=20*max(len(hashes), 1))
+
+    # Inv a block we expect to be accepted, keeping at most pipeline_window
+    # blocks outstanding.
+    def pipeline_block(self, block, pipeline):
+        if len(pipeline) >= self.pipeline_window:
+            if not self.wait_for_requests(pipeline[-self.pipeline_window:], self.pipeline_window - 1, 'block_request_map'):
+                raise AssertionError("Not all nodes requested block")
+        pipeline.append(block.sha256)
+        [ c.cb.send_inv(block) for c in self.connections ]
+
+    # Analogous to pipeline_block
+    def pipeline_transaction(self, tx, pipeline):
+        if len(pipeline) >= self.pipeline_window:
+            if not self.wait_for_requests(pipeline[-self.pipeline_window:], self.pipeline_window - 1, 'tx_request_map'):
+                raise AssertionError("Not all nodes requested transaction")
+        pipeline.append(tx.sha256)
+        [ c.cb.send_inv(tx) for c in self.connections ]
+
+    # Barrier for a run of pipelined blocks: wait for them all to be
+    # requested, sync up the tips, and check that the last one is the tip
+    # and that none were rejected along the way.
+    def flush_block_pipeline(self, pipeline, test_number):
+        if not pipeline:
+            return
+        if not self.wait_for_requests(pipeline, 0, 'block_request_map'):
+            raise AssertionError("Not all nodes requested block")
+        self.sync_blocks(pipeline[-1], 1)
+        if not self.check_results(pipeline[-1], True):
+            raise AssertionError("Test failed at test %d" % test_number)
+        with mininode_lock:
+            for c in self.connections:
+                for blockhash in pipeline:
+                    if blockhash in c.cb.block_reject_map:
+                        print('Block rejected with %s: %064x' % (c.cb.block_reject_map[blockhash], blockhash))
+                        raise AssertionError("Test failed at test %d" % test_number)
+        del pipeline[:]
+
+    # Analogous to flush_block_pipeline
+    def flush_tx_pipeline(self, pipeline, test_number):
+        if not pipeline:
+            return
+        if not self.wait_for_requests(pipeline, 0, 'tx_request_map'):
+            raise AssertionError("Not all nodes requested transaction")
+        self.sync_transaction(pipeline[-1], 1)
+        for txhash in pipeline:
+            if not self.check_mempool(txhash, True):
+                raise AssertionError("Test failed at test %d" % test_number)
+        with mininode_lock:
+            for c in self.connections:
+                for txhash in pipeline:
+                    if txhash in c.cb.tx_reject_map:
+                        print('Tx rejected with %s: %064x' % (c.cb.tx_reject_map[txhash], txhash))
+                        raise AssertionError("Test failed at test %d" % test_number)
+        del pipeline[:]
+
     # Analogous to sync_block (see above)
     def sync_transaction(self, txhash, num_events):
         # Wait for nodes to request transaction (50ms sleep * 20 tries * num_events)
@@ -306,6 +392,7 @@ class TestManager(object):
         self.wait_for_verack()
 
         test_number = 1
+        run_start = time.time()
         for test_instance in self.test_generator.get_tests():
             # We use these variables to keep track of the last block
             # and last transaction in the tests, which are used
@@ -313,6 +400,15 @@ class TestManager(object):
             [ block, block_outcome, tip ] = [ None, None, None ]
             [ tx, tx_outcome ] = [ None, None ]
             invqueue = []
+            # Hashes of objects in flight in pipelined mode, and the tip we
+            # know (or will know, once the pipeline is flushed) the nodes
+            # to be at.
+            block_pipeline = []
+            tx_pipeline = []
+            verified_tip = None
+            instance_start = time.time()
+            instance_blocks = 0
+            instance_txs = 0
 
             for test_obj in test_instance.blocks_and_transactions:
                 b_or_t = test_obj[0]
@@ -321,6 +417,7 @@ class TestManager(object):
                 if isinstance(b_or_t, CBlock):  # Block test runner
                     block = b_or_t
                     block_outcome = outcome
+                    instance_blocks += 1
                     tip = block.sha256
                     # each test_obj can have an optional third argument
                     # to specify the tip we should compare with
@@ -350,18 +447,25 @@ class TestManager(object):
                     # Either send inv's to each node and sync, or add
                     # to invqueue for later inv'ing.
                     if (test_instance.sync_every_block):
-                        # if we expect success, send inv and sync every block
-                        # if we expect failure, just push the block and see what happens.
-                        if outcome == True:
-                            [ c.cb.send_inv(block) for c in self.connections ]
-                            self.sync_blocks(block.sha256, 1)
+                        self.flush_tx_pipeline(tx_pipeline, test_number)
+                        if (self.pipeline_window > 0 and outcome == True and tip == block.sha256 and
+                                verified_tip is not None and block.hashPrevBlock == verified_tip):
+                            self.pipeline_block(block, block_pipeline)
                         else:
-                            [ c.send_message(msg_block(block)) for c in self.connections ]
-                            [ c.cb.send_ping(self.ping_counter) for c in self.connections ]
-                            self.wait_for_pings(self.ping_counter)
-                            self.ping_counter += 1
-                        if (not self.check_results(tip, outcome)):
-                            raise AssertionError("Test failed at test %d" % test_number)
+                            self.flush_block_pipeline(block_pipeline, test_number)
+                            # if we expect success, send inv and sync every block
+                            # if we expect failure, just push the block and see what happens.
+                            if outcome == True:
+                                [ c.cb.send_inv(block) for c in self.connections ]
+                                self.sync_blocks(block.sha256, 1)
+                            else:
+                                [ c.send_message(msg_block(block)) for c in self.connections ]
+                                [ c.cb.send_ping(self.ping_counter) for c in self.connections ]
+                                self.wait_for_pings(self.ping_counter)
+                                self.ping_counter += 1
+                            if (not self.check_results(tip, outcome)):
+                                raise AssertionError("Test failed at test %d" % test_number)
+                        verified_tip = tip if outcome == True else None
                     else:
                         invqueue.append(CInv(2, block.sha256))
                 elif isinstance(b_or_t, CBlockHeader):
@@ -373,6 +477,7 @@ class TestManager(object):
                     assert(isinstance(b_or_t, CTransaction))
                     tx = b_or_t
                     tx_outcome = outcome
+                    instance_txs += 1
                     # Add to shared tx store and clear map entry
                     with mininode_lock:
                         self.tx_store.add_transaction(tx)
@@ -380,10 +485,15 @@ class TestManager(object):
                             c.cb.tx_request_map[tx.sha256] = False
                     # Again, either inv to all nodes or save for later
                     if (test_instance.sync_every_tx):
-                        [ c.cb.send_inv(tx) for c in self.connections ]
-                        self.sync_transaction(tx.sha256, 1)
-                        if (not self.check_mempool(tx.sha256, outcome)):
-                            raise AssertionError("Test failed at test %d" % test_number)
+                        self.flush_block_pipeline(block_pipeline, test_number)
+                        if self.pipeline_window > 0 and outcome == True:
+                            self.pipeline_transaction(tx, tx_pipeline)
+                        else:
+                            self.flush_tx_pipeline(tx_pipeline, test_number)
+                            [ c.cb.send_inv(tx) for c in self.connections ]
+                            self.sync_transaction(tx.sha256, 1)
+                            if (not self.check_mempool(tx.sha256, outcome)):
+                                raise AssertionError("Test failed at test %d" % test_number)
                     else:
                         invqueue.append(CInv(1, tx.sha256))
                 # Ensure we're not overflowing the inv queue
@@ -391,6 +501,9 @@ class TestManager(object):
                     [ c.send_message(msg_inv(invqueue)) for c in self.connections ]
                     invqueue = []
 
+            self.flush_block_pipeline(block_pipeline, test_number)
+            self.flush_tx_pipeline(tx_pipeline, test_number)
+
             # Do final sync if we weren't syncing on every block or every tx.
             if (not test_instance.sync_every_block and block is not None):
                 if len(invqueue) > 0:
@@ -407,9 +520,21 @@ class TestManager(object):
                 if (not self.check_mempool(tx.sha256, tx_outcome)):
                     raise AssertionError("Mempool test failed at test %d" % test_number)
 
-            print("Test %d: PASS" % test_number, [ c.rpc.getblockcount() for c in self.connections ])
+            elapsed = time.time() - instance_start
+            self.blocks_processed += instance_blocks
+            self.txs_processed += instance_txs
+            if instance_blocks > 0 and elapsed > 0:
+                print("Test %d: PASS" % test_number, [ c.rpc.getblockcount() for c in self.connections ],
+                      "(%d blocks, %.1f blocks/sec)" % (instance_blocks, instance_blocks / elapsed))
+            else:
+                print("Test %d: PASS" % test_number, [ c.rpc.getblockcount() for c in self.connections ])
             test_number += 1
 
+        elapsed = time.time() - run_start
+        print("Processed %d blocks and %d transactions in %.2fs (%.1f blocks/sec)" %
+              (self.blocks_processed, self.txs_processed, elapsed,
+               self.blocks_processed / elapsed if elapsed > 0 else 0))
+
         [ c.disconnect_node() for c in self.connections ]
         self.wait_for_disconnections()
         self.block_store.close()
@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Elements Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+#
+# confidential.py - Confidential Transactions without the node
+#
+# Asset generators, Pedersen value commitments, rangeproofs and surjection
+# proofs via the generator, rangeproof and surjectionproof modules of the
+# bundled libsecp256k1 (see secp256k1.py for how to build it).
+#
+# The high-level helpers (blind_output, unblind_output, blind_transaction,
+# verify_output, verify_amounts) follow src/blind.cpp and VerifyAmounts()
+# closely enough that the node accepts what they produce and that they
+# accept what blindrawtransaction produces:
+#
+#  - the rangeproof nonce is sha256(ECDH(ephemeral key, blinding pubkey)),
+#    with the ephemeral pubkey stored in nNonce
+#  - the rangeproof commits to the scriptPubKey and carries the asset id
+#    and asset blinding factor as its 64-byte message
+#  - surjection proofs use up to 3 of the inputs as the anonymity set
+#
+# Assets are the raw 32-byte ids as serialized in transactions (ie the
+# part of an explicit CTxOutAsset after the 0x01 prefix).  Blinding
+# factors are 32-byte strings.
+#
+
+import ctypes
+import hashlib
+import os
+
+from . import secp256k1
+from .mininode import CTxOutAsset, CTxOutNonce, CTxOutValue, CTxOutWitness
+
+ZERO_BLIND = b'\x00' * 32
+RANGEPROOF_MAX_LENGTH = 5134
+RANGEPROOF_MESSAGE_LENGTH = 4096
+DEFAULT_CT_BITS = 32
+DEFAULT_CT_EXPONENT = 0
+SURJECTION_INPUTS_TO_USE = 3
+SURJECTION_MAX_ITERATIONS = 100
+
+def available():
+    """Whether the loaded libsecp256k1 has everything this module needs"""
+    return all(secp256k1.has_module(name) for name in ("generator", "rangeproof", "surjectionproof"))
+
+def _check_available():
+    if not available():
+        raise RuntimeError("libsecp256k1 with the generator, rangeproof and surjectionproof "
+                           "modules is required (see secp256k1.py)")
+
+def random_blind():
+    return os.urandom(32)
+
+#
+# Primitives
+#
+
+def _generator(serialized):
+    gen = secp256k1.secp256k1_generator()
+    if len(serialized) != 33 or not secp256k1.lib.secp256k1_generator_parse(secp256k1.ctx, ctypes.byref(gen), serialized):
+        raise ValueError("invalid asset generator %s" % serialized.hex())
+    return gen
+
+def _serialize_generator(gen):
+    out = ctypes.create_string_buffer(33)
+    secp256k1.lib.secp256k1_generator_serialize(secp256k1.ctx, out, ctypes.byref(gen))
+    return out.raw
+
+def _commitment(serialized):
+    commit = secp256k1.secp256k1_pedersen_commitment()
+    if len(serialized) != 33 or not secp256k1.lib.secp256k1_pedersen_commitment_parse(secp256k1.ctx, ctypes.byref(commit), serialized):
+        raise ValueError("invalid value commitment %s" % serialized.hex())
+    return commit
+
+def _serialize_commitment(commit):
+    out = ctypes.create_string_buffer(33)
+    secp256k1.lib.secp256k1_pedersen_commitment_serialize(secp256k1.ctx, out, ctypes.byref(commit))
+    return out.raw
+
+def asset_generator(asset, blind=None):
+    """Serialized (33-byte) generator for asset, blinded by blind if given
+
+    This is the vchCommitment of a blinded CTxOutAsset.  An unblinded
+    generator is what the node uses for explicit assets.
+    """
+    _check_available()
+    gen = secp256k1.secp256k1_generator()
+    if blind is None:
+        ret = secp256k1.lib.secp256k1_generator_generate(secp256k1.ctx, ctypes.byref(gen), asset)
+    else:
+        ret = secp256k1.lib.secp256k1_generator_generate_blinded(secp256k1.ctx, ctypes.byref(gen), asset, blind)
+    if not ret:
+        raise ValueError("could not generate generator for asset %s" % asset.hex())
+    return _serialize_generator(gen)
+
+def value_commitment(value, blind, generator):
+    """Serialized (33-byte) Pedersen commitment to value with blind under generator"""
+    _check_available()
+    commit = secp256k1.secp256k1_pedersen_commitment()
+    if not secp256k1.lib.secp256k1_pedersen_commit(secp256k1.ctx, ctypes.byref(commit), blind, value,
+                                                  ctypes.byref(_generator(generator))):
+        raise ValueError("could not commit to value %d" % value)
+    return _serialize_commitment(commit)
+
+def blind_sum(blinds, npositive):
+    """Sum of blinds, with all but the first npositive negated"""
+    _check_available()
+    out = ctypes.create_string_buffer(32)
+    array = (ctypes.c_char_p * len(blinds))(*blinds)
+    if not secp256k1.lib.secp256k1_pedersen_blind_sum(secp256k1.ctx, out, array, len(blinds), npositive):
+        raise ValueError("blinding factors sum out of range")
+    return out.raw
+
+def balance_blinds(values, asset_blinds, value_blinds, n_inputs):
+    """Final value blinding factor that makes the commitments balance
+
+    values, asset_blinds and value_blinds list the inputs followed by the
+    blinded outputs; the last entry of value_blinds is ignored and the
+    returned blind should be used in its place.
+    """
+    _check_available()
+    n = len(values)
+    c_values = (ctypes.c_uint64 * n)(*values)
+    generator_blinds = [ctypes.create_string_buffer(bytes(blind), 32) for blind in asset_blinds]
+    blinding_factors = [ctypes.create_string_buffer(bytes(blind), 32) for blind in value_blinds]
+    c_generator_blinds = (ctypes.c_void_p * n)(*[ctypes.addressof(b) for b in generator_blinds])
+    c_blinding_factors = (ctypes.c_void_p * n)(*[ctypes.addressof(b) for b in blinding_factors])
+    if not secp256k1.lib.secp256k1_pedersen_blind_generator_blind_sum(secp256k1.ctx, c_values, c_generator_blinds,
+                                                                     c_blinding_factors, n, n_inputs):
+        raise ValueError("could not balance blinding factors")
+    return blinding_factors[-1].raw
+
+def verify_tally(positive, negative):
+    """Whether the serialized commitments in positive and negative sum to the same value"""
+    _check_available()
+    pcommits = [_commitment(c) for c in positive]
+    ncommits = [_commitment(c) for c in negative]
+    P = ctypes.POINTER(secp256k1.secp256k1_pedersen_commitment)
+    c_positive = (P * len(pcommits))(*[ctypes.pointer(c) for c in pcommits])
+    c_negative = (P * len(ncommits))(*[ctypes.pointer(c) for c in ncommits])
+    return secp256k1.lib.secp256k1_pedersen_verify_tally(secp256k1.ctx, c_positive, len(pcommits),
+                                                        c_negative, len(ncommits)) == 1
+
+def rangeproof_sign(value, commitment, blind, nonce, generator, min_value=1, exp=DEFAULT_CT_EXPONENT,
+                    min_bits=DEFAULT_CT_BITS, message=b'', extra_commit=b''):
+    _check_available()
+    proof = ctypes.create_string_buffer(RANGEPROOF_MAX_LENGTH)
+    plen = ctypes.c_size_t(RANGEPROOF_MAX_LENGTH)
+    if not secp256k1.lib.secp256k1_rangeproof_sign(secp256k1.ctx, proof, ctypes.byref(plen), min_value,
+                                                  ctypes.byref(_commitment(commitment)), blind, nonce, exp,
+                                                  min_bits, value, message, len(message), extra_commit,
+                                                  len(extra_commit), ctypes.byref(_generator(generator))):
+        raise ValueError("could not create rangeproof for value %d" % value)
+    return proof.raw[:plen.value]
+
+def rangeproof_verify(proof, commitment, generator, extra_commit=b''):
+    """(min_value, max_value) proven by proof, or None if it doesn't verify"""
+    _check_available()
+    min_value = ctypes.c_uint64()
+    max_value = ctypes.c_uint64()
+    if not secp256k1.lib.secp256k1_rangeproof_verify(secp256k1.ctx, ctypes.byref(min_value), ctypes.byref(max_value),
+                                                    ctypes.byref(_commitment(commitment)), proof, len(proof),
+                                                    extra_commit, len(extra_commit),
+                                                    ctypes.byref(_generator(generator))):
+        return None
+    return (min_value.value, max_value.value)
+
+def rangeproof_rewind(proof, commitment, nonce, generator, extra_commit=b''):
+    """(value, blind, message) recovered from proof with nonce, or None"""
+    _check_available()
+    blind = ctypes.create_string_buffer(32)
+    value = ctypes.c_uint64()
+    message = ctypes.create_string_buffer(RANGEPROOF_MESSAGE_LENGTH)
+    message_len = ctypes.c_size_t(RANGEPROOF_MESSAGE_LENGTH)
+    min_value = ctypes.c_uint64()
+    max_value = ctypes.c_uint64()
+    if not secp256k1.lib.secp256k1_rangeproof_rewind(secp256k1.ctx, blind, ctypes.byref(value), message,
+                                                    ctypes.byref(message_len), nonce, ctypes.byref(min_value),
+                                                    ctypes.byref(max_value), ctypes.byref(_commitment(commitment)),
+                                                    proof, len(proof), extra_commit, len(extra_commit),
+                                                    ctypes.byref(_generator(generator))):
+        return None
+    return (value.value, blind.raw, message.raw[:message_len.value])
+
+def rangeproof_info(proof):
+    """(exp, mantissa, min_value, max_value) of proof, or None if it can't be decoded"""
+    _check_available()
+    exp = ctypes.c_int()
+    mantissa = ctypes.c_int()
+    min_value = ctypes.c_uint64()
+    max_value = ctypes.c_uint64()
+    if not secp256k1.lib.secp256k1_rangeproof_info(secp256k1.ctx, ctypes.byref(exp), ctypes.byref(mantissa),
+                                                  ctypes.byref(min_value), ctypes.byref(max_value),
+                                                  proof, len(proof)):
+        return None
+    return (exp.value, mantissa.value, min_value.value, max_value.value)
+
+def surjectionproof_create(output_asset, output_generator, output_blind, input_assets, input_generators,
+                           input_blinds, inputs_to_use=SURJECTION_INPUTS_TO_USE, seed=None):
+    """Prove output_generator blinds one of input_assets
+
+    input_generators are the serialized generators the inputs commit to,
+    and input_blinds their asset blinding factors (ZERO_BLIND for explicit
+    assets).
+    """
+    _check_available()
+    n = len(input_assets)
+    tags = (secp256k1.secp256k1_fixed_asset_tag * n)()
+    for (i, asset) in enumerate(input_assets):
+        ctypes.memmove(tags[i].data, asset, 32)
+    output_tag = secp256k1.secp256k1_fixed_asset_tag()
+    ctypes.memmove(output_tag.data, output_asset, 32)
+    generators = (secp256k1.secp256k1_generator * n)(*[_generator(g) for g in input_generators])
+    output_gen = _generator(output_generator)
+
+    proof = secp256k1.secp256k1_surjectionproof()
+    input_index = ctypes.c_size_t()
+    if not secp256k1.lib.secp256k1_surjectionproof_initialize(secp256k1.ctx, ctypes.byref(proof),
+                                                             ctypes.byref(input_index), tags, n,
+                                                             min(inputs_to_use, n), ctypes.byref(output_tag),
+                                                             SURJECTION_MAX_ITERATIONS, seed or os.urandom(32)):
+        raise ValueError("output asset %s is not among the inputs" % output_asset.hex())
+    if not secp256k1.lib.secp256k1_surjectionproof_generate(secp256k1.ctx, ctypes.byref(proof), generators, n,
+                                                           ctypes.byref(output_gen), input_index.value,
+                                                           input_blinds[input_index.value], output_blind):
+        raise ValueError("could not create surjection proof")
+
+    size = ctypes.c_size_t(secp256k1.lib.secp256k1_surjectionproof_serialized_size(secp256k1.ctx, ctypes.byref(proof)))
+    out = ctypes.create_string_buffer(size.value)
+    secp256k1.lib.secp256k1_surjectionproof_serialize(secp256k1.ctx, out, ctypes.byref(size), ctypes.byref(proof))
+    return out.raw[:size.value]
+
+def surjectionproof_verify(proof, input_generators, output_generator):
+    _check_available()
+    parsed = secp256k1.secp256k1_surjectionproof()
+    if not secp256k1.lib.secp256k1_surjectionproof_parse(secp256k1.ctx, ctypes.byref(parsed), proof, len(proof)):
+        return False
+    n = len(input_generators)
+    generators = (secp256k1.secp256k1_generator * n)(*[_generator(g) for g in input_generators])
+    return secp256k1.lib.secp256k1_surjectionproof_verify(secp256k1.ctx, ctypes.byref(parsed), generators, n,
+                                                         ctypes.byref(_generator(output_generator))) == 1
+
+#
+# Transaction-level helpers
+#
+
+def ecdh_nonce(secret, pubkey):
+    """Rangeproof nonce shared between secret and pubkey
+
+    sha256 of CKey::ECDH(), which is itself sha256 of the compressed
+    shared point.
+    """
+    point = secp256k1.secp256k1_pubkey()
+    if not secp256k1.lib.secp256k1_ec_pubkey_parse(secp256k1.ctx, ctypes.byref(point), pubkey, len(pubkey)):
+        raise ValueError("invalid pubkey %s" % pubkey.hex())
+    if not secp256k1.lib.secp256k1_ec_pubkey_tweak_mul(secp256k1.ctx, ctypes.byref(point), secret):
+        raise ValueError("invalid secret")
+    out = ctypes.create_string_buffer(33)
+    outlen = ctypes.c_size_t(33)
+    secp256k1.lib.secp256k1_ec_pubkey_serialize(secp256k1.ctx, out, ctypes.byref(outlen), ctypes.byref(point),
+                                                secp256k1.SECP256K1_EC_COMPRESSED)
+    return hashlib.sha256(hashlib.sha256(out.raw).digest()).digest()
+
+def _ephemeral_key():
+    while True:
+        secret = os.urandom(32)
+        if secp256k1.lib.secp256k1_ec_seckey_verify(secp256k1.ctx, secret):
+            break
+    pubkey = secp256k1.secp256k1_pubkey()
+    secp256k1.lib.secp256k1_ec_pubkey_create(secp256k1.ctx, ctypes.byref(pubkey), secret)
+    out = ctypes.create_string_buffer(33)
+    outlen = ctypes.c_size_t(33)
+    secp256k1.lib.secp256k1_ec_pubkey_serialize(secp256k1.ctx, out, ctypes.byref(outlen), ctypes.byref(pubkey),
+                                                secp256k1.SECP256K1_EC_COMPRESSED)
+    return (secret, out.raw)
+
+def is_unspendable(script):
+    return (len(script) > 0 and script[0] == 0x6a) or len(script) > 10000
+
+def input_generator(asset, asset_blind):
+    """Generator an input with the given asset and asset blind commits to"""
+    if asset_blind == ZERO_BLIND:
+        return asset_generator(asset)
+    return asset_generator(asset, asset_blind)
+
+def blind_output(txout, txoutwit, value, asset, blinding_pubkey, value_blind, asset_blind,
+                 input_assets, input_asset_blinds, input_generators=None, ct_bits=DEFAULT_CT_BITS):
+    """Blind txout to pay value of asset, filling in its witness
+
+    Sets txout's nAsset, nValue and nNonce and txoutwit's rangeproof and
+    surjection proof.  The surjection proof is over input_assets, whose
+    generators are derived from input_asset_blinds unless given.
+    """
+    _check_available()
+    if input_generators is None:
+        input_generators = [input_generator(a, b) for (a, b) in zip(input_assets, input_asset_blinds)]
+    generator = asset_generator(asset, asset_blind)
+    commitment = value_commitment(value, value_blind, generator)
+    (ephemeral_secret, ephemeral_pubkey) = _ephemeral_key()
+    nonce = ecdh_nonce(ephemeral_secret, blinding_pubkey)
+
+    script = bytes(txout.scriptPubKey)
+    txoutwit.vchRangeproof = rangeproof_sign(value, commitment, value_blind, nonce, generator,
+                                             min_value=0 if is_unspendable(script) else 1,
+                                             min_bits=ct_bits, message=asset + asset_blind, extra_commit=script)
+    txoutwit.vchSurjectionproof = surjectionproof_create(asset, generator, asset_blind, input_assets,
+                                                         input_generators, input_asset_blinds)
+    txout.nAsset = CTxOutAsset(generator)
+    txout.nValue = CTxOutValue()
+    txout.nValue.vchCommitment = commitment
+    txout.nNonce = CTxOutNonce(ephemeral_pubkey)
+
+def unblind_output(txout, txoutwit, blinding_secret):
+    """(value, asset, value_blind, asset_blind) of a blinded txout, or None
+
+    Like UnblindConfidentialPair(), this fails unless the rangeproof
+    message matches the asset commitment.
+    """
+    _check_available()
+    if txout.nValue.vchCommitment[0] not in (8, 9) or len(txoutwit.vchRangeproof) == 0:
+        return None
+    nonce_commitment = txout.nNonce.vchCommitment
+    if len(nonce_commitment) == 33:
+        nonce = ecdh_nonce(blinding_secret, nonce_commitment)
+        extra_commit = bytes(txout.scriptPubKey)
+    else:
+        nonce = blinding_secret
+        extra_commit = b''
+    asset_commitment = txout.nAsset.vchCommitment
+    if asset_commitment[0] == 1:
+        generator = asset_generator(asset_commitment[1:])
+    else:
+        generator = asset_commitment
+    result = rangeproof_rewind(txoutwit.vchRangeproof, txout.nValue.vchCommitment, nonce, generator, extra_commit)
+    if result is None:
+        return None
+    (value, value_blind, message) = result
+    if len(message) < 64:
+        return None
+    (asset, asset_blind) = (message[:32], message[32:64])
+    if asset_generator(asset, asset_blind) != generator:
+        return None
+    return (value, asset, value_blind, asset_blind)
+
+def blind_transaction(tx, input_values, input_assets, input_value_blinds, input_asset_blinds,
+                      output_pubkeys, ct_bits=DEFAULT_CT_BITS):
+    """Blind the outputs of tx that have a pubkey in output_pubkeys
+
+    The input_* lists describe what tx spends (ZERO_BLIND for explicit
+    inputs).  The outputs to blind must still be explicit; output_pubkeys
+    is indexed by output and None (or short) for outputs to leave alone,
+    such as the fee.  The last blinded output's value blind is chosen so
+    that the commitments balance.
+
+    Returns the (value_blinds, asset_blinds) of all outputs.
+    """
+    _check_available()
+    output_pubkeys = list(output_pubkeys) + [None] * (len(tx.vout) - len(output_pubkeys))
+    blinded = [i for i in range(len(tx.vout)) if output_pubkeys[i] is not None]
+    if not blinded:
+        raise ValueError("no outputs to blind")
+
+    value_blinds = [ZERO_BLIND] * len(tx.vout)
+    asset_blinds = [ZERO_BLIND] * len(tx.vout)
+    output_values = []
+    output_assets = []
+    for i in blinded:
+        output_values.append(tx.vout[i].nValue.getAmount())
+        output_assets.append(tx.vout[i].nAsset.vchCommitment[1:])
+        value_blinds[i] = random_blind()
+        asset_blinds[i] = random_blind()
+    value_blinds[blinded[-1]] = balance_blinds(
+        list(input_values) + output_values,
+        list(input_asset_blinds) + [asset_blinds[i] for i in blinded],
+        list(input_value_blinds) + [value_blinds[i] for i in blinded],
+        len(input_values))
+
+    input_generators = [input_generator(a, b) for (a, b) in zip(input_assets, input_asset_blinds)]
+    while len(tx.wit.vtxoutwit) < len(tx.vout):
+        tx.wit.vtxoutwit.append(CTxOutWitness())
+    for (n, i) in enumerate(blinded):
+        blind_output(tx.vout[i], tx.wit.vtxoutwit[i], output_values[n], output_assets[n], output_pubkeys[i],
+                     value_blinds[i], asset_blinds[i], input_assets, input_asset_blinds, input_generators,
+                     ct_bits)
+    tx.rehash()
+    return (value_blinds, asset_blinds)
+
+def _txout_generator(txout):
+    asset = txout.nAsset.vchCommitment
+    if asset[0] == 1:
+        return asset_generator(asset[1:])
+    return asset
+
+def _txout_commitment(txout, generator):
+    value = txout.nValue.vchCommitment
+    if value[0] == 1:
+        return value_commitment(txout.nValue.getAmount(), ZERO_BLIND, generator)
+    return value
+
+def verify_output(txout, txoutwit, input_generators):
+    """Check a blinded txout's rangeproof and surjection proof"""
+    _check_available()
+    generator = _txout_generator(txout)
+    if txout.nValue.vchCommitment[0] != 1:
+        if rangeproof_verify(txoutwit.vchRangeproof, txout.nValue.vchCommitment, generator,
+                             bytes(txout.scriptPubKey)) is None:
+            return False
+    if txout.nAsset.vchCommitment[0] != 1:
+        if not surjectionproof_verify(txoutwit.vchSurjectionproof, input_generators, generator):
+            return False
+    return True
+
+def verify_amounts(spent_txouts, tx):
+    """Whether tx's outputs balance the txouts it spends, and their proofs verify
+
+    Issuances aren't supported.
+    """
+    _check_available()
+    input_generators = [_txout_generator(txout) for txout in spent_txouts]
+    inputs = [_txout_commitment(txout, generator) for (txout, generator) in zip(spent_txouts, input_generators)]
+    outputs = [_txout_commitment(txout, _txout_generator(txout)) for txout in tx.vout]
+    if not verify_tally(outputs, inputs):
+        return False
+    for i in range(len(tx.vout)):
+        txoutwit = tx.wit.vtxoutwit[i] if i < len(tx.wit.vtxoutwit) else CTxOutWitness()
+        if not verify_output(tx.vout[i], txoutwit, input_generators):
+            return False
+    return True
@@ -1,12 +1,16 @@
 # Copyright (c) 2011 Sam Rushing
 #
-# key.py - OpenSSL wrapper
+# key.py - OpenSSL and libsecp256k1 wrappers
 #
 # This file is modified from python-bitcoinlib.
 #
 
 """ECC secp256k1 crypto routines
 
+CECKey is backed by libsecp256k1 (see secp256k1.py) when the shared library
+is available, and by OpenSSL's EC_KEY otherwise.  Both backends have the
+same interface.
+
 WARNING: This module does not mlock() secrets; your private keys may end up on
 disk in swap! Use with caution!
 """
@@ -16,6 +20,8 @@ import ctypes.util
 import hashlib
 import sys
 
+from . import secp256k1
+
 ssl = ctypes.cdll.LoadLibrary(ctypes.util.find_library ('ssl') or 'libeay32')
 
 ssl.BN_new.restype = ctypes.c_void_p
@@ -88,7 +94,7 @@ def _check_result(val, func, args):
 ssl.EC_KEY_new_by_curve_name.restype = ctypes.c_void_p
 ssl.EC_KEY_new_by_curve_name.errcheck = _check_result
 
-class CECKey(object):
+class OpenSSLECKey(object):
     """Wrapper around OpenSSL's EC_KEY"""
 
     POINT_CONVERSION_COMPRESSED = 2
@@ -186,6 +192,12 @@ class CECKey(object):
         """Verify a DER signature"""
         return ssl.ECDSA_verify(0, hash, len(hash), sig, len(sig), self.k) == 1
 
+    def sign_many(self, hashes, low_s = True):
+        return [self.sign(hash, low_s) for hash in hashes]
+
+    def verify_many(self, hashes, sigs):
+        return [self.verify(hash, sig) for (hash, sig) in zip(hashes, sigs)]
+
     def set_compressed(self, compressed):
         if compressed:
             form = self.POINT_CONVERSION_COMPRESSED
@@ -194,6 +206,178 @@ class CECKey(object):
         ssl.EC_KEY_set_conv_form(self.k, form)
 
 
+# DER (SEC1 ECPrivateKey) encoding of a private key, laid out the way
+# OpenSSL's i2d_ECPrivateKey() does for a named curve.
+SECP256K1_OID_DER = b'\x06\x05\x2b\x81\x04\x00\x0a'
+
+def _der_length(n):
+    if n < 0x80:
+        return bytes([n])
+    return bytes([0x81, n])
+
+def _der_read_length(der, i):
+    n = der[i]
+    if n < 0x80:
+        return (n, i + 1)
+    nbytes = n & 0x7f
+    return (int.from_bytes(der[i+1:i+1+nbytes], 'big'), i + 1 + nbytes)
+
+def privkey_to_der(secret, pubkey):
+    body = b'\x02\x01\x01' + b'\x04\x20' + secret
+    body += b'\xa0' + _der_length(len(SECP256K1_OID_DER)) + SECP256K1_OID_DER
+    bitstring = b'\x03' + _der_length(len(pubkey) + 1) + b'\x00' + pubkey
+    body += b'\xa1' + _der_length(len(bitstring)) + bitstring
+    return b'\x30' + _der_length(len(body)) + body
+
+def privkey_from_der(der):
+    """Return the 32-byte secret from a DER private key, or None"""
+    try:
+        if der[0] != 0x30:
+            return None
+        (length, i) = _der_read_length(der, 1)
+        if der[i:i+3] != b'\x02\x01\x01' or der[i+3] != 0x04:
+            return None
+        (length, i) = _der_read_length(der, i + 4)
+        if length > 32 or i + length > len(der):
+            return None
+        return der[i:i+length].rjust(32, b'\x00')
+    except IndexError:
+        return None
+
+
+class Secp256k1ECKey(object):
+    """Key backed by libsecp256k1, with the same interface as OpenSSLECKey
+
+    All keys share the module's long-lived context.  Signatures are always
+    produced in low-S form (with RFC6979 nonces), so signing with
+    low_s=False raises ValueError rather than quietly ignoring it;
+    verification accepts high-S signatures, as OpenSSL does.
+    """
+
+    def __init__(self):
+        self.secret = None
+        self.pubkey = None
+        self.compressed = False
+        # Scratch buffers reused across (batch) calls
+        self._sig = secp256k1.secp256k1_ecdsa_signature()
+        self._der = ctypes.create_string_buffer(72)
+        self._der_len = ctypes.c_size_t()
+
+    def set_secretbytes(self, secret):
+        secret = bytes(secret)
+        pubkey = secp256k1.secp256k1_pubkey()
+        if len(secret) != 32 or not secp256k1.lib.secp256k1_ec_pubkey_create(secp256k1.ctx, ctypes.byref(pubkey), secret):
+            raise ValueError("Could not derive public key from the supplied secret.")
+        self.secret = secret
+        self.pubkey = pubkey
+        return self
+
+    def set_privkey(self, key):
+        secret = privkey_from_der(key)
+        if secret is None:
+            return 0
+        try:
+            self.set_secretbytes(secret)
+        except ValueError:
+            return 0
+        return 1
+
+    def set_pubkey(self, key):
+        pubkey = secp256k1.secp256k1_pubkey()
+        key = bytes(key)
+        if not secp256k1.lib.secp256k1_ec_pubkey_parse(secp256k1.ctx, ctypes.byref(pubkey), key, len(key)):
+            return 0
+        self.secret = None
+        self.pubkey = pubkey
+        self.compressed = len(key) == 33
+        return 1
+
+    def get_privkey(self):
+        return privkey_to_der(self.secret, self.get_pubkey())
+
+    def _serialize_pubkey(self, pubkey, compressed):
+        out = ctypes.create_string_buffer(65)
+        outlen = ctypes.c_size_t(65)
+        flags = secp256k1.SECP256K1_EC_COMPRESSED if compressed else secp256k1.SECP256K1_EC_UNCOMPRESSED
+        secp256k1.lib.secp256k1_ec_pubkey_serialize(secp256k1.ctx, out, ctypes.byref(outlen), ctypes.byref(pubkey), flags)
+        return out.raw[:outlen.value]
+
+    def get_pubkey(self):
+        if self.pubkey is None:
+            return b''
+        return self._serialize_pubkey(self.pubkey, self.compressed)
+
+    def get_raw_ecdh_key(self, other_pubkey):
+        # The x coordinate of secret * other's point, as ECDH_compute_key()
+        # returns without a KDF.
+        if self.secret is None:
+            raise ValueError('Key has no secret for ECDH')
+        point = secp256k1.secp256k1_pubkey()
+        ctypes.memmove(ctypes.byref(point), ctypes.byref(other_pubkey.pubkey), ctypes.sizeof(point))
+        if not secp256k1.lib.secp256k1_ec_pubkey_tweak_mul(secp256k1.ctx, ctypes.byref(point), self.secret):
+            raise Exception('CKey.get_ecdh_key(): secp256k1_ec_pubkey_tweak_mul() failed')
+        return self._serialize_pubkey(point, True)[1:]
+
+    def get_ecdh_key(self, other_pubkey, kdf=lambda k: hashlib.sha256(k).digest()):
+        r = self.get_raw_ecdh_key(other_pubkey)
+        return kdf(r)
+
+    def _check_can_sign(self, low_s):
+        # libsecp256k1 aborts the process on a NULL secret, so check first
+        if self.secret is None:
+            raise ValueError('Key has no secret to sign with')
+        if not low_s:
+            raise ValueError('libsecp256k1 only makes low-S signatures')
+
+    def sign(self, hash, low_s = True):
+        if not isinstance(hash, bytes):
+            raise TypeError('Hash must be bytes instance; got %r' % hash.__class__)
+        if len(hash) != 32:
+            raise ValueError('Hash must be exactly 32 bytes long')
+        self._check_can_sign(low_s)
+        return self._sign(hash)
+
+    def _sign(self, hash):
+        lib = secp256k1.lib
+        result = lib.secp256k1_ecdsa_sign(secp256k1.ctx, ctypes.byref(self._sig), hash, self.secret, None, None)
+        assert 1 == result
+        self._der_len.value = 72
+        lib.secp256k1_ecdsa_signature_serialize_der(secp256k1.ctx, self._der, ctypes.byref(self._der_len), ctypes.byref(self._sig))
+        return self._der.raw[:self._der_len.value]
+
+    def verify(self, hash, sig):
+        """Verify a DER signature"""
+        lib = secp256k1.lib
+        sig = bytes(sig)
+        if len(hash) != 32 or self.pubkey is None:
+            return False
+        if not lib.secp256k1_ecdsa_signature_parse_der(secp256k1.ctx, ctypes.byref(self._sig), sig, len(sig)):
+            return False
+        lib.secp256k1_ecdsa_signature_normalize(secp256k1.ctx, ctypes.byref(self._sig), ctypes.byref(self._sig))
+        return lib.secp256k1_ecdsa_verify(secp256k1.ctx, ctypes.byref(self._sig), bytes(hash), ctypes.byref(self.pubkey)) == 1
+
+    def sign_many(self, hashes, low_s = True):
+        """Sign a list of 32-byte hashes, returning a list of DER signatures"""
+        self._check_can_sign(low_s)
+        for hash in hashes:
+            if not isinstance(hash, bytes) or len(hash) != 32:
+                raise ValueError('Hashes must be 32-byte bytes instances')
+        return [self._sign(hash) for hash in hashes]
+
+    def verify_many(self, hashes, sigs):
+        """Verify a list of DER signatures, returning a list of bools"""
+        return [self.verify(hash, sig) for (hash, sig) in zip(hashes, sigs)]
+
+    def set_compressed(self, compressed):
+        self.compressed = compressed
+
+
+if secp256k1.lib is not None:
+    CECKey = Secp256k1ECKey
+else:
+    CECKey = OpenSSLECKey
+
+
 class CPubKey(bytes):
     """An encapsulated public key
 
@@ -223,6 +407,9 @@ class CPubKey(bytes):
     def verify(self, hash, sig):
         return self._cec_key.verify(hash, sig)
 
+    def verify_many(self, hashes, sigs):
+        return self._cec_key.verify_many(hashes, sigs)
+
     def __str__(self):
         return repr(self)
 
@@ -36,7 +36,7 @@ from threading import RLock
 from threading import Thread
 import logging
 import copy
-from test_framework.siphash import siphash256
+from test_framework.siphash import siphash256, siphash256_batch
 
 BIP0031_VERSION = 60000
 MY_VERSION = 70014  # past bip-31 for ping/pong
@@ -556,10 +556,12 @@ class CTxWitness(object):
     def serialize(self):
         r = b""
         # This is different than the usual vector serialization --
-        # we omit the length of the vector, which is required to be
-        # the same length as the transaction's vin vector.
+        # we omit the length of the vectors, which are required to be
+        # the same length as the transaction's vin and vout vectors.
         for x in self.vtxinwit:
             r += x.serialize()
+        for x in self.vtxoutwit:
+            r += x.serialize()
         return r
 
     def __repr__(self):
@@ -612,10 +614,12 @@ class CTransaction(object):
         self.sha256 = None
         self.hash = None
 
-    # Only applicable for non-CT, non-segwit transactions
+    # Elements always serializes the flags byte; without witness it is
+    # zero.  This is the serialization the txid commits to.
     def serialize_without_witness(self):
         r = b""
         r += struct.pack("<i", self.nVersion)
+        r += struct.pack("<B", 0)
         r += ser_vector(self.vin)
         r += ser_vector(self.vout)
         r += struct.pack("<I", self.nLockTime)
@@ -633,14 +637,15 @@ class CTransaction(object):
         r += ser_vector(self.vout)
         r += struct.pack("<I", self.nLockTime)
         if flags & 1:
+            # vtxinwit and vtxoutwit must have the same length as vin and vout
             if (len(self.wit.vtxinwit) != len(self.vin)):
-                # vtxinwit must have the same length as vin
                 self.wit.vtxinwit = self.wit.vtxinwit[:len(self.vin)]
                 for i in range(len(self.wit.vtxinwit), len(self.vin)):
                     self.wit.vtxinwit.append(CTxInWitness())
+            if (len(self.wit.vtxoutwit) != len(self.vout)):
                 self.wit.vtxoutwit = self.wit.vtxoutwit[:len(self.vout)]
                 for i in range(len(self.wit.vtxoutwit), len(self.vout)):
-                    self.wit.vtxoutwit.append(CTxInWitness())
+                    self.wit.vtxoutwit.append(CTxOutWitness())
             r += self.wit.serialize()
         return r
 
@@ -660,7 +665,7 @@ class CTransaction(object):
 
         if self.sha256 is None:
             self.sha256 = uint256_from_str(hash256(self.serialize_without_witness()))
-        self.hash = encode(hash256(self.serialize())[::-1], 'hex_codec').decode('ascii')
+        self.hash = encode(ser_uint256(self.sha256)[::-1], 'hex_codec').decode('ascii')
 
     def is_valid(self):
         self.calc_sha256()
@@ -770,14 +775,141 @@ class CBlockHeader(object):
                time.ctime(self.nTime), self.nHeight)
 
 
+class MerkleTree(object):
+    """Merkle tree with incremental updates
+
+    Leaves are uint256s.  Every level of the tree is kept (leaves first)
+    so that appending, replacing or truncating leaves only rehashes the
+    nodes above the changed leaves, the next time the root is asked for.
+    Odd levels pair their last node with itself, as in the block merkle
+    root.
+    """
+
+    def __init__(self, hashes=()):
+        self.leaves = []
+        self.levels = [[]]
+        self.dirty = set()
+        for h in hashes:
+            self.append(h)
+
+    def __len__(self):
+        return len(self.leaves)
+
+    def append(self, h):
+        self.dirty.add(len(self.leaves))
+        self.leaves.append(h)
+        self.levels[0].append(ser_uint256(h))
+
+    def replace(self, index, h):
+        if self.leaves[index] != h:
+            self.leaves[index] = h
+            self.levels[0][index] = ser_uint256(h)
+            self.dirty.add(index)
+
+    def truncate(self, n):
+        if n >= len(self.leaves):
+            return
+        del self.leaves[n:]
+        del self.levels[0][n:]
+        self.dirty = set(i for i in self.dirty if i < n)
+        if n > 0:
+            # The new last leaf may now be paired with itself
+            self.dirty.add(n - 1)
+
+    def update(self, hashes):
+        """Make the leaves equal to hashes, marking only changes dirty"""
+        self.truncate(len(hashes))
+        n = len(self.leaves)
+        # Usually the existing leaves are unchanged; compare them in bulk
+        if hashes[:n] != self.leaves:
+            for i in [i for (i, (a, b)) in enumerate(zip(hashes, self.leaves)) if a != b]:
+                self.replace(i, hashes[i])
+        for h in hashes[n:]:
+            self.append(h)
+
+    def _rehash(self):
+        dirty = self.dirty
+        level = 0
+        while len(self.levels[level]) > 1:
+            nodes = self.levels[level]
+            if level + 1 == len(self.levels):
+                self.levels.append([])
+            parents = self.levels[level + 1]
+            del parents[(len(nodes) + 1) // 2:]
+            dirty = sorted(set(i >> 1 for i in dirty))
+            for i in dirty:
+                left = nodes[2*i]
+                right = nodes[2*i+1] if 2*i+1 < len(nodes) else left
+                if i < len(parents):
+                    parents[i] = hash256(left + right)
+                else:
+                    parents.append(hash256(left + right))
+            level += 1
+        del self.levels[level+1:]
+        self.dirty = set()
+
+    def root(self):
+        """The merkle root as a uint256, 0 if there are no leaves"""
+        if not self.leaves:
+            return 0
+        if self.dirty:
+            self._rehash()
+        return uint256_from_str(self.levels[-1][0])
+
+
+class TxMerkleTree(MerkleTree):
+    """MerkleTree over a block's txids, or (witness=True) wtxids
+
+    sync() either hashes every transaction again and replaces the leaves
+    that changed, or, once the leaves are known to be good for the first
+    len(self) transactions (see CBlock.append_tx()), only hashes the
+    transactions appended since and truncates the leaves of any removed
+    from the end.
+    """
+
+    def __init__(self, witness=False):
+        super(TxMerkleTree, self).__init__()
+        self.witness = witness
+        self.synced = False
+
+    def tx_hash(self, index, tx):
+        if self.witness:
+            # For witness root purposes, the hash of the
+            # coinbase, with witness, is defined to be 0...0
+            if index == 0:
+                return 0
+            return tx.calc_sha256(True)
+        if tx.sha256 is None:
+            tx.calc_sha256()
+        return tx.sha256
+
+    def sync(self, vtx, incremental=False):
+        if incremental and self.synced:
+            self.truncate(len(vtx))
+            for i in range(len(self), len(vtx)):
+                self.append(self.tx_hash(i, vtx[i]))
+        else:
+            self.update([self.tx_hash(i, tx) for (i, tx) in enumerate(vtx)])
+        self.synced = incremental
+
+    def refresh(self, vtx, index):
+        if self.synced and index < len(self):
+            self.replace(index, self.tx_hash(index, vtx[index]))
+
+
 class CBlock(CBlockHeader):
     def __init__(self, header=None):
         super(CBlock, self).__init__(header)
         self.vtx = []
+        # Built on first use; see calc_merkle_root()
+        self.merkle_tree = None
+        self.witness_merkle_tree = None
+        self.merkle_incremental = False
 
     def deserialize(self, f):
         super(CBlock, self).deserialize(f)
         self.vtx = deser_vector(f, CTransaction)
+        self.invalidate_merkle()
 
     def serialize(self, with_witness=False):
         r = b""
@@ -798,23 +930,54 @@ class CBlock(CBlockHeader):
             hashes = newhashes
         return uint256_from_str(hashes[0])
 
+    # The trees are kept between calls, so recomputing the root after
+    # adding, replacing or removing transactions only rehashes the paths
+    # above the changes.  Every transaction is hashed again each time (with
+    # tx.sha256 trusted for the txid, as always), unless the block is built
+    # with append_tx().
     def calc_merkle_root(self):
-        hashes = []
-        for tx in self.vtx:
-            tx.calc_sha256()
-            hashes.append(ser_uint256(tx.sha256))
-        return self.get_merkle_root(hashes)
+        if self.merkle_tree is None:
+            self.merkle_tree = TxMerkleTree()
+        self.merkle_tree.sync(self.vtx, self.merkle_incremental)
+        return self.merkle_tree.root()
 
     def calc_witness_merkle_root(self):
-        # For witness root purposes, the hash of the
-        # coinbase, with witness, is defined to be 0...0
-        hashes = [ser_uint256(0)]
-
-        for tx in self.vtx[1:]:
-            # Calculate the hashes with witness data
-            hashes.append(ser_uint256(tx.calc_sha256(True)))
-
-        return self.get_merkle_root(hashes)
+        if self.witness_merkle_tree is None:
+            self.witness_merkle_tree = TxMerkleTree(witness=True)
+        self.witness_merkle_tree.sync(self.vtx, self.merkle_incremental)
+        return self.witness_merkle_tree.root()
+
+    def append_tx(self, tx):
+        """Add tx to the end of the block
+
+        From the first call on, calc_merkle_root() and
+        calc_witness_merkle_root() only hash the transactions added with
+        append_tx() since they were last called, and drop those removed
+        from the end of vtx.  Any other change to vtx, or to a transaction
+        already in it, must then be made with replace_tx() or followed by
+        invalidate_merkle().
+        """
+        for tree in (self.merkle_tree, self.witness_merkle_tree):
+            if tree is not None:
+                # Leaves past the end are for transactions since removed
+                tree.truncate(len(self.vtx))
+        self.vtx.append(tx)
+        self.merkle_incremental = True
+
+    def replace_tx(self, index, tx):
+        self.vtx[index] = tx
+        self.invalidate_merkle(index)
+
+    def invalidate_merkle(self, index=None):
+        """Hash vtx[index] again for the merkle roots (rehash() it first if
+        its txid changed), or with no index, all of vtx the next time"""
+        for tree in (self.merkle_tree, self.witness_merkle_tree):
+            if tree is None:
+                continue
+            if index is None:
+                tree.synced = False
+            else:
+                tree.refresh(self.vtx, index)
 
     def is_valid(self):
         self.calc_sha256()
@@ -842,6 +1005,309 @@ class CBlock(CBlockHeader):
                time.ctime(self.nTime), repr(self.vtx))
 
 
+# Parent chain (bitcoin) block header, as found in peg-in proofs
+class CBitcoinBlockHeader(object):
+    def __init__(self, header=None):
+        if header is None:
+            self.set_null()
+        else:
+            self.nVersion = header.nVersion
+            self.hashPrevBlock = header.hashPrevBlock
+            self.hashMerkleRoot = header.hashMerkleRoot
+            self.nTime = header.nTime
+            self.nBits = header.nBits
+            self.nNonce = header.nNonce
+            self.sha256 = header.sha256
+            self.hash = header.hash
+            self.calc_sha256()
+
+    def set_null(self):
+        self.nVersion = 1
+        self.hashPrevBlock = 0
+        self.hashMerkleRoot = 0
+        self.nTime = 0
+        self.nBits = 0
+        self.nNonce = 0
+        self.sha256 = None
+        self.hash = None
+
+    def deserialize(self, f):
+        self.nVersion = struct.unpack("<i", f.read(4))[0]
+        self.hashPrevBlock = deser_uint256(f)
+        self.hashMerkleRoot = deser_uint256(f)
+        self.nTime = struct.unpack("<I", f.read(4))[0]
+        self.nBits = struct.unpack("<I", f.read(4))[0]
+        self.nNonce = struct.unpack("<I", f.read(4))[0]
+        self.sha256 = None
+        self.hash = None
+
+    def serialize(self):
+        r = b""
+        r += struct.pack("<i", self.nVersion)
+        r += ser_uint256(self.hashPrevBlock)
+        r += ser_uint256(self.hashMerkleRoot)
+        r += struct.pack("<I", self.nTime)
+        r += struct.pack("<I", self.nBits)
+        r += struct.pack("<I", self.nNonce)
+        return r
+
+    def calc_sha256(self):
+        if self.sha256 is None:
+            h = hash256(self.serialize())
+            self.sha256 = uint256_from_str(h)
+            self.hash = encode(h[::-1], 'hex_codec').decode('ascii')
+
+    def rehash(self):
+        self.sha256 = None
+        self.calc_sha256()
+        return self.sha256
+
+    def __repr__(self):
+        return "CBitcoinBlockHeader(nVersion=%i hashPrevBlock=%064x hashMerkleRoot=%064x nTime=%s nBits=%08x nNonce=%08x)" \
+            % (self.nVersion, self.hashPrevBlock, self.hashMerkleRoot,
+               time.ctime(self.nTime), self.nBits, self.nNonce)
+
+
+# Partial merkle tree, as in merkleblock.h.  Build from all of a block's
+# txids and a list of which ones to match; extract_matches() checks one
+# the way CPartialMerkleTree::ExtractMatches() does.
+class CPartialMerkleTree(object):
+    def __init__(self, txids=None, matches=None):
+        self.nTransactions = 0
+        self.vHash = []
+        self.vBits = []
+        self.fBad = False
+        if txids is not None:
+            self.build(txids, matches)
+
+    def deserialize(self, f):
+        self.nTransactions = struct.unpack("<I", f.read(4))[0]
+        self.vHash = deser_uint256_vector(f)
+        vBytes = deser_string(f)
+        self.vBits = [(vBytes[i >> 3] >> (i & 7)) & 1 == 1 for i in range(len(vBytes) * 8)]
+        self.fBad = False
+
+    def serialize(self):
+        r = b""
+        r += struct.pack("<I", self.nTransactions)
+        r += ser_uint256_vector(self.vHash)
+        vBytes = bytearray((len(self.vBits) + 7) // 8)
+        for (i, bit) in enumerate(self.vBits):
+            if bit:
+                vBytes[i >> 3] |= 1 << (i & 7)
+        r += ser_string(bytes(vBytes))
+        return r
+
+    def calc_tree_width(self, height):
+        return (self.nTransactions + (1 << height) - 1) >> height
+
+    def calc_tree_height(self):
+        height = 0
+        while self.calc_tree_width(height) > 1:
+            height += 1
+        return height
+
+    def build(self, txids, matches):
+        if len(txids) == 0 or len(txids) != len(matches):
+            raise ValueError('need one match flag for each of at least one txid')
+        self.nTransactions = len(txids)
+        self.vHash = []
+        self.vBits = []
+        self.fBad = False
+        # Hash each level once, bottom up, rather than recursing for every
+        # stored hash as CalcHash() does; likewise for the match flags.
+        levels = [[ser_uint256(h) for h in txids]]
+        flags = [[bool(m) for m in matches]]
+        while len(levels[-1]) > 1:
+            nodes = levels[-1]
+            below = flags[-1]
+            last = len(nodes) - 1
+            levels.append([hash256(nodes[i] + nodes[min(i + 1, last)]) for i in range(0, len(nodes), 2)])
+            flags.append([below[i] or (i < last and below[i + 1]) for i in range(0, len(nodes), 2)])
+        self._traverse_and_build(len(levels) - 1, 0, levels, flags)
+
+    def _traverse_and_build(self, height, pos, levels, flags):
+        parent_of_match = flags[height][pos]
+        self.vBits.append(parent_of_match)
+        if height == 0 or not parent_of_match:
+            self.vHash.append(uint256_from_str(levels[height][pos]))
+        else:
+            self._traverse_and_build(height - 1, pos * 2, levels, flags)
+            if pos * 2 + 1 < len(levels[height - 1]):
+                self._traverse_and_build(height - 1, pos * 2 + 1, levels, flags)
+
+    def _traverse_and_extract(self, height, pos, used, hashes, matches, indices):
+        if used[0] >= len(self.vBits):
+            self.fBad = True
+            return ser_uint256(0)
+        parent_of_match = self.vBits[used[0]]
+        used[0] += 1
+        if height == 0 or not parent_of_match:
+            if used[1] >= len(hashes):
+                self.fBad = True
+                return ser_uint256(0)
+            h = hashes[used[1]]
+            used[1] += 1
+            if height == 0 and parent_of_match:
+                matches.append(self.vHash[used[1] - 1])
+                indices.append(pos)
+            return h
+        left = self._traverse_and_extract(height - 1, pos * 2, used, hashes, matches, indices)
+        if pos * 2 + 1 < self.calc_tree_width(height - 1):
+            right = self._traverse_and_extract(height - 1, pos * 2 + 1, used, hashes, matches, indices)
+            if right == left:
+                # Identical branches would mean duplicate txids
+                self.fBad = True
+        else:
+            right = left
+        return hash256(left + right)
+
+    def extract_matches(self):
+        """Return (merkle root, matched txids, their indices)
+
+        The root is 0 if the tree is malformed."""
+        matches = []
+        indices = []
+        if self.nTransactions == 0 or self.nTransactions > MAX_BLOCK_BASE_SIZE // 60:
+            return (0, [], [])
+        if len(self.vHash) > self.nTransactions or len(self.vBits) < len(self.vHash):
+            return (0, [], [])
+        self.fBad = False
+        used = [0, 0] # bits, hashes
+        hashes = [ser_uint256(h) for h in self.vHash]
+        root = self._traverse_and_extract(self.calc_tree_height(), 0, used, hashes, matches, indices)
+        if self.fBad or (used[0] + 7) // 8 != (len(self.vBits) + 7) // 8 or used[1] != len(hashes):
+            return (0, [], [])
+        return (uint256_from_str(root), matches, indices)
+
+    def __repr__(self):
+        return "CPartialMerkleTree(nTransactions=%d, vHash=%s, vBits=%s)" \
+            % (self.nTransactions, repr(self.vHash), repr(self.vBits))
+
+
+# What gettxoutproof returns: a block header and a partial merkle tree.
+class CMerkleBlock(object):
+    header_class = CBlockHeader
+
+    def __init__(self, header=None, txn=None):
+        self.header = header if header is not None else self.header_class()
+        self.txn = txn if txn is not None else CPartialMerkleTree()
+
+    @classmethod
+    def from_block(cls, block, txids):
+        """Proof that the txids (uint256s) in txids are in block"""
+        txids = set(txids)
+        hashes = []
+        for tx in block.vtx:
+            if tx.sha256 is None:
+                tx.calc_sha256()
+            hashes.append(tx.sha256)
+        return cls(cls.header_class(block), CPartialMerkleTree(hashes, [h in txids for h in hashes]))
+
+    def deserialize(self, f):
+        self.header.deserialize(f)
+        self.txn.deserialize(f)
+
+    def serialize(self):
+        r = b""
+        r += self.header.serialize()
+        r += self.txn.serialize()
+        return r
+
+    def verify(self):
+        """The txids proven to be in header's block, as verifytxoutproof
+        returns them, or None if the proof is invalid"""
+        (root, matches, indices) = self.txn.extract_matches()
+        if root == 0 or root != self.header.hashMerkleRoot:
+            return None
+        return matches
+
+    def __repr__(self):
+        return "CMerkleBlock(header=%s, txn=%s)" % (repr(self.header), repr(self.txn))
+
+
+class CBitcoinMerkleBlock(CMerkleBlock):
+    header_class = CBitcoinBlockHeader
+
+
+# parentChainPowLimit for -regtest and the elements chain (chainparams.cpp)
+REGTEST_PARENT_POW_LIMIT = 0x7fffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff
+ELEMENTS_PARENT_POW_LIMIT = 0x00000000ffffffffffffffffffffffffffffffffffffffffffffffffffffffff
+
+def check_bitcoin_proof(hash, nBits, pow_limit=REGTEST_PARENT_POW_LIMIT):
+    """CheckBitcoinProof(): whether hash meets the compact target nBits"""
+    size = nBits >> 24
+    word = nBits & 0x007fffff
+    if size <= 3:
+        target = word >> (8 * (3 - size))
+    else:
+        target = word << (8 * (size - 3))
+    negative = word != 0 and (nBits & 0x00800000) != 0
+    overflow = word != 0 and (size > 34 or (word > 0xff and size > 33) or (word > 0xffff and size > 32))
+    if negative or overflow or target == 0 or target > pow_limit:
+        return False
+    return hash <= target
+
+def bitcoin_txid(raw_tx):
+    """txid of a serialized parent chain (bitcoin) transaction"""
+    try:
+        return _bitcoin_txid(raw_tx)
+    except struct.error:
+        raise ValueError('malformed bitcoin transaction')
+
+def _bitcoin_txid(raw_tx):
+    f = BytesIO(raw_tx)
+    version = f.read(4)
+    segwit = raw_tx[4:6] == b'\x00\x01'
+    if segwit:
+        f.read(2)
+    start = f.tell()
+    n_inputs = deser_compact_size(f)
+    for i in range(n_inputs):
+        f.read(36)
+        deser_string(f)
+        f.read(4)
+    n_outputs = deser_compact_size(f)
+    for i in range(n_outputs):
+        f.read(8)
+        deser_string(f)
+    end = f.tell()
+    if segwit:
+        for i in range(n_inputs):
+            deser_string_vector(f)
+    locktime = f.read(4)
+    if len(locktime) != 4 or f.read(1) != b'':
+        raise ValueError('malformed bitcoin transaction')
+    return uint256_from_str(hash256(version + raw_tx[start:end] + locktime))
+
+def check_pegin_proof(txoutproof, bitcoin_tx, pow_limit=REGTEST_PARENT_POW_LIMIT):
+    """Pre-screen claimpegin's bitcoinTx and txoutproof (both raw bytes)
+
+    Makes the same proof checks claimpegin does: the proof parses
+    completely, its header meets its own target (within pow_limit) and it
+    proves exactly the given transaction.  Returns the bitcoin txid;
+    raises ValueError otherwise.  The peg-in output itself is not checked.
+    """
+    f = BytesIO(txoutproof)
+    merkle_block = CBitcoinMerkleBlock()
+    try:
+        merkle_block.deserialize(f)
+    except struct.error:
+        raise ValueError('malformed txoutproof')
+    if f.read(1) != b'':
+        raise ValueError('invalid txoutproof')
+    merkle_block.header.calc_sha256()
+    if not check_bitcoin_proof(merkle_block.header.sha256, merkle_block.header.nBits, pow_limit):
+        raise ValueError('invalid txoutproof')
+    matches = merkle_block.verify()
+    if matches is None:
+        raise ValueError('invalid txoutproof')
+    txid = bitcoin_txid(bitcoin_tx)
+    if matches != [txid]:
+        raise ValueError('txoutproof must contain bitcoinTx and only bitcoinTx')
+    return txid
+
+
 class CUnsignedAlert(object):
     def __init__(self):
         self.nVersion = 1
@@ -993,6 +1459,10 @@ def calculate_shortid(k0, k1, tx_hash):
     expected_shortid &= 0x0000ffffffffffff
     return expected_shortid
 
+# Same for a list of hashes, in one batch
+def calculate_shortids(k0, k1, tx_hashes):
+    return [h & 0x0000ffffffffffff for h in siphash256_batch(k0, k1, tx_hashes)]
+
 # This version gets rid of the array lengths, and reinterprets the differential
 # encoding into indices that can be used for lookup.
 class HeaderAndShortIDs(object):
@@ -1045,17 +1515,111 @@ class HeaderAndShortIDs(object):
         self.shortids = []
         self.use_witness = use_witness
         [k0, k1] = self.get_siphash_keys()
+        prefilled = set(prefill_list)
+        tx_hashes = []
         for i in range(len(block.vtx)):
-            if i not in prefill_list:
+            if i not in prefilled:
                 tx_hash = block.vtx[i].sha256
                 if use_witness:
                     tx_hash = block.vtx[i].calc_sha256(with_witness=True)
-                self.shortids.append(calculate_shortid(k0, k1, tx_hash))
+                tx_hashes.append(tx_hash)
+        self.shortids = calculate_shortids(k0, k1, tx_hashes)
 
     def __repr__(self):
         return "HeaderAndShortIDs(header=%s, nonce=%d, shortids=%s, prefilledtxn=%s" % (repr(self.header), self.nonce, repr(self.shortids), repr(self.prefilled_txn))
 
 
+# Receiver side of BIP 152, after PartiallyDownloadedBlock in
+# blockencodings.cpp: fill in a compact block from transactions we already
+# have, work out which ones to request with getblocktxn, and complete the
+# block from the blocktxn response.
+class PartiallyDownloadedBlock(object):
+    def __init__(self):
+        self.header = None
+        self.txn_available = []
+        self.prefilled_count = 0
+        self.mempool_count = 0
+
+    def init_data(self, header_and_shortids, mempool):
+        """Match header_and_shortids (a HeaderAndShortIDs) against mempool
+
+        mempool is an iterable of CTransaction.  Short IDs of all of them
+        are computed in one batch.  As in the node, a short ID matching more
+        than one candidate is left to be requested.  Returns False if the
+        compact block itself is invalid (eg duplicate short IDs).
+        """
+        cmpct = header_and_shortids
+        self.header = CBlockHeader(cmpct.header)
+        total = len(cmpct.shortids) + len(cmpct.prefilled_txn)
+        self.txn_available = [None] * total
+        for prefilled in cmpct.prefilled_txn:
+            if prefilled.index >= total or self.txn_available[prefilled.index] is not None:
+                return False
+            self.txn_available[prefilled.index] = prefilled.tx
+        self.prefilled_count = len(cmpct.prefilled_txn)
+
+        # Short ID -> block position, skipping over the prefilled slots
+        shortid_index = {}
+        shortids = iter(cmpct.shortids)
+        for i in range(total):
+            if self.txn_available[i] is None:
+                shortid_index[next(shortids)] = i
+        if len(shortid_index) != len(cmpct.shortids):
+            return False
+
+        mempool = list(mempool)
+        tx_hashes = []
+        for tx in mempool:
+            if cmpct.use_witness:
+                tx_hashes.append(tx.calc_sha256(with_witness=True))
+            else:
+                tx.calc_sha256()
+                tx_hashes.append(tx.sha256)
+        [k0, k1] = cmpct.get_siphash_keys()
+        matched = {}    # block position -> hash of the mempool tx put there
+        collided = set()
+        for (tx, tx_hash, shortid) in zip(mempool, tx_hashes, calculate_shortids(k0, k1, tx_hashes)):
+            i = shortid_index.get(shortid)
+            if i is None or i in collided:
+                continue
+            if self.txn_available[i] is None:
+                self.txn_available[i] = tx
+                matched[i] = tx_hash
+                self.mempool_count += 1
+            elif matched[i] != tx_hash:
+                self.txn_available[i] = None
+                self.mempool_count -= 1
+                collided.add(i)
+        return True
+
+    def is_tx_available(self, index):
+        return self.txn_available[index] is not None
+
+    def get_missing(self):
+        """Indexes to put in a BlockTransactionsRequest"""
+        return [i for (i, tx) in enumerate(self.txn_available) if tx is None]
+
+    def fill_block(self, vtx_missing):
+        """Complete the block with the transactions from blocktxn
+
+        Returns the CBlock, or None if vtx_missing doesn't fit the gaps or
+        the result doesn't match the header's merkle root.
+        """
+        missing = self.get_missing()
+        if len(vtx_missing) != len(missing):
+            return None
+        block = CBlock(self.header)
+        block.vtx = list(self.txn_available)
+        for (i, tx) in zip(missing, vtx_missing):
+            block.vtx[i] = tx
+        for tx in block.vtx:
+            tx.calc_sha256()
+        if block.calc_merkle_root() != self.header.hashMerkleRoot:
+            return None
+        block.calc_sha256()
+        return block
+
+
 class BlockTransactionsRequest(object):
 
     def __init__(self, blockhash=0, indexes = None):
@@ -1792,7 +2356,8 @@ class NodeConn(asyncore.dispatcher):
     MAGIC_BYTES = {
         "mainnet": b"\xf9\xbe\xb4\xd9",   # mainnet
         "testnet3": b"\x0b\x11\x09\x07",  # testnet3
-        "regtest": b"\xfa\xbf\xb5\xda",   # regtest
+        "regtest": b"\xfa\xbf\xb5\xda",   # regtest, and custom chains
+        "elements": b"\xef\xb1\x1f\xea",  # chain=elements
     }
 
     def __init__(self, dstaddr, dstport, rpc, callback, net="regtest", services=NODE_NETWORK, send_version=True):
@@ -0,0 +1,64 @@
+# Wait for daemons to be ready (or gone) instead of sleeping for a guessed number of seconds.
+#
+# start_node runs the daemon in the foreground (-daemon=0, whatever the config file says) so that we hold its process,
+# then polls RPC until it answers: connection refused means it isn't listening yet, and error -28 means it is still
+# warming up (loading blocks, or waiting for bitcoind to validate pegins). If the process exits first, that is an error.
+# stop_node asks it to stop over RPC and waits for the process to exit, so its datadir can be reused or removed
+# straight away.
+
+from .authproxy import AuthServiceProxy, JSONRPCException
+import http.client
+import subprocess
+import time
+
+RPC_IN_WARMUP = -28
+POLL_INTERVAL = 0.05
+
+processes = {}  # rpc url -> subprocess.Popen, for the nodes started here
+
+class DaemonExitedError(Exception):
+    """The daemon exited before it was ready"""
+
+def wait_for_rpc(url, process=None, timeout=60):
+    # Returns a proxy once the node at url has finished starting up
+    deadline = time.time() + timeout
+    while True:
+        if process is not None and process.poll() is not None:
+            raise DaemonExitedError("daemon exited with status %i during initialization" % process.returncode)
+        try:
+            rpc = AuthServiceProxy(url)
+            rpc.getblockcount()
+            return rpc
+        except (OSError, http.client.HTTPException):
+            pass  # Port not yet open, or closed on us while starting
+        except JSONRPCException as e:
+            if e.error["code"] != RPC_IN_WARMUP:
+                raise
+        if time.time() > deadline:
+            raise Exception("daemon at %s not ready after %ds" % (url.split("@")[-1], timeout))
+        time.sleep(POLL_INTERVAL)
+
+def start_node(cmdline, url, timeout=60):
+    # cmdline is the daemon and its arguments, as a list
+    process = subprocess.Popen(cmdline + ["-daemon=0"], stdout=subprocess.DEVNULL)
+    processes[url] = process
+    return wait_for_rpc(url, process, timeout)
+
+def wait_for_exit(url, timeout=60):
+    # Wait for a node started with start_node to exit by itself; returns its exit status
+    process = processes.pop(url)
+    return process.wait(timeout=timeout)
+
+def stop_node(url, timeout=60):
+    try:
+        AuthServiceProxy(url).stop()
+    except (OSError, http.client.HTTPException):
+        pass  # Already on its way out
+    return wait_for_exit(url, timeout)
+
+def wait_for_peers(rpc, count=1, timeout=60):
+    deadline = time.time() + timeout
+    while rpc.getconnectioncount() < count:
+        if time.time() > deadline:
+            raise Exception("fewer than %d peers after %ds" % (count, timeout))
+        time.sleep(POLL_INTERVAL)
@@ -15,8 +15,10 @@ Functionality to build scripts, as well as SignatureHash().
 """
 
 
-from .mininode import CTransaction, CTxOut, sha256, hash256, uint256_from_str, ser_uint256, ser_string
+from .mininode import CTxOutValue, sha256, hash256, ser_string, ser_compact_size
 from binascii import hexlify
+from array import array
+import bisect
 import hashlib
 
 import sys
@@ -701,6 +703,19 @@ class CScript(bytes):
             # returns a bytes instance even when subclassed.
             return super(CScript, cls).__new__(cls, b''.join(coerce_iterable(value)))
 
+    def tokens(self):
+        """Decoded opcodes of the script (a CScriptTokens)
+
+        The script is decoded once; since CScript is immutable the result is
+        cached on the instance and shared by raw_iter(), iter(),
+        GetSigOpCount() and FindAndDelete().
+        """
+        try:
+            return self._tokens
+        except AttributeError:
+            self._tokens = CScriptTokens(self)
+            return self._tokens
+
     def raw_iter(self):
         """Raw iteration
 
@@ -708,55 +723,14 @@ class CScript(bytes):
         PUSHDATA encodings can be accurately distinguished, as well as
         determining the exact opcode byte indexes. (sop_idx)
         """
-        i = 0
-        while i < len(self):
-            sop_idx = i
-            opcode = bord(self[i])
-            i += 1
-
+        tokens = self.tokens()
+        for (opcode, sop_idx, data_start, data_end) in zip(tokens.opcodes, tokens.offsets,
+                                                             tokens.data_start, tokens.data_end):
             if opcode > OP_PUSHDATA4:
                 yield (opcode, None, sop_idx)
             else:
-                datasize = None
-                pushdata_type = None
-                if opcode < OP_PUSHDATA1:
-                    pushdata_type = 'PUSHDATA(%d)' % opcode
-                    datasize = opcode
-
-                elif opcode == OP_PUSHDATA1:
-                    pushdata_type = 'PUSHDATA1'
-                    if i >= len(self):
-                        raise CScriptInvalidError('PUSHDATA1: missing data length')
-                    datasize = bord(self[i])
-                    i += 1
-
-                elif opcode == OP_PUSHDATA2:
-                    pushdata_type = 'PUSHDATA2'
-                    if i + 1 >= len(self):
-                        raise CScriptInvalidError('PUSHDATA2: missing data length')
-                    datasize = bord(self[i]) + (bord(self[i+1]) << 8)
-                    i += 2
-
-                elif opcode == OP_PUSHDATA4:
-                    pushdata_type = 'PUSHDATA4'
-                    if i + 3 >= len(self):
-                        raise CScriptInvalidError('PUSHDATA4: missing data length')
-                    datasize = bord(self[i]) + (bord(self[i+1]) << 8) + (bord(self[i+2]) << 16) + (bord(self[i+3]) << 24)
-                    i += 4
-
-                else:
-                    assert False # shouldn't happen
-
-
-                data = bytes(self[i:i+datasize])
-
-                # Check for truncation
-                if len(data) < datasize:
-                    raise CScriptTruncatedPushDataError('%s: truncated data' % pushdata_type, data)
-
-                i += datasize
-
-                yield (opcode, data, sop_idx)
+                yield (opcode, self[data_start:data_end], sop_idx)
+        tokens.raise_error()
 
     def __iter__(self):
         """'Cooked' iteration
@@ -779,11 +753,10 @@ class CScript(bytes):
                     yield CScriptOp(opcode)
 
     def __repr__(self):
-        # For Python3 compatibility add b before strings so testcases don't
-        # need to change
+        # Pushed data is shown as x('<hex>'), as in python-bitcoinlib
         def _repr(o):
             if isinstance(o, bytes):
-                return b"x('%s')" % hexlify(o).decode('ascii')
+                return "x('%s')" % hexlify(o).decode('ascii')
             else:
                 return repr(o)
 
@@ -812,136 +785,315 @@ class CScript(bytes):
 
         fAccurate - Accurately count CHECKMULTISIG, see BIP16 for details.
 
-        Note that this is consensus-critical.
+        Note that this is consensus-critical.  As in CScript::GetSigOpCount(),
+        counting stops (without error) at an undecodable opcode.
         """
-        n = 0
-        lastOpcode = OP_INVALIDOPCODE
-        for (opcode, data, sop_idx) in self.raw_iter():
-            if opcode in (OP_CHECKSIG, OP_CHECKSIGVERIFY):
-                n += 1
-            elif opcode in (OP_CHECKMULTISIG, OP_CHECKMULTISIGVERIFY):
-                if fAccurate and (OP_1 <= lastOpcode <= OP_16):
-                    n += opcode.decode_op_n()
-                else:
-                    n += 20
-            lastOpcode = opcode
+        # None of the sigop opcodes appear anywhere in the script
+        if not (b'\xac' in self or b'\xad' in self or b'\xae' in self or b'\xaf' in self):
+            return 0
+        opcodes = self.tokens().opcodes
+        n = opcodes.count(OP_CHECKSIG) + opcodes.count(OP_CHECKSIGVERIFY)
+        if OP_CHECKMULTISIG in opcodes or OP_CHECKMULTISIGVERIFY in opcodes:
+            lastOpcode = OP_INVALIDOPCODE
+            for opcode in opcodes:
+                if opcode == OP_CHECKMULTISIG or opcode == OP_CHECKMULTISIGVERIFY:
+                    if fAccurate and (OP_1 <= lastOpcode <= OP_16):
+                        n += CScriptOp(lastOpcode).decode_op_n()
+                    else:
+                        n += 20
+                lastOpcode = opcode
         return n
 
 
+class CScriptTokens(object):
+    """Compact decoding of a script
+
+    Parallel arrays holding, for each opcode, the opcode itself, its byte
+    offset in the script and the [start, end) byte range of its pushed data
+    (empty for non-push opcodes).  If the script ends in an undecodable
+    opcode, the opcodes before it are kept and the error is re-raised by
+    raise_error().
+    """
+    __slots__ = ('opcodes', 'offsets', 'data_start', 'data_end', 'error')
+
+    def __init__(self, script):
+        opcodes = self.opcodes = array('B')
+        offsets = self.offsets = array('I')
+        data_start = self.data_start = array('I')
+        data_end = self.data_end = array('I')
+        self.error = None
+
+        n = len(script)
+        i = 0
+        while i < n:
+            sop_idx = i
+            opcode = script[i]
+            i += 1
+
+            if opcode > OP_PUSHDATA4:
+                start = end = i
+            else:
+                if opcode < OP_PUSHDATA1:
+                    datasize = opcode
+                elif opcode == OP_PUSHDATA1:
+                    if i >= n:
+                        self.error = (CScriptInvalidError, 'PUSHDATA1: missing data length', None)
+                        break
+                    datasize = script[i]
+                    i += 1
+                elif opcode == OP_PUSHDATA2:
+                    if i + 1 >= n:
+                        self.error = (CScriptInvalidError, 'PUSHDATA2: missing data length', None)
+                        break
+                    datasize = script[i] + (script[i+1] << 8)
+                    i += 2
+                else:
+                    if i + 3 >= n:
+                        self.error = (CScriptInvalidError, 'PUSHDATA4: missing data length', None)
+                        break
+                    datasize = struct.unpack_from('<I', script, i)[0]
+                    i += 4
+
+                start = i
+                end = i + datasize
+                if end > n:
+                    if opcode < OP_PUSHDATA1:
+                        pushdata_type = 'PUSHDATA(%d)' % opcode
+                    else:
+                        pushdata_type = 'PUSHDATA%d' % {OP_PUSHDATA1: 1, OP_PUSHDATA2: 2, OP_PUSHDATA4: 4}[opcode]
+                    self.error = (CScriptTruncatedPushDataError, '%s: truncated data' % pushdata_type, bytes(script[start:n]))
+                    break
+                i = end
+
+            opcodes.append(opcode)
+            offsets.append(sop_idx)
+            data_start.append(start)
+            data_end.append(end)
+
+    def raise_error(self):
+        if self.error is not None:
+            (cls, msg, data) = self.error
+            if data is None:
+                raise cls(msg)
+            raise cls(msg, data)
+
+
 SIGHASH_ALL = 1
 SIGHASH_NONE = 2
 SIGHASH_SINGLE = 3
 SIGHASH_ANYONECANPAY = 0x80
 
+ZERO_HASH = b'\x00' * 32
+
 def FindAndDelete(script, sig):
     """Consensus critical, see FindAndDelete() in Satoshi codebase"""
-    r = b''
-    last_sop_idx = sop_idx = 0
-    skip = True
-    for (opcode, data, sop_idx) in script.raw_iter():
-        if not skip:
-            r += script[last_sop_idx:sop_idx]
-        last_sop_idx = sop_idx
-        if script[sop_idx:sop_idx + len(sig)] == sig:
-            skip = True
+    if not isinstance(script, CScript):
+        script = CScript(script)
+    tokens = script.tokens()
+    tokens.raise_error()
+    offsets = tokens.offsets
+
+    # Only look at the opcodes that sig actually occurs at; the opcode at
+    # each such offset is dropped.
+    r = []
+    last = 0
+    pos = script.find(sig) if len(sig) else -1
+    while pos != -1:
+        k = bisect.bisect_left(offsets, pos)
+        if k < len(offsets) and offsets[k] == pos:
+            r.append(script[last:pos])
+            last = offsets[k+1] if k + 1 < len(offsets) else len(script)
+            pos = script.find(sig, last)
         else:
-            skip = False
-    if not skip:
-        r += script[last_sop_idx:]
-    return CScript(r)
+            pos = script.find(sig, pos + 1)
+    r.append(script[last:])
+    return CScript(b''.join(r))
 
 
-def SignatureHash(script, txTo, inIdx, hashtype):
+# Serialization of a null CTxOut (null asset, value and nonce, empty script)
+NULL_TXOUT_SERIALIZED = b'\x00\x00\x00\x00'
+
+HASH_ONE = b'\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+class PrecomputedTransactionData(object):
+    """Per-transaction data shared by the signature hashes of all inputs
+
+    Corresponds to PrecomputedTransactionData in interpreter.cpp (the BIP143
+    hashPrevouts/hashSequence/hashIssuance/hashOutputs midstates), plus the
+    pre-serialized inputs and outputs that SignatureHash() splices the
+    scriptCode into.  Everything is computed lazily, on first use.
+
+    The transaction must not be modified while the cache is in use, other
+    than its scriptSigs and witnesses (which are never signed).
+    """
+    def __init__(self, txTo):
+        self.txTo = txTo
+        self._prevouts = None
+        self._sequences = None
+        self._outputs = None
+        self._blank_inputs = None
+        self._blank_inputs_nosequence = None
+        self._all_outputs = None
+        self._hashPrevouts = None
+        self._hashSequence = None
+        self._hashIssuance = None
+        self._hashOutputs = None
+        self._script_codes = {}
+
+    def prevouts(self):
+        if self._prevouts is None:
+            self._prevouts = [i.prevout.serialize() for i in self.txTo.vin]
+        return self._prevouts
+
+    def sequences(self):
+        if self._sequences is None:
+            self._sequences = [struct.pack("<I", i.nSequence) for i in self.txTo.vin]
+        return self._sequences
+
+    def outputs(self):
+        if self._outputs is None:
+            self._outputs = [o.serialize() for o in self.txTo.vout]
+        return self._outputs
+
+    def hashPrevouts(self):
+        if self._hashPrevouts is None:
+            self._hashPrevouts = hash256(b''.join(self.prevouts()))
+        return self._hashPrevouts
+
+    def hashSequence(self):
+        if self._hashSequence is None:
+            self._hashSequence = hash256(b''.join(self.sequences()))
+        return self._hashSequence
+
+    def hashIssuance(self):
+        # CTxIn has no asset issuance in this framework, so every input
+        # contributes a null issuance (a single zero byte).
+        if self._hashIssuance is None:
+            self._hashIssuance = hash256(b'\x00' * len(self.txTo.vin))
+        return self._hashIssuance
+
+    def hashOutputs(self):
+        if self._hashOutputs is None:
+            self._hashOutputs = hash256(b''.join(self.outputs()))
+        return self._hashOutputs
+
+    def script_code(self, script):
+        """Serialized scriptCode with OP_CODESEPARATORs removed"""
+        r = self._script_codes.get(script)
+        if r is None:
+            script_code = script
+            if bchr(OP_CODESEPARATOR) in script:
+                script_code = FindAndDelete(CScript(script), CScript([OP_CODESEPARATOR]))
+            r = ser_string(script_code)
+            self._script_codes[script] = r
+        return r
+
+    def blank_inputs(self, keep_sequence):
+        """Inputs as serialized for the legacy sighash, with empty scripts"""
+        if keep_sequence:
+            if self._blank_inputs is None:
+                self._blank_inputs = [p + b'\x00' + n for (p, n) in zip(self.prevouts(), self.sequences())]
+            return self._blank_inputs
+        if self._blank_inputs_nosequence is None:
+            self._blank_inputs_nosequence = [p + b'\x00\x00\x00\x00\x00' for p in self.prevouts()]
+        return self._blank_inputs_nosequence
+
+    def all_outputs(self):
+        if self._all_outputs is None:
+            self._all_outputs = ser_compact_size(len(self.txTo.vout)) + b''.join(self.outputs())
+        return self._all_outputs
+
+def SignatureHash(script, txTo, inIdx, hashtype, cache=None):
     """Consensus-correct SignatureHash
 
     Returns (hash, err) to precisely match the consensus-critical behavior of
     the SIGHASH_SINGLE bug. (inIdx is *not* checked for validity)
-    """
-    HASH_ONE = b'\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
 
+    Serializes like CTransactionSignatureSerializer, substituting the
+    scriptCode, blanked scriptSigs and (for NONE/SINGLE) nSequences while
+    writing rather than copying the transaction.  Pass the same
+    PrecomputedTransactionData as cache when hashing several inputs of one
+    transaction.
+    """
     if inIdx >= len(txTo.vin):
         return (HASH_ONE, "inIdx %d out of range (%d)" % (inIdx, len(txTo.vin)))
-    txtmp = CTransaction(txTo)
-
-    for txin in txtmp.vin:
-        txin.scriptSig = b''
-    txtmp.vin[inIdx].scriptSig = FindAndDelete(script, CScript([OP_CODESEPARATOR]))
 
-    if (hashtype & 0x1f) == SIGHASH_NONE:
-        txtmp.vout = []
+    base_type = hashtype & 0x1f
+    if base_type == SIGHASH_SINGLE and inIdx >= len(txTo.vout):
+        return (HASH_ONE, "outIdx %d out of range (%d)" % (inIdx, len(txTo.vout)))
 
-        for i in range(len(txtmp.vin)):
-            if i != inIdx:
-                txtmp.vin[i].nSequence = 0
-
-    elif (hashtype & 0x1f) == SIGHASH_SINGLE:
-        outIdx = inIdx
-        if outIdx >= len(txtmp.vout):
-            return (HASH_ONE, "outIdx %d out of range (%d)" % (outIdx, len(txtmp.vout)))
-
-        tmp = txtmp.vout[outIdx]
-        txtmp.vout = []
-        for i in range(outIdx):
-            txtmp.vout.append(CTxOut(-1))
-        txtmp.vout.append(tmp)
-
-        for i in range(len(txtmp.vin)):
-            if i != inIdx:
-                txtmp.vin[i].nSequence = 0
+    if cache is None:
+        cache = PrecomputedTransactionData(txTo)
+    prevouts = cache.prevouts()
+    sequences = cache.sequences()
+    signed_input = prevouts[inIdx] + cache.script_code(script) + sequences[inIdx]
 
+    s = [struct.pack("<i", txTo.nVersion)]
     if hashtype & SIGHASH_ANYONECANPAY:
-        tmp = txtmp.vin[inIdx]
-        txtmp.vin = []
-        txtmp.vin.append(tmp)
-
-    s = txtmp.serialize()
-    s += struct.pack(b"<I", hashtype)
+        s.append(b'\x01')
+        s.append(signed_input)
+    else:
+        blank_inputs = cache.blank_inputs(base_type != SIGHASH_NONE and base_type != SIGHASH_SINGLE)
+        s.append(ser_compact_size(len(txTo.vin)))
+        s.extend(blank_inputs[:inIdx])
+        s.append(signed_input)
+        s.extend(blank_inputs[inIdx+1:])
+
+    if base_type == SIGHASH_NONE:
+        s.append(b'\x00')
+    elif base_type == SIGHASH_SINGLE:
+        s.append(ser_compact_size(inIdx + 1))
+        s.append(NULL_TXOUT_SERIALIZED * inIdx)
+        s.append(cache.outputs()[inIdx])
+    else:
+        s.append(cache.all_outputs())
+
+    s.append(struct.pack("<I", txTo.nLockTime))
+    s.append(struct.pack("<I", hashtype))
+
+    return (hash256(b''.join(s)), None)
 
-    hash = hash256(s)
+# Note that this corresponds to sigversion == 1 in EvalScript, which is used
+# for version 0 witnesses.  amount is the spent output's value: an int, a
+# CTxOutValue or a serialized (possibly confidential) value commitment.
+def SegwitVersion1SignatureHash(script, txTo, inIdx, hashtype, amount, cache=None):
+    if cache is None:
+        cache = PrecomputedTransactionData(txTo)
+
+    hashPrevouts = ZERO_HASH
+    hashSequence = ZERO_HASH
+    hashIssuance = ZERO_HASH
+    hashOutputs = ZERO_HASH
+    base_type = hashtype & 0x1f
 
-    return (hash, None)
+    if not (hashtype & SIGHASH_ANYONECANPAY):
+        hashPrevouts = cache.hashPrevouts()
+        hashIssuance = cache.hashIssuance()
 
-# TODO: Allow cached hashPrevouts/hashSequence/hashOutputs to be provided.
-# Performance optimization probably not necessary for python tests, however.
-# Note that this corresponds to sigversion == 1 in EvalScript, which is used
-# for version 0 witnesses.
-def SegwitVersion1SignatureHash(script, txTo, inIdx, hashtype, amount):
+    if (not (hashtype & SIGHASH_ANYONECANPAY) and base_type != SIGHASH_SINGLE and base_type != SIGHASH_NONE):
+        hashSequence = cache.hashSequence()
 
-    hashPrevouts = 0
-    hashSequence = 0
-    hashOutputs = 0
+    if (base_type != SIGHASH_SINGLE and base_type != SIGHASH_NONE):
+        hashOutputs = cache.hashOutputs()
+    elif (base_type == SIGHASH_SINGLE and inIdx < len(txTo.vout)):
+        hashOutputs = hash256(cache.outputs()[inIdx])
 
-    if not (hashtype & SIGHASH_ANYONECANPAY):
-        serialize_prevouts = bytes()
-        for i in txTo.vin:
-            serialize_prevouts += i.prevout.serialize()
-        hashPrevouts = uint256_from_str(hash256(serialize_prevouts))
-
-    if (not (hashtype & SIGHASH_ANYONECANPAY) and (hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
-        serialize_sequence = bytes()
-        for i in txTo.vin:
-            serialize_sequence += struct.pack("<I", i.nSequence)
-        hashSequence = uint256_from_str(hash256(serialize_sequence))
-
-    if ((hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
-        serialize_outputs = bytes()
-        for o in txTo.vout:
-            serialize_outputs += o.serialize()
-        hashOutputs = uint256_from_str(hash256(serialize_outputs))
-    elif ((hashtype & 0x1f) == SIGHASH_SINGLE and inIdx < len(txTo.vout)):
-        serialize_outputs = txTo.vout[inIdx].serialize()
-        hashOutputs = uint256_from_str(hash256(serialize_outputs))
+    if isinstance(amount, int):
+        amount = CTxOutValue(amount)
+    if not isinstance(amount, bytes):
+        amount = amount.serialize()
 
     ss = bytes()
     ss += struct.pack("<i", txTo.nVersion)
-    ss += ser_uint256(hashPrevouts)
-    ss += ser_uint256(hashSequence)
-    ss += txTo.vin[inIdx].prevout.serialize()
+    ss += hashPrevouts
+    ss += hashSequence
+    ss += hashIssuance
+    ss += cache.prevouts()[inIdx]
     ss += ser_string(script)
-    ss += struct.pack("<q", amount)
-    ss += struct.pack("<I", txTo.vin[inIdx].nSequence)
-    ss += ser_uint256(hashOutputs)
-    ss += struct.pack("<i", txTo.nLockTime)
+    ss += amount
+    ss += cache.sequences()[inIdx]
+    ss += hashOutputs
+    ss += struct.pack("<I", txTo.nLockTime)
     ss += struct.pack("<I", hashtype)
 
     return hash256(ss)
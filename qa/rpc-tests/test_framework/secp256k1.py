@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Elements Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+#
+# secp256k1.py - ctypes bindings for the bundled libsecp256k1
+#
+# The node links src/secp256k1 statically, so a shared library has to be
+# built separately to use these bindings, eg:
+#
+#   cd src/secp256k1
+#   ./configure --enable-shared --enable-experimental --enable-module-ecdh \
+#       --enable-module-generator --enable-module-rangeproof \
+#       --enable-module-surjectionproof
+#   make
+#
+# The library is looked for at $SECP256K1_LIB, then in src/secp256k1/.libs,
+# then on the system library path.  If it can't be found, lib and ctx are
+# None and callers fall back to other implementations.
+#
+# One context, created for both signing and verification and randomized
+# once at load time, is shared by all users of the module.
+#
+
+import ctypes
+import ctypes.util
+import os
+
+SECP256K1_CONTEXT_VERIFY = (1 << 0) | (1 << 8)
+SECP256K1_CONTEXT_SIGN = (1 << 0) | (1 << 9)
+SECP256K1_EC_COMPRESSED = (1 << 1) | (1 << 8)
+SECP256K1_EC_UNCOMPRESSED = (1 << 1)
+
+# Opaque structures; sizes from include/secp256k1.h
+class secp256k1_pubkey(ctypes.Structure):
+    _fields_ = [("data", ctypes.c_ubyte * 64)]
+
+class secp256k1_ecdsa_signature(ctypes.Structure):
+    _fields_ = [("data", ctypes.c_ubyte * 64)]
+
+# From include/secp256k1_generator.h, secp256k1_rangeproof.h and
+# secp256k1_surjectionproof.h (as built without VERIFY)
+SECP256K1_SURJECTIONPROOF_MAX_N_INPUTS = 256
+
+class secp256k1_generator(ctypes.Structure):
+    _fields_ = [("data", ctypes.c_ubyte * 33)]
+
+class secp256k1_pedersen_commitment(ctypes.Structure):
+    _fields_ = [("data", ctypes.c_ubyte * 33)]
+
+class secp256k1_fixed_asset_tag(ctypes.Structure):
+    _fields_ = [("data", ctypes.c_ubyte * 32)]
+
+class secp256k1_surjectionproof(ctypes.Structure):
+    _fields_ = [("n_inputs", ctypes.c_size_t),
+                ("used_inputs", ctypes.c_ubyte * (SECP256K1_SURJECTIONPROOF_MAX_N_INPUTS // 8)),
+                ("data", ctypes.c_ubyte * (32 * (1 + SECP256K1_SURJECTIONPROOF_MAX_N_INPUTS)))]
+
+def find_library():
+    candidates = []
+    if os.getenv("SECP256K1_LIB"):
+        candidates.append(os.getenv("SECP256K1_LIB"))
+    libs_dir = os.path.normpath(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                             "../../../src/secp256k1/.libs"))
+    candidates += [os.path.join(libs_dir, name) for name in
+                   ("libsecp256k1.so", "libsecp256k1.dylib", "libsecp256k1-0.dll")]
+    system_lib = ctypes.util.find_library("secp256k1")
+    if system_lib:
+        candidates.append(system_lib)
+    for path in candidates:
+        try:
+            return ctypes.cdll.LoadLibrary(path)
+        except OSError:
+            continue
+    return None
+
+def _declare(lib, name, restype, argtypes):
+    func = getattr(lib, name)
+    func.restype = restype
+    func.argtypes = argtypes
+
+def _declare_core(lib):
+    c_void_p, c_int, c_char_p, c_size_t = ctypes.c_void_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t
+    P = ctypes.POINTER
+    _declare(lib, "secp256k1_context_create", c_void_p, [ctypes.c_uint])
+    _declare(lib, "secp256k1_context_randomize", c_int, [c_void_p, c_char_p])
+    _declare(lib, "secp256k1_ec_seckey_verify", c_int, [c_void_p, c_char_p])
+    _declare(lib, "secp256k1_ec_pubkey_create", c_int, [c_void_p, P(secp256k1_pubkey), c_char_p])
+    _declare(lib, "secp256k1_ec_pubkey_parse", c_int, [c_void_p, P(secp256k1_pubkey), c_char_p, c_size_t])
+    _declare(lib, "secp256k1_ec_pubkey_serialize", c_int,
+             [c_void_p, c_char_p, P(c_size_t), P(secp256k1_pubkey), ctypes.c_uint])
+    _declare(lib, "secp256k1_ec_pubkey_tweak_mul", c_int, [c_void_p, P(secp256k1_pubkey), c_char_p])
+    _declare(lib, "secp256k1_ecdsa_sign", c_int,
+             [c_void_p, P(secp256k1_ecdsa_signature), c_char_p, c_char_p, c_void_p, c_void_p])
+    _declare(lib, "secp256k1_ecdsa_verify", c_int,
+             [c_void_p, P(secp256k1_ecdsa_signature), c_char_p, P(secp256k1_pubkey)])
+    _declare(lib, "secp256k1_ecdsa_signature_parse_der", c_int,
+             [c_void_p, P(secp256k1_ecdsa_signature), c_char_p, c_size_t])
+    _declare(lib, "secp256k1_ecdsa_signature_serialize_der", c_int,
+             [c_void_p, c_char_p, P(c_size_t), P(secp256k1_ecdsa_signature)])
+    _declare(lib, "secp256k1_ecdsa_signature_normalize", c_int,
+             [c_void_p, P(secp256k1_ecdsa_signature), P(secp256k1_ecdsa_signature)])
+
+def _declare_generator(lib):
+    c_void_p, c_int, c_char_p = ctypes.c_void_p, ctypes.c_int, ctypes.c_char_p
+    P = ctypes.POINTER
+    _declare(lib, "secp256k1_generator_parse", c_int, [c_void_p, P(secp256k1_generator), c_char_p])
+    _declare(lib, "secp256k1_generator_serialize", c_int, [c_void_p, c_char_p, P(secp256k1_generator)])
+    _declare(lib, "secp256k1_generator_generate", c_int, [c_void_p, P(secp256k1_generator), c_char_p])
+    _declare(lib, "secp256k1_generator_generate_blinded", c_int,
+             [c_void_p, P(secp256k1_generator), c_char_p, c_char_p])
+
+def _declare_rangeproof(lib):
+    c_void_p, c_int, c_char_p, c_size_t, c_uint64 = \
+        ctypes.c_void_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t, ctypes.c_uint64
+    P = ctypes.POINTER
+    _declare(lib, "secp256k1_pedersen_commitment_parse", c_int,
+             [c_void_p, P(secp256k1_pedersen_commitment), c_char_p])
+    _declare(lib, "secp256k1_pedersen_commitment_serialize", c_int,
+             [c_void_p, c_char_p, P(secp256k1_pedersen_commitment)])
+    _declare(lib, "secp256k1_pedersen_commit", c_int,
+             [c_void_p, P(secp256k1_pedersen_commitment), c_char_p, c_uint64, P(secp256k1_generator)])
+    _declare(lib, "secp256k1_pedersen_blind_sum", c_int,
+             [c_void_p, c_char_p, P(c_char_p), c_size_t, c_size_t])
+    _declare(lib, "secp256k1_pedersen_verify_tally", c_int,
+             [c_void_p, P(P(secp256k1_pedersen_commitment)), c_size_t,
+              P(P(secp256k1_pedersen_commitment)), c_size_t])
+    _declare(lib, "secp256k1_pedersen_blind_generator_blind_sum", c_int,
+             [c_void_p, P(c_uint64), P(c_void_p), P(c_void_p), c_size_t, c_size_t])
+    _declare(lib, "secp256k1_rangeproof_sign", c_int,
+             [c_void_p, c_char_p, P(c_size_t), c_uint64, P(secp256k1_pedersen_commitment),
+              c_char_p, c_char_p, c_int, c_int, c_uint64, c_char_p, c_size_t, c_char_p, c_size_t,
+              P(secp256k1_generator)])
+    _declare(lib, "secp256k1_rangeproof_verify", c_int,
+             [c_void_p, P(c_uint64), P(c_uint64), P(secp256k1_pedersen_commitment),
+              c_char_p, c_size_t, c_char_p, c_size_t, P(secp256k1_generator)])
+    _declare(lib, "secp256k1_rangeproof_rewind", c_int,
+             [c_void_p, c_char_p, P(c_uint64), c_char_p, P(c_size_t), c_char_p, P(c_uint64), P(c_uint64),
+              P(secp256k1_pedersen_commitment), c_char_p, c_size_t, c_char_p, c_size_t,
+              P(secp256k1_generator)])
+    _declare(lib, "secp256k1_rangeproof_info", c_int,
+             [c_void_p, P(c_int), P(c_int), P(c_uint64), P(c_uint64), c_char_p, c_size_t])
+
+def _declare_surjectionproof(lib):
+    c_void_p, c_int, c_char_p, c_size_t = ctypes.c_void_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t
+    P = ctypes.POINTER
+    _declare(lib, "secp256k1_surjectionproof_parse", c_int,
+             [c_void_p, P(secp256k1_surjectionproof), c_char_p, c_size_t])
+    _declare(lib, "secp256k1_surjectionproof_serialize", c_int,
+             [c_void_p, c_char_p, P(c_size_t), P(secp256k1_surjectionproof)])
+    _declare(lib, "secp256k1_surjectionproof_serialized_size", c_size_t,
+             [c_void_p, P(secp256k1_surjectionproof)])
+    _declare(lib, "secp256k1_surjectionproof_initialize", c_int,
+             [c_void_p, P(secp256k1_surjectionproof), P(c_size_t), P(secp256k1_fixed_asset_tag),
+              c_size_t, c_size_t, P(secp256k1_fixed_asset_tag), c_size_t, c_char_p])
+    _declare(lib, "secp256k1_surjectionproof_generate", c_int,
+             [c_void_p, P(secp256k1_surjectionproof), P(secp256k1_generator), c_size_t,
+              P(secp256k1_generator), c_size_t, c_char_p, c_char_p])
+    _declare(lib, "secp256k1_surjectionproof_verify", c_int,
+             [c_void_p, P(secp256k1_surjectionproof), P(secp256k1_generator), c_size_t,
+              P(secp256k1_generator)])
+
+def load():
+    lib = find_library()
+    if lib is None:
+        return (None, None)
+    try:
+        _declare_core(lib)
+    except AttributeError:
+        # Not a (compatible) libsecp256k1
+        return (None, None)
+    # Optional modules; see has_module()
+    for declare in (_declare_generator, _declare_rangeproof, _declare_surjectionproof):
+        try:
+            declare(lib)
+        except AttributeError:
+            pass
+    ctx = lib.secp256k1_context_create(SECP256K1_CONTEXT_SIGN | SECP256K1_CONTEXT_VERIFY)
+    if not ctx:
+        return (None, None)
+    if not lib.secp256k1_context_randomize(ctx, os.urandom(32)):
+        raise RuntimeError("secp256k1_context_randomize failed")
+    return (lib, ctx)
+
+(lib, ctx) = load()
+
+def has_module(name):
+    """Whether the loaded library was built with an optional module
+
+    eg has_module("generator") checks for secp256k1_generator_parse.
+    """
+    probes = {
+        "ecdh": "secp256k1_ecdh",
+        "generator": "secp256k1_generator_parse",
+        "rangeproof": "secp256k1_rangeproof_sign",
+        "surjectionproof": "secp256k1_surjectionproof_initialize",
+    }
+    return lib is not None and hasattr(lib, probes[name])
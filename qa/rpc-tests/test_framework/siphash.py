@@ -62,3 +62,124 @@ def siphash256(k0, k1, h):
     v0, v1, v2, v3 = siphash_round(v0, v1, v2, v3)
     v0, v1, v2, v3 = siphash_round(v0, v1, v2, v3)
     return v0 ^ v1 ^ v2 ^ v3
+
+# Batched SipHash-2-4 over many 256-bit integers with the same key, as
+# needed for BIP 152 short IDs.  Uses numpy uint64 vectors when numpy is
+# installed (arithmetic wraps for free, one pass of array ops per round for
+# the whole batch); otherwise a pure python loop with the rounds inlined,
+# which is still several times faster than calling siphash256 per hash.
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def _siphash256_batch_numpy(k0, k1, hashes):
+    data = b"".join(h.to_bytes(32, "little") for h in hashes)
+    n = numpy.frombuffer(data, dtype="<u8").reshape(-1, 4).astype(numpy.uint64)
+    n0, n1, n2, n3 = n[:, 0], n[:, 1], n[:, 2], n[:, 3]
+    shift = {b: (numpy.uint64(b), numpy.uint64(64 - b)) for b in (13, 16, 17, 21, 32)}
+
+    def rotl(x, b):
+        (left, right) = shift[b]
+        return (x << left) | (x >> right)
+
+    def rounds(v0, v1, v2, v3, count):
+        for i in range(count):
+            v0 += v1
+            v1 = rotl(v1, 13)
+            v1 ^= v0
+            v0 = rotl(v0, 32)
+            v2 += v3
+            v3 = rotl(v3, 16)
+            v3 ^= v2
+            v0 += v3
+            v3 = rotl(v3, 21)
+            v3 ^= v0
+            v2 += v1
+            v1 = rotl(v1, 17)
+            v1 ^= v2
+            v2 = rotl(v2, 32)
+        return (v0, v1, v2, v3)
+
+    count = len(n0)
+    v0 = numpy.full(count, 0x736f6d6570736575 ^ k0, dtype=numpy.uint64)
+    v1 = numpy.full(count, 0x646f72616e646f6d ^ k1, dtype=numpy.uint64)
+    v2 = numpy.full(count, 0x6c7967656e657261 ^ k0, dtype=numpy.uint64)
+    v3 = numpy.full(count, 0x7465646279746573 ^ k1, dtype=numpy.uint64) ^ n0
+    v0, v1, v2, v3 = rounds(v0, v1, v2, v3, 2)
+    v0 ^= n0
+    v3 ^= n1
+    v0, v1, v2, v3 = rounds(v0, v1, v2, v3, 2)
+    v0 ^= n1
+    v3 ^= n2
+    v0, v1, v2, v3 = rounds(v0, v1, v2, v3, 2)
+    v0 ^= n2
+    v3 ^= n3
+    v0, v1, v2, v3 = rounds(v0, v1, v2, v3, 2)
+    v0 ^= n3
+    v3 ^= numpy.uint64(0x2000000000000000)
+    v0, v1, v2, v3 = rounds(v0, v1, v2, v3, 2)
+    v0 ^= numpy.uint64(0x2000000000000000)
+    v2 ^= numpy.uint64(0xFF)
+    v0, v1, v2, v3 = rounds(v0, v1, v2, v3, 4)
+    return (v0 ^ v1 ^ v2 ^ v3).tolist()
+
+def _siphash256_batch_python(k0, k1, hashes):
+    M = (1 << 64) - 1
+    init0 = 0x736f6d6570736575 ^ k0
+    init1 = 0x646f72616e646f6d ^ k1
+    init2 = 0x6c7967656e657261 ^ k0
+    init3 = 0x7465646279746573 ^ k1
+    ret = []
+    for h in hashes:
+        words = (h & M, (h >> 64) & M, (h >> 128) & M, h >> 192, 0x2000000000000000)
+        v0, v1, v2, v3 = init0, init1, init2, init3
+        for m in words:
+            v3 ^= m
+            for i in range(2):
+                v0 = (v0 + v1) & M
+                v1 = ((v1 << 13) & M | v1 >> 51) ^ v0
+                v0 = (v0 << 32) & M | v0 >> 32
+                v2 = (v2 + v3) & M
+                v3 = ((v3 << 16) & M | v3 >> 48) ^ v2
+                v0 = (v0 + v3) & M
+                v3 = ((v3 << 21) & M | v3 >> 43) ^ v0
+                v2 = (v2 + v1) & M
+                v1 = ((v1 << 17) & M | v1 >> 47) ^ v2
+                v2 = (v2 << 32) & M | v2 >> 32
+            v0 ^= m
+        v2 ^= 0xFF
+        for i in range(4):
+            v0 = (v0 + v1) & M
+            v1 = ((v1 << 13) & M | v1 >> 51) ^ v0
+            v0 = (v0 << 32) & M | v0 >> 32
+            v2 = (v2 + v3) & M
+            v3 = ((v3 << 16) & M | v3 >> 48) ^ v2
+            v0 = (v0 + v3) & M
+            v3 = ((v3 << 21) & M | v3 >> 43) ^ v0
+            v2 = (v2 + v1) & M
+            v1 = ((v1 << 17) & M | v1 >> 47) ^ v2
+            v2 = (v2 << 32) & M | v2 >> 32
+        ret.append(v0 ^ v1 ^ v2 ^ v3)
+    return ret
+
+# Below this many hashes the numpy setup costs more than it saves
+NUMPY_BATCH_THRESHOLD = 16
+
+def siphash256_batch(k0, k1, hashes, use_numpy=None):
+    """siphash256(k0, k1, h) for every h in hashes, as a list
+
+    use_numpy forces (True) or disables (False) the numpy implementation;
+    by default it is used when available and the batch is big enough.
+    """
+    hashes = list(hashes)
+    if use_numpy is None:
+        use_numpy = numpy is not None and len(hashes) >= NUMPY_BATCH_THRESHOLD
+    if use_numpy:
+        if numpy is None:
+            raise RuntimeError("numpy is not available")
+        if not hashes:
+            return []
+        return _siphash256_batch_numpy(k0, k1, hashes)
+    return _siphash256_batch_python(k0, k1, hashes)
@@ -210,6 +210,8 @@ class ComparisonTestFramework(BitcoinTestFramework):
         parser.add_option("--refbinary", dest="refbinary",
                           default=os.getenv("ELEMENTSD", "elementsd"),
                           help="bitcoind binary to use for reference nodes (if any)")
+        parser.add_option("--pipeline", dest="pipeline_window", default=0, type='int',
+                          help="keep up to this many blocks/transactions in flight when the test syncs on every one (default: 0, disabled)")
 
     def setup_network(self):
         self.nodes = start_nodes(
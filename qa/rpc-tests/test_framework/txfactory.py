@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 The Elements Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+
+#
+# txfactory.py - wallet-free transaction construction
+#
+# TxFactory holds its own P2PKH keys and the set of outputs paying to them,
+# and builds signed Elements transactions from them entirely in python:
+# explicit asset tags and values, an explicit fee output, change back to
+# one of its own keys.  Nothing here talks to a node; hand the hex to
+# sendrawtransaction (or msg_tx) yourself.
+#
+# Typical use for load generation:
+#
+#   factory = TxFactory(asset=asset_from_hex(node.dumpassetlabels()["bitcoin"]))
+#   txid = node.sendtoaddress(factory.get_new_address(), 100, "", "", False, "bitcoin", True)
+#   factory.add_transaction(node.getrawtransaction(txid))
+#   factory.split(1000, 10000000)    # fan out
+#   for txhex in factory.payments(10000, 1000):
+#       node.sendrawtransaction(txhex, True, True)
+#
+# Outputs are tracked as soon as a transaction is built, so chains of
+# unconfirmed transactions can be produced without waiting for blocks.
+#
+
+import os
+
+from collections import deque
+from io import BytesIO
+
+from .address import ELEMENTS_PUBKEY_ADDRESS, ELEMENTS_SCRIPT_ADDRESS, base58_to_byte, key_to_p2pkh
+from .key import CECKey
+from .mininode import COutPoint, CTransaction, CTxIn, CTxOut, CTxOutAsset
+from .script import CScript, OP_CHECKSIG, OP_DUP, OP_EQUAL, OP_EQUALVERIFY, OP_HASH160, \
+    PrecomputedTransactionData, SignatureHash, SIGHASH_ALL, hash160
+from .util import BITCOIN_ASSET, hex_str_to_bytes
+
+DEFAULT_FEE = 10000
+
+def asset_from_hex(asset_hex):
+    """Asset id bytes as serialized in transactions, from its RPC hex form"""
+    return hex_str_to_bytes(asset_hex)[::-1]
+
+def p2pkh_script(pubkey):
+    return CScript([OP_DUP, OP_HASH160, hash160(pubkey), OP_EQUALVERIFY, OP_CHECKSIG])
+
+def address_to_script(address):
+    """scriptPubKey for an unconfidential Elements P2PKH or P2SH address"""
+    (payload, version) = base58_to_byte(address)
+    if version == ELEMENTS_PUBKEY_ADDRESS:
+        return CScript([OP_DUP, OP_HASH160, payload, OP_EQUALVERIFY, OP_CHECKSIG])
+    if version == ELEMENTS_SCRIPT_ADDRESS:
+        return CScript([OP_HASH160, payload, OP_EQUAL])
+    raise ValueError("unsupported address version %d" % version)
+
+class UTXO(object):
+    __slots__ = ("txid", "n", "value", "asset", "script")
+
+    def __init__(self, txid, n, value, asset, script):
+        self.txid = txid
+        self.n = n
+        self.value = value
+        self.asset = asset
+        self.script = script
+
+    def outpoint(self):
+        return COutPoint(self.txid, self.n)
+
+    def __repr__(self):
+        return "UTXO(txid=%064x n=%d value=%d asset=%s)" % (self.txid, self.n, self.value, self.asset[::-1].hex())
+
+class TxFactory(object):
+    """Keys, UTXO set and coin selection for building signed transactions
+
+    Coin selection is first-in first-out per asset, which keeps it O(inputs
+    used) and naturally spreads load over a fanned-out UTXO set.
+    """
+
+    def __init__(self, asset=bytes(BITCOIN_ASSET), fee=DEFAULT_FEE, address_version=ELEMENTS_PUBKEY_ADDRESS):
+        self.asset = asset
+        self.fee = fee
+        self.address_version = address_version
+        self.keys = {}       # scriptPubKey -> (CECKey, pubkey)
+        self.scripts = []    # our scriptPubKeys, in creation order
+        self.utxos = {}      # asset -> deque of UTXO
+        self.next_script = 0
+
+    def new_key(self, secret=None):
+        """Add a key, returning its scriptPubKey"""
+        key = CECKey()
+        key.set_secretbytes(secret or os.urandom(32))
+        key.set_compressed(True)
+        pubkey = key.get_pubkey()
+        script = p2pkh_script(pubkey)
+        self.keys[script] = (key, pubkey)
+        self.scripts.append(script)
+        return script
+
+    def get_new_address(self):
+        script = self.new_key()
+        return key_to_p2pkh(self.keys[script][1], version=self.address_version)
+
+    def _change_script(self):
+        # Round-robin over our keys rather than creating one per output
+        if not self.scripts:
+            self.new_key()
+        script = self.scripts[self.next_script % len(self.scripts)]
+        self.next_script += 1
+        return script
+
+    def is_mine(self, script):
+        return bytes(script) in self.keys
+
+    def add_utxo(self, utxo):
+        self.utxos.setdefault(utxo.asset, deque()).append(utxo)
+
+    def add_transaction(self, tx):
+        """Track the explicit outputs of tx (CTransaction or hex) that pay to us"""
+        if isinstance(tx, str):
+            hex_tx = tx
+            tx = CTransaction()
+            tx.deserialize(BytesIO(hex_str_to_bytes(hex_tx)))
+        tx.calc_sha256()
+        for (n, txout) in enumerate(tx.vout):
+            script = bytes(txout.scriptPubKey)
+            if script not in self.keys or txout.nValue.vchCommitment[0] != 1 or txout.nAsset.vchCommitment[0] != 1:
+                continue
+            self.add_utxo(UTXO(tx.sha256, n, txout.nValue.getAmount(), txout.nAsset.vchCommitment[1:], script))
+        return tx
+
+    def balance(self, asset=None):
+        return sum(utxo.value for utxo in self.utxos.get(asset or self.asset, ()))
+
+    def count_utxos(self, asset=None):
+        return len(self.utxos.get(asset or self.asset, ()))
+
+    def select_coins(self, amount, asset=None):
+        """Remove and return UTXOs of asset adding up to at least amount"""
+        available = self.utxos.get(asset or self.asset, deque())
+        selected = []
+        total = 0
+        while total < amount:
+            if not available:
+                # Put them back where they were
+                available.extendleft(reversed(selected))
+                raise ValueError("insufficient funds: need %d, have %d" % (amount, total))
+            utxo = available.popleft()
+            selected.append(utxo)
+            total += utxo.value
+        return selected
+
+    def sign_transaction(self, tx, spent):
+        """Sign every input of tx, spending the UTXOs in spent"""
+        cache = PrecomputedTransactionData(tx)
+        for (i, utxo) in enumerate(spent):
+            (key, pubkey) = self.keys[utxo.script]
+            (sighash, err) = SignatureHash(CScript(utxo.script), tx, i, SIGHASH_ALL, cache)
+            tx.vin[i].scriptSig = CScript([key.sign(sighash) + bytes([SIGHASH_ALL]), pubkey])
+
+    def create_transaction(self, outputs, fee=None, asset=None):
+        """Build and sign a transaction paying outputs, with change and fee
+
+        outputs is a list of (script or address, value) or (script or
+        address, value, asset) tuples.  Inputs of every asset involved are
+        selected from our UTXOs; the fee is paid in the factory's asset.
+        Our own outputs (including change) are tracked for later spending.
+        """
+        fee = self.fee if fee is None else fee
+        asset = asset or self.asset
+        needed = {asset: fee}
+        tx = CTransaction()
+        for output in outputs:
+            (dest, value) = output[:2]
+            out_asset = output[2] if len(output) > 2 else asset
+            script = address_to_script(dest) if isinstance(dest, str) else CScript(dest)
+            tx.vout.append(CTxOut(value, script, CTxOutAsset(b'\x01' + out_asset)))
+            needed[out_asset] = needed.get(out_asset, 0) + value
+
+        spent = []
+        try:
+            for (out_asset, amount) in needed.items():
+                selected = self.select_coins(amount, out_asset)
+                spent += selected
+                change = sum(utxo.value for utxo in selected) - amount
+                if change > 0:
+                    tx.vout.append(CTxOut(change, self._change_script(), CTxOutAsset(b'\x01' + out_asset)))
+        except ValueError:
+            for utxo in reversed(spent):
+                self.utxos[utxo.asset].appendleft(utxo)
+            raise
+        # Explicit fee output: empty scriptPubKey
+        tx.vout.append(CTxOut(fee, b'', CTxOutAsset(b'\x01' + asset)))
+        for utxo in spent:
+            tx.vin.append(CTxIn(utxo.outpoint(), b'', 0xffffffff))
+
+        self.sign_transaction(tx, spent)
+        self.add_transaction(tx)
+        return tx
+
+    def split(self, count, value, asset=None):
+        """Fan out: one transaction creating count outputs of value to our keys"""
+        while len(self.scripts) < min(count, 100):
+            self.new_key()
+        return self.create_transaction([(self._change_script(), value, asset or self.asset) for i in range(count)])
+
+    def payments(self, count, value, dest=None):
+        """Generate count signed hex transactions, each paying value
+
+        Pays dest (script or address) if given, otherwise one of our own
+        keys, so the payments can themselves be spent again.
+        """
+        for i in range(count):
+            tx = self.create_transaction([(dest if dest is not None else self._change_script(), value)])
+            yield tx.serialize().hex()